@@ -0,0 +1,192 @@
+"""
+Semantic response cache
+Near-duplicate queries (by embedding cosine similarity) reuse an earlier response
+as long as no knowledge their retrieval could return has changed since
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+import numpy as np
+from app.config import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY
+
+logger = logging.getLogger(__name__)
+
+class SemanticResponseCache:
+    """Size-bounded, TTL-limited cache of chat responses keyed by query embedding"""
+
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 similarity: float = RESPONSE_CACHE_SIMILARITY, epoch: Optional[Callable[[], int]] = None,
+                 changes: Optional[Callable[[int], Optional[np.ndarray]]] = None, invalidate_distance: float = 0.0):
+        self.max_size = max_size
+        self.ttl = ttl  # Seconds; 0 keeps entries until evicted by size
+        self.similarity = similarity  # Minimum cosine similarity for a hit
+        self._entries: "OrderedDict[int, Dict]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        # Stacked vectors of all entries, rebuilt lazily after changes
+        self._ids = []
+        self._unit_matrix = None
+        self._raw_matrix = None
+        # Knowledge store epoch (KnowledgeStore.epoch) and the embeddings changed since an
+        # earlier one (KnowledgeStore.changed_embeddings): when the epoch moves - teaches,
+        # evictions, snapshot loads in any process - entries whose query is within
+        # invalidate_distance (squared L2) of a changed embedding are dropped, and all
+        # of them when the changes are not known
+        self._epoch_source = epoch
+        self._changes = changes
+        self.invalidate_distance = invalidate_distance
+        self._epoch = None  # Epoch the entries are valid at
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def lookup(self, embedding: np.ndarray) -> Optional[Dict]:
+        """
+        Find a cached response for a query
+
+        Args:
+            embedding: Query embedding
+
+        Returns:
+            The cached response dictionary, or None
+        """
+        query = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return None
+        epoch = self.current_epoch()
+
+        with self._lock:
+            self._sync_epoch(epoch)
+            self._expire()
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            self._build_matrix()
+            scores = self._unit_matrix @ (query / norm)
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity:
+                self.misses += 1
+                return None
+
+            entry_id = self._ids[best]
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return dict(self._entries[entry_id]["response"])
+
+    def store(self, embedding: np.ndarray, response: Dict, epoch: Optional[int] = None):
+        """
+        Cache a response for a query, evicting the least recently used entries
+
+        Args:
+            embedding: Query embedding
+            response: Response dictionary
+            epoch: current_epoch() read before retrieval; the response is not cached
+                if knowledge near the query changed while it was being generated
+        """
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return
+        current = self.current_epoch()
+
+        if epoch is not None and epoch != current and self._near_changes(epoch, vector[None, :]).any():
+            self.stale_puts += 1
+            return
+
+        with self._lock:
+            self._sync_epoch(current)
+            self._entries[self._next_id] = {
+                "raw": vector,
+                "unit": vector / norm,
+                "response": dict(response),
+                "stored_at": time.monotonic()
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._unit_matrix = None
+
+    def current_epoch(self) -> Optional[int]:
+        """The knowledge store's epoch (None without an epoch source)"""
+        return self._epoch_source() if self._epoch_source is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._unit_matrix = None
+            self._raw_matrix = None
+
+    def stats(self) -> Dict:
+        """Hit rate and size statistics"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "similarity": self.similarity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "stale_puts": self.stale_puts
+            }
+
+    def _near_changes(self, since: int, vectors: np.ndarray) -> np.ndarray:
+        """Which vectors are near an embedding changed after epoch since (all if unknown)"""
+        changed = self._changes(since) if self._changes is not None else None
+        if changed is None:
+            return np.ones(len(vectors), dtype=bool)
+        near = np.zeros(len(vectors), dtype=bool)
+        for start in range(0, len(changed), 1024):
+            block = changed[start:start + 1024]
+            distances = (
+                np.einsum("ij,ij->i", vectors, vectors)[:, None] + np.einsum("ij,ij->i", block, block)[None, :]
+                - 2.0 * vectors @ block.T
+            )
+            near |= (distances <= self.invalidate_distance).any(axis=1)
+        return near
+
+    def _sync_epoch(self, epoch: Optional[int]):
+        """Catch up with knowledge changes since the entries' epoch (lock held)"""
+        if epoch == self._epoch:
+            return
+        if self._entries:
+            self._build_matrix()
+            near = self._near_changes(self._epoch, self._raw_matrix)
+            self._remove([self._ids[i] for i in np.flatnonzero(near)])
+        self._epoch = epoch
+
+    def _remove(self, stale) -> int:
+        """Drop entries invalidated by knowledge changes (lock held)"""
+        for entry_id in stale:
+            del self._entries[entry_id]
+        if stale:
+            self._unit_matrix = None
+            self.invalidations += len(stale)
+            logger.debug(f"Invalidated {len(stale)} cached responses")
+        return len(stale)
+
+    def _expire(self):
+        """Remove entries older than the TTL (lock held)"""
+        if not self.ttl:
+            return
+        cutoff = time.monotonic() - self.ttl
+        expired = [entry_id for entry_id, entry in self._entries.items() if entry["stored_at"] < cutoff]
+        for entry_id in expired:
+            del self._entries[entry_id]
+        if expired:
+            self._unit_matrix = None
+
+    def _build_matrix(self):
+        """Stack entry vectors for vectorized search (lock held)"""
+        if self._unit_matrix is not None:
+            return
+        self._ids = list(self._entries.keys())
+        self._unit_matrix = np.stack([self._entries[i]["unit"] for i in self._ids])
+        self._raw_matrix = np.stack([self._entries[i]["raw"] for i in self._ids])
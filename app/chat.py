@@ -3,71 +3,118 @@ Chat handler that combines model inference with RAG knowledge retrieval
 """
 import logging
 import threading
-from typing import List, Dict, Optional
-from app.model import Phi2Model
-from app.knowledge import KnowledgeStore
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Dict, Optional
+from app.model import Phi2Model, GENERATION_ERROR_PREFIX
+from app.knowledge import KnowledgeStore, chunk_knowledge, retrieval_max_distance
+from app.scheduler import GenerationScheduler
+from app.cache import SemanticResponseCache
+from app.ingestion import IngestionQueue
+from app.compaction import KnowledgeCompactor, limits_enabled
+from app.chat_batch import answer_batch
+from app.sessions import Session, SessionStore
+from app.metrics import stage
+from app.context import pack_context
+from app.config import (
+    RESPONSE_CACHE_SIZE, INGEST_WAL_PATH, SESSION_KV_CACHE, SESSION_MAX_CONTEXT_TOKENS, MAX_RETRIEVED_DOCS
+)
 
 logger = logging.getLogger(__name__)
 
 class ChatHandler:
     """Handles chat interactions with learning capabilities"""
 
-    def __init__(self):
+    def __init__(self, ingest_wal_path: Optional[Path] = None, run_compaction: bool = True):
+        """
+        Args:
+            ingest_wal_path: Teach write-ahead log (defaults to INGEST_WAL_PATH; one per pre-fork worker)
+            run_compaction: Run the knowledge eviction job when limits are configured (one pre-fork worker does)
+        """
         self.model = Phi2Model()
+        self.scheduler = GenerationScheduler(self.model)
         self.knowledge_store = KnowledgeStore()
-        self.conversation_history: List[Dict] = []
+        # Answers are dropped when knowledge their retrieval could return changes
+        self.response_cache = SemanticResponseCache(
+            epoch=lambda: self.knowledge_store.epoch,
+            changes=self.knowledge_store.changed_embeddings,
+            invalidate_distance=retrieval_max_distance()
+        ) if RESPONSE_CACHE_SIZE > 0 else None
+        self.ingestion = IngestionQueue(self.knowledge_store, wal_path=ingest_wal_path or INGEST_WAL_PATH)
+        self.compactor = KnowledgeCompactor(self.knowledge_store) if run_compaction and limits_enabled() else None
+        if self.compactor is not None:
+            self.compactor.start()
+        self.sessions = SessionStore()
+        # Extends session KV caches over each finished turn off the request path
+        self._session_cache_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-cache")
 
-    def chat(self, user_message: str, conversation_id: Optional[str] = None) -> Dict:
+    def _query_embedding(self, user_message: str):
+        """Query embedding for the response cache and retrieval (None when the cache is off)"""
+        if self.response_cache is None:
+            return None
+        # Retrieval reuses this, so the embed stage is timed once per request
+        with stage("embed"):
+            return self.knowledge_store.embedding_model.encode(user_message)[0]
+
+    def chat(self, user_message: str, conversation_id: Optional[str] = None,
+             stop: Optional[List[str]] = None) -> Dict:
         """
         Process chat message with RAG - fast synchronous retrieval, async learning
 
         Args:
             user_message: User's message
             conversation_id: Optional conversation ID for context
+            stop: Extra stop strings for this request
 
         Returns:
             Dictionary with response and metadata
         """
         try:
+            # Near-duplicate questions are answered from the response cache
+            # (not for custom stop strings or conversations - the answer depends on them)
+            cacheable = not stop and not conversation_id
+            query_embedding = self._query_embedding(user_message) if cacheable else None
+            epoch = None
+            if query_embedding is not None:
+                epoch = self.response_cache.current_epoch()  # Before retrieval, so later writes are noticed
+                cached = self.response_cache.lookup(query_embedding)
+                if cached is not None:
+                    return {**cached, "conversation_id": conversation_id, "cached": True}
+
             # Fast synchronous knowledge retrieval (should be instant)
             relevant_knowledge = self.knowledge_store.retrieve_relevant_knowledge(
                 user_message,
-                top_k=2  # Limit to 2 for speed
+                top_k=MAX_RETRIEVED_DOCS,
+                query_embedding=query_embedding
             )
 
-            # Build context silently (no metadata tags that reveal knowledge source)
-            context = ""
-            if relevant_knowledge:
-                # Just use the text, don't reveal it's learned knowledge
-                context_parts = [item['text'] for item in relevant_knowledge[:2]]
-                context = " ".join(context_parts)
-                logger.debug(f"Using {len(relevant_knowledge)} knowledge items (silently)")
+            # Build context silently (no metadata tags that reveal knowledge source) from
+            # the best chunks that fit the token budget, so prefill cost stays bounded
+            context, knowledge_used = pack_context(relevant_knowledge)
+            if knowledge_used:
+                logger.debug(f"Using {knowledge_used} knowledge items ({len(context)} tokens, silently)")
 
-            # Generate response (fast with max 50 tokens)
-            response = self.model.generate(
-                prompt=user_message,
-                context=context,
-                max_tokens=50  # Hard limit for speed
-            )
+            if conversation_id:
+                # Follow-up turns build on the conversation (and its cached prefill)
+                response = self._generate_turn(conversation_id, user_message, context, stop, knowledge_used)
+            else:
+                # Generate response (fast with max 50 tokens, batched with concurrent requests)
+                response = self.scheduler.generate(
+                    prompt=user_message,
+                    context=context,
+                    max_tokens=50,  # Hard limit for speed
+                    stop=stop
+                )
 
-            # Background learning - fire and forget, doesn't block response
-            def store_conversation():
-                try:
-                    self.conversation_history.append({
-                        "user": user_message,
-                        "assistant": response,
-                        "knowledge_used": len(relevant_knowledge)
-                    })
-                except:
-                    pass  # Silently fail background task
-
-            # Run in background thread - don't wait
-            import threading
-            threading.Thread(target=store_conversation, daemon=True).start()
+            if query_embedding is not None and not response.startswith(GENERATION_ERROR_PREFIX):
+                self.response_cache.store(query_embedding, {
+                    "response": response,
+                    "knowledge_used": knowledge_used
+                }, epoch=epoch)
 
             return {
                 "response": response,
-                "knowledge_used": len(relevant_knowledge),
+                "knowledge_used": knowledge_used,
                 "conversation_id": conversation_id
             }
 
@@ -78,16 +125,95 @@ class ChatHandler:
                 "error": True
             }
 
+    def chat_stream(self, user_message: str, conversation_id: Optional[str] = None,
+                    cancel_event: Optional[threading.Event] = None,
+                    stop: Optional[List[str]] = None) -> Iterator[Dict]:
+        """
+        Process chat message with RAG, streaming the response as it is decoded
+
+        Args:
+            user_message: User's message
+            conversation_id: Optional conversation ID for context
+            cancel_event: Optional event that stops generation when set
+            stop: Extra stop strings for this request
+
+        Yields:
+            {"token": ...} events, then a final {"done": True, ...} event with metadata
+        """
+        cacheable = not stop and not conversation_id
+        query_embedding = self._query_embedding(user_message) if cacheable else None
+        epoch = None
+        if query_embedding is not None:
+            epoch = self.response_cache.current_epoch()
+            cached = self.response_cache.lookup(query_embedding)
+            if cached is not None:
+                yield {"token": cached["response"]}
+                yield {"done": True, **cached, "conversation_id": conversation_id, "cached": True}
+                return
+
+        relevant_knowledge = self.knowledge_store.retrieve_relevant_knowledge(
+            user_message,
+            top_k=MAX_RETRIEVED_DOCS,
+            query_embedding=query_embedding
+        )
+        context, knowledge_used = pack_context(relevant_knowledge)
+
+        parts = []
+        try:
+            for piece in self.model.stream(
+                prompt=user_message,
+                context=context,
+                max_tokens=50,
+                cancel_event=cancel_event,
+                stop=stop
+            ):
+                parts.append(piece)
+                yield {"token": piece}
+        except Exception as e:
+            logger.error(f"Error in chat stream: {e}")
+            yield {"done": True, "error": True, "response": "Sorry, I encountered an error."}
+            return
+
+        response = "".join(parts)
+        if query_embedding is not None:
+            self.response_cache.store(query_embedding, {
+                "response": response,
+                "knowledge_used": knowledge_used
+            }, epoch=epoch)
+        if conversation_id:
+            # Streams do not use the conversation prompt yet; the turn is recorded for later ones
+            self.sessions.add_turn(conversation_id, user_message, response, knowledge_used)
+
+        yield {
+            "done": True,
+            "response": response,
+            "knowledge_used": knowledge_used,
+            "conversation_id": conversation_id
+        }
+
+    def chat_batch(self, messages: List[str], stop: Optional[List[str]] = None) -> Iterator[Dict]:
+        """
+        Answer many independent messages with batched retrieval and generation
+
+        Args:
+            messages: User messages
+            stop: Extra stop strings for every message
+
+        Yields:
+            {"index", "response", "knowledge_used"} per message, in completion order
+        """
+        return answer_batch(self.model, self.knowledge_store, messages, stop=stop)
+
     def teach(self, knowledge: str, topic: str = "") -> Dict:
         """
-        Store new knowledge - async background storage for speed
+        Store new knowledge - queued durably, stored in the background for speed
 
         Args:
             knowledge: The knowledge to store
             topic: Optional topic/category
 
         Returns:
-            Dictionary with success status and message
+            Dictionary with success status, message and ingestion job id
         """
         try:
             # Validate first (fast check)
@@ -97,21 +223,14 @@ class ChatHandler:
                     "message": "Knowledge too short (minimum 10 characters)"
                 }
 
-            # Async store - fire and forget for instant response
-            def store_async():
-                try:
-                    self.knowledge_store.store_knowledge(knowledge, topic)
-                    logger.info(f"Knowledge stored (background): {topic if topic else 'General'}")
-                except Exception as e:
-                    logger.error(f"Background knowledge storage failed: {e}")
+            # Durable queue - storage (embedding + database write) happens in batches in the background
+            job_id = self.ingestion.submit(knowledge, topic)
 
-            # Store in background thread - don't wait
-            threading.Thread(target=store_async, daemon=True).start()
-
-            # Return immediately - storage happens in background
+            # Return immediately - the job id can be used to check progress
             return {
                 "success": True,
-                "message": "Knowledge will be stored in background"
+                "message": "Knowledge will be stored in background",
+                "job_id": job_id
             }
 
         except Exception as e:
@@ -121,8 +240,137 @@ class ChatHandler:
                 "message": f"Error: {str(e)}"
             }
 
-    def clear_history(self):
-        """Clear conversation history"""
-        self.conversation_history = []
+    def teach_batch(self, items: List[Dict]) -> Dict:
+        """
+        Queue many documents at once, chunking long ones to fit the knowledge size limit
+
+        Args:
+            items: Dictionaries with 'knowledge' and optional 'topic' keys
+
+        Returns:
+            Dictionary with success status, message and one job id per stored chunk
+        """
+        try:
+            chunks = []
+            for item in items:
+                for chunk in chunk_knowledge(item.get("knowledge") or ""):
+                    if len(chunk.strip()) >= 10:
+                        chunks.append({"knowledge": chunk, "topic": item.get("topic") or ""})
+
+            if not chunks:
+                return {
+                    "success": False,
+                    "message": "No valid knowledge in batch",
+                    "job_ids": []
+                }
+
+            # One WAL write for the whole batch; the worker embeds and stores in large batches
+            job_ids = self.ingestion.submit_many(chunks)
+            return {
+                "success": True,
+                "message": f"{len(items)} documents queued as {len(chunks)} chunks",
+                "job_ids": job_ids
+            }
+
+        except Exception as e:
+            logger.error(f"Error in teach batch: {e}")
+            return {
+                "success": False,
+                "message": f"Error: {str(e)}",
+                "job_ids": []
+            }
+
+    def teach_status(self, job_id: str) -> Optional[Dict]:
+        """Status of a queued teach job (None if unknown)"""
+        return self.ingestion.status(job_id)
+
+    def _generate_turn(self, conversation_id: str, user_message: str, context: List[int],
+                       stop: Optional[List[str]], knowledge_used: int) -> str:
+        """
+        Generate a reply within a conversation and record the turn
+
+        The prompt is the conversation's token history plus the new message. With
+        SESSION_KV_CACHE the cache from the previous turn covers the history, so only
+        the new message is prefilled; the cache is then extended over the reply in
+        the background, ready for the next turn.
+        """
+        session = self.sessions.get(conversation_id)
+        with stage("tokenize"):
+            user_ids = self.model.encode_prompt(user_message, context)
+        prompt_ids = self._conversation_prompt(session, user_ids)
+
+        result = self.model.generate_with_history(
+            prompt_ids,
+            user_message,
+            max_tokens=50,
+            stop=stop,
+            past_ids=session.past_ids if session else None,
+            past_key_values=session.past_key_values if session else None
+        )
+        response = result["response"]
+        if response.startswith(GENERATION_ERROR_PREFIX):
+            return response
+
+        turn_ids = prompt_ids + self.model.encode_text(f" {response}\n")
+        self.sessions.add_turn(conversation_id, user_message, response, knowledge_used, token_ids=turn_ids)
+
+        if SESSION_KV_CACHE and result["cache"] is not None:
+            def extend_cache():
+                try:
+                    cache = self.model.extend_cache(result["cache_ids"], result["cache"], turn_ids)
+                    self.sessions.set_cache(conversation_id, turn_ids, cache)
+                except Exception as e:
+                    logger.error(f"Error extending session cache: {e}")
+
+            self._session_cache_pool.submit(extend_cache)
+
+        return response
+
+    def _conversation_prompt(self, session: Optional[Session], user_ids: List[int]) -> List[int]:
+        """
+        Prompt tokens for the next turn: the conversation history plus the new message
+
+        When the history would exceed SESSION_MAX_CONTEXT_TOKENS it is rebuilt from the
+        most recent turns filling half the limit, so the (cache-invalidating) rebuild
+        happens only once every few turns.
+        """
+        if session is None:
+            return user_ids[-SESSION_MAX_CONTEXT_TOKENS:]
+
+        history = session.token_ids
+        if history is None or len(history) + len(user_ids) > SESSION_MAX_CONTEXT_TOKENS:
+            budget = SESSION_MAX_CONTEXT_TOKENS // 2 if history is not None else SESSION_MAX_CONTEXT_TOKENS
+            history = self._turn_ids(session.turns, budget - len(user_ids))
+        return (history + user_ids)[-SESSION_MAX_CONTEXT_TOKENS:]
+
+    def _turn_ids(self, turns, budget: int) -> List[int]:
+        """Token ids of the most recent turns that fit in budget tokens"""
+        ids: List[int] = []
+        for turn in reversed(list(turns)):
+            turn_ids = self.model.encode_text(turn["user"]) + self.model.encode_text(f" {turn['assistant']}\n")
+            if len(ids) + len(turn_ids) > budget:
+                break
+            ids = turn_ids + ids
+        return ids
+
+    def load_snapshot(self, path: Path) -> Dict:
+        """Switch the knowledge store to a snapshot and drop responses cached from the old knowledge"""
+        header = self.knowledge_store.load_snapshot(path)
+        if self.response_cache is not None:
+            self.response_cache.clear()
+        return header
+
+    def close(self):
+        """Flush pending knowledge and stop background workers"""
+        self.ingestion.close()
+        if self.compactor is not None:
+            self.compactor.close()
+        self.knowledge_store.usage.close()
+        self.scheduler.close()
+        self._session_cache_pool.shutdown(wait=False)
+
+    def clear_history(self, conversation_id: Optional[str] = None):
+        """Clear one conversation's history, or all of them"""
+        self.sessions.clear(conversation_id)
         logger.info("Conversation history cleared")
 
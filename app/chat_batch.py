@@ -0,0 +1,159 @@
+"""
+Offline batch chat
+Answers many messages at once: each chunk of messages is embedded with one
+encode call and searched with one multi-query search, then the prompts are
+sorted by token length and generated in padded batches of similar length.
+Serves POST /chat/batch and the file-in/file-out command line
+
+Usage:
+    python -m app.chat_batch prompts.jsonl answers.jsonl
+    python -m app.chat_batch prompts.txt answers.jsonl --batch-size 32
+
+JSONL input lines hold a "message" (plus an optional "id", copied to the
+output); text input has one message per line. Answers are written as their
+batch finishes - not in input order - with the message's "index" (0-based
+position among the input messages).
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from app.config import (
+    LOG_LEVEL, MAX_RETRIEVED_DOCS, CHAT_BATCH_CHUNK, CHAT_BATCH_GENERATE_SIZE
+)
+from app.context import build_prompt_ids, encode_texts, pack_context
+from app.knowledge import KnowledgeStore
+from app.metrics import stage
+from app.model import Phi2Model, GENERATION_ERROR_PREFIX
+
+logger = logging.getLogger(__name__)
+
+def answer_batch(model: Phi2Model, store: KnowledgeStore, messages: List[str],
+                 stop: Optional[List[str]] = None, max_tokens: int = 50,
+                 chunk_size: int = CHAT_BATCH_CHUNK,
+                 batch_size: int = CHAT_BATCH_GENERATE_SIZE) -> Iterator[Dict]:
+    """
+    Answer messages with batched retrieval and length-sorted batched generation
+
+    Messages are answered independently (no conversations, no response cache).
+
+    Args:
+        model: Chat model
+        store: Knowledge store to retrieve from
+        messages: User messages
+        stop: Extra stop strings for every message
+        max_tokens: Maximum tokens per response
+        chunk_size: Messages retrieved together (one encode and one search call)
+        batch_size: Prompts per generate call
+
+    Yields:
+        {"index", "response", "knowledge_used"} per message (with "error": True if
+        generation failed), in completion order
+    """
+    for chunk_start in range(0, len(messages), chunk_size):
+        chunk = messages[chunk_start:chunk_start + chunk_size]
+        retrieved = store.retrieve_relevant_knowledge_batch(chunk, top_k=MAX_RETRIEVED_DOCS)
+        packed = [pack_context(items) for items in retrieved]
+        with stage("tokenize"):
+            prompt_ids = [
+                build_prompt_ids(message_ids, context)
+                for message_ids, (context, _) in zip(encode_texts(chunk), packed)
+            ]
+
+        # Prompts of similar length share a batch, so little of each forward pass is padding
+        order = sorted(range(len(chunk)), key=lambda i: len(prompt_ids[i]))
+        for start in range(0, len(order), batch_size):
+            group = order[start:start + batch_size]
+            responses = model.generate_batch(
+                [chunk[i] for i in group],
+                max_tokens=max_tokens,
+                stop=stop,
+                prompt_ids=[prompt_ids[i] for i in group]
+            )
+            for i, response in zip(group, responses):
+                result = {"index": chunk_start + i, "response": response, "knowledge_used": packed[i][1]}
+                if response.startswith(GENERATION_ERROR_PREFIX):
+                    result.update(response="Sorry, I encountered an error.", error=True)
+                yield result
+
+def read_messages(path: Path, fmt: str) -> Tuple[List[str], List[Optional[str]]]:
+    """
+    Messages and their ids from an input file (blank and malformed lines are skipped)
+
+    Returns:
+        (messages, ids - None where the input gave none)
+    """
+    messages, ids = [], []
+    with open(path, "r", encoding="utf-8") as source:
+        for number, line in enumerate(source, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if fmt == "text":
+                messages.append(line)
+                ids.append(None)
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed line {number}")
+                continue
+            message = (record.get("message") or "").strip()
+            if not message:
+                logger.warning(f"Skipping line {number} without a message")
+                continue
+            messages.append(message)
+            ids.append(record.get("id"))
+    return messages, ids
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Answer a file of chat messages offline")
+    parser.add_argument("input", type=Path, help="Messages (JSONL with a 'message' field, or one per line)")
+    parser.add_argument("output", type=Path, help="JSONL answers")
+    parser.add_argument("--format", choices=["jsonl", "text"], help="Input format (default: from extension)")
+    parser.add_argument("--chunk-size", type=int, default=CHAT_BATCH_CHUNK, help="Messages retrieved together")
+    parser.add_argument("--batch-size", type=int, default=CHAT_BATCH_GENERATE_SIZE, help="Prompts per generate call")
+    parser.add_argument("--stop", action="append", help="Extra stop string (repeatable)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, LOG_LEVEL),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    if not args.input.exists():
+        logger.error(f"Input not found: {args.input}")
+        return 1
+
+    fmt = args.format or ("jsonl" if args.input.suffix in (".jsonl", ".ndjson") else "text")
+    messages, ids = read_messages(args.input, fmt)
+    logger.info(f"Answering {len(messages)} messages from {args.input}")
+
+    model, store = Phi2Model(), KnowledgeStore()
+    started = time.monotonic()
+    answered = failed = 0
+    with open(args.output, "w", encoding="utf-8") as output:
+        for result in answer_batch(model, store, messages, stop=args.stop,
+                                   chunk_size=max(1, args.chunk_size), batch_size=max(1, args.batch_size)):
+            if ids[result["index"]] is not None:
+                result["id"] = ids[result["index"]]
+            output.write(json.dumps(result) + "\n")
+            answered += 1
+            failed += bool(result.get("error"))
+            if answered % 1000 == 0:
+                output.flush()
+                logger.info(f"{answered}/{len(messages)} answered ({answered / (time.monotonic() - started):.1f}/sec)")
+    store.usage.close()
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Done: {answered} messages in {elapsed:.1f}s ({answered / elapsed if elapsed > 0 else 0.0:.1f}/sec), "
+        f"{failed} failed"
+    )
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Knowledge store capacity limits
+Evicts entries idle for longer than KNOWLEDGE_TTL and the coldest entries
+beyond KNOWLEDGE_MAX_ENTRIES, then compacts the vector backend to reclaim
+their space. Runs periodically in the background, or once from the command line
+
+Usage:
+    python -m app.compaction --max-entries 100000 --ttl 2592000
+    python -m app.compaction --dry-run
+
+An entry's activity is the later of its last retrieval (last_used) and its
+last teach (last_taught). Entries with neither - stored before usage tracking -
+are evicted first when over capacity but never expire.
+"""
+import argparse
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from app.config import (
+    LOG_LEVEL, KNOWLEDGE_MAX_ENTRIES, KNOWLEDGE_TTL, KNOWLEDGE_COMPACT_INTERVAL,
+    KNOWLEDGE_PAGE_MAX, MAX_RETRIEVED_DOCS
+)
+from app.knowledge import KnowledgeStore
+from app.vector_store import VectorBackend
+
+logger = logging.getLogger(__name__)
+
+LATENCY_PROBES = 16  # Stored embeddings used as queries to measure search latency
+LATENCY_ROUNDS = 3
+DELETE_CHUNK = 500
+
+def limits_enabled(max_entries: int = KNOWLEDGE_MAX_ENTRIES, ttl: float = KNOWLEDGE_TTL) -> bool:
+    return max_entries > 0 or ttl > 0
+
+def last_active(metadata: Dict) -> Optional[float]:
+    """Latest retrieval or teach time of an entry (None if neither was recorded)"""
+    times = [metadata[key] for key in ("last_used", "last_taught") if metadata.get(key) is not None]
+    return max(times) if times else None
+
+def find_evictions(backend: VectorBackend, max_entries: int, ttl: float,
+                   now: Optional[float] = None) -> Tuple[List[str], Dict]:
+    """
+    Entries to evict: expired ones, then the least recently active beyond max_entries
+
+    Args:
+        backend: Vector backend to scan (metadata only, page by page)
+        max_entries: Entries to keep at most (0 = unlimited)
+        ttl: Seconds of inactivity before an entry expires (0 = never)
+        now: Reference time (defaults to the current time)
+
+    Returns:
+        (ids to evict, counts by reason)
+    """
+    now = time.time() if now is None else now
+    ids: List[str] = []
+    active: List[float] = []
+    hits: List[int] = []
+    cursor = None
+    while True:
+        page, cursor = backend.page(limit=KNOWLEDGE_PAGE_MAX, cursor=cursor)
+        for doc_id, metadata in zip(page["ids"], page["metadatas"]):
+            metadata = metadata or {}
+            ids.append(doc_id)
+            seen = last_active(metadata)
+            active.append(-1.0 if seen is None else float(seen))
+            hits.append(int(metadata.get("retrieval_hits", 0)))
+        if cursor is None:
+            break
+
+    active_times = np.asarray(active, dtype=np.float64)
+    retrievals = np.asarray(hits, dtype=np.int64)
+    if ttl > 0:
+        evict = (active_times >= 0) & (active_times < now - ttl)
+    else:
+        evict = np.zeros(len(ids), dtype=bool)
+    expired = int(evict.sum())
+
+    over_capacity = max(0, len(ids) - expired - max_entries) if max_entries > 0 else 0
+    if over_capacity:
+        candidates = np.flatnonzero(~evict)
+        # Least recently active first; fewer retrievals first among ties
+        coldest = candidates[np.lexsort((retrievals[candidates], active_times[candidates]))[:over_capacity]]
+        evict[coldest] = True
+
+    return [ids[i] for i in np.flatnonzero(evict)], {"expired": expired, "over_capacity": over_capacity}
+
+def measure_query_latency(backend: VectorBackend, probes: List[np.ndarray]) -> Optional[float]:
+    """Median search latency in milliseconds over the probe embeddings (None without probes)"""
+    if not probes:
+        return None
+    timings = []
+    for _ in range(LATENCY_ROUNDS):
+        for probe in probes:
+            started = time.perf_counter()
+            backend.query(probe, n_results=MAX_RETRIEVED_DOCS)
+            timings.append(time.perf_counter() - started)
+    return round(float(np.median(timings)) * 1000.0, 3)
+
+def compact_knowledge(store: KnowledgeStore, max_entries: int = KNOWLEDGE_MAX_ENTRIES,
+                      ttl: float = KNOWLEDGE_TTL, dry_run: bool = False,
+                      reclaim: bool = False) -> Dict:
+    """
+    Evict expired and surplus entries and reclaim their space
+
+    Args:
+        store: Knowledge store to compact
+        max_entries: Entries to keep at most (0 = unlimited)
+        ttl: Seconds of inactivity before an entry expires (0 = never)
+        dry_run: Only count what would be evicted
+        reclaim: Compact the backend even when nothing was evicted (e.g. after deletes)
+
+    Returns:
+        Report with entry counts, storage bytes and search latency before and after
+    """
+    started = time.monotonic()
+    backend = store.backend
+    store.usage.flush()  # Recent retrievals in this process count as activity
+
+    sample = backend.get(limit=LATENCY_PROBES, include_embeddings=True)
+    probes = [np.asarray(embedding, dtype=np.float32) for embedding in sample.get("embeddings") or []]
+    report = {
+        "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "dry_run": dry_run,
+        "entries_before": backend.count(),
+        "bytes_before": backend.storage_bytes(),
+        "query_p50_ms_before": measure_query_latency(backend, probes)
+    }
+
+    evict, reasons = find_evictions(backend, max_entries, ttl)
+    report.update(reasons)
+    report["evicted"] = len(evict)
+    if not dry_run:
+        for start in range(0, len(evict), DELETE_CHUNK):
+            backend.delete(evict[start:start + DELETE_CHUNK])
+        if evict or reclaim:
+            report["backend"] = backend.compact()
+
+    report.update({
+        "entries_after": backend.count(),
+        "bytes_after": backend.storage_bytes(),
+        "query_p50_ms_after": measure_query_latency(backend, probes),
+        "seconds": round(time.monotonic() - started, 3)
+    })
+    logger.info(
+        f"Knowledge compaction{' (dry run)' if dry_run else ''}: {report['evicted']} evicted "
+        f"({report['expired']} expired, {report['over_capacity']} over capacity); "
+        f"entries {report['entries_before']} -> {report['entries_after']}, "
+        f"bytes {report['bytes_before']} -> {report['bytes_after']}, "
+        f"query p50 {report['query_p50_ms_before']} -> {report['query_p50_ms_after']} ms"
+    )
+    return report
+
+class KnowledgeCompactor:
+    """Runs compact_knowledge every KNOWLEDGE_COMPACT_INTERVAL seconds on a background thread"""
+
+    def __init__(self, store: KnowledgeStore, interval: float = KNOWLEDGE_COMPACT_INTERVAL,
+                 max_entries: int = KNOWLEDGE_MAX_ENTRIES, ttl: float = KNOWLEDGE_TTL):
+        self.store = store
+        self.interval = interval
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.runs = 0
+        self.last_report: Optional[Dict] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="knowledge-compaction", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(
+            f"Knowledge compaction every {self.interval:.0f}s "
+            f"(max entries {self.max_entries or 'unlimited'}, TTL {self.ttl or 'none'})"
+        )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.last_report = compact_knowledge(self.store, self.max_entries, self.ttl)
+                self.runs += 1
+            except Exception as e:
+                logger.error(f"Knowledge compaction failed: {e}")
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": True,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "runs": self.runs,
+            "last_run": self.last_report
+        }
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Evict expired and surplus knowledge and compact the store")
+    parser.add_argument("--max-entries", type=int, default=KNOWLEDGE_MAX_ENTRIES, help="Entries to keep (0 = unlimited)")
+    parser.add_argument("--ttl", type=float, default=KNOWLEDGE_TTL, help="Seconds of inactivity before expiry (0 = never)")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be evicted without changing anything")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, LOG_LEVEL),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    compact_knowledge(KnowledgeStore(), max(0, args.max_entries), max(0.0, args.ttl),
+                      dry_run=args.dry_run, reclaim=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,7 @@ from pathlib import Path
 
 # Base directories
 BASE_DIR = Path(__file__).parent.parent
-DATA_DIR = BASE_DIR / "data"
+DATA_DIR = Path(os.getenv("DATA_DIR", str(BASE_DIR / "data")))  # Models, knowledge store, WAL
 MODEL_CACHE_DIR = DATA_DIR / "models"
 KNOWLEDGE_DB_DIR = DATA_DIR / "chromadb"
 
@@ -20,16 +20,127 @@ MODEL_NAME = "gpt2"  # Small, fast model (124M params, ~500MB) perfect for simpl
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 QUANTIZATION_BITS = 4  # 4-bit quantization for memory efficiency
 
+# Inference Backend for MODEL_NAME:
+#   bnb-4bit   - bitsandbytes 4-bit (GPU)
+#   torch-fp32 - plain PyTorch
+#   torch-int8 - PyTorch dynamic int8 quantization of the Linear layers (CPU)
+#   onnx       - ONNX Runtime with KV cache (needs optimum[onnxruntime])
+#   auto       - bnb-4bit when CUDA is available, torch-int8 otherwise
+INFERENCE_BACKENDS = ["bnb-4bit", "torch-fp32", "torch-int8", "onnx"]
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "auto")
+MODEL_SNAPSHOT = os.getenv("MODEL_SNAPSHOT", "0") == "1"  # Save/reuse the loaded torch-fp32/torch-int8 model
+MODEL_SNAPSHOT_DIR = MODEL_CACHE_DIR / "snapshots"
+
+# Speculative (Assisted) Decoding
+SPECULATIVE_DRAFT_MODEL = os.getenv("SPECULATIVE_DRAFT_MODEL", "")  # e.g. "distilgpt2"; empty disables
+SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "5"))  # Tokens the draft proposes per verification
+SPECULATIVE_BASELINE_EVERY = 20  # Every Nth single-prompt generation skips the draft to measure the speedup
+
+# Embedding Cache (repeated queries skip the encoder)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))  # 0 disables the cache
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "0"))  # Seconds, 0 = no expiry
+
+# Embedding backend and cross-request batching
+EMBEDDING_BACKENDS = ["torch-fp32", "torch-int8", "onnx"]
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch-fp32")
+EMBEDDING_MIN_COSINE = 0.99  # torch-int8/onnx vectors must match fp32 this closely at load time, else fp32 is used
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))  # 1 disables cross-request batching
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "2"))  # How long a query waits for company
+EMBEDDING_BATCH_TIMEOUT = float(os.getenv("EMBEDDING_BATCH_TIMEOUT", "30"))  # Seconds to wait for a batch before encoding directly
+
 # Generation Parameters
 MAX_NEW_TOKENS = 50  # Very short responses for speed (2-5 seconds)
 TEMPERATURE = 0.7
 TOP_P = 0.9
 TOP_K = 50
+MAX_RESPONSE_CHARS = 60  # Responses are cut to the first sentence or this many characters
+STOP_STRINGS_MAX = 8  # Extra stop strings per chat request
+STOP_STRING_MAX_CHARS = 32
+STREAM_TOKEN_TIMEOUT = float(os.getenv("STREAM_TOKEN_TIMEOUT", "60"))  # Seconds to wait for the next streamed token
+
+# Dynamic Batching (concurrent prompts share one generate call)
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))  # 1 disables batching
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "20"))  # How long the first request waits for company
+
+# Offline Batch Chat (POST /chat/batch and python -m app.chat_batch)
+CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "10000"))  # Messages per /chat/batch request
+CHAT_BATCH_CHUNK = int(os.getenv("CHAT_BATCH_CHUNK", "512"))  # Messages embedded and searched together
+CHAT_BATCH_GENERATE_SIZE = int(os.getenv("CHAT_BATCH_GENERATE_SIZE", "16"))  # Length-sorted prompts per padded generate call
+
+# Admission Control (blocking inference runs on a bounded pool, off the event loop)
+INFERENCE_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", str(BATCH_MAX_SIZE)))  # Requests processed at once
+INFERENCE_QUEUE_DEPTH = int(os.getenv("INFERENCE_QUEUE_DEPTH", "32"))  # Requests waiting beyond that; more get 429
+
+# Vector Backend ("chromadb", or "numpy" for an in-process index over a memory-mapped matrix)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chromadb")
+NUMPY_INDEX_DIR = DATA_DIR / "numpy_index"
+NUMPY_INDEX_DTYPE = os.getenv("NUMPY_INDEX_DTYPE", "float32")  # float16 halves memory; fixed when the index is created
+# "int8" or "pq": search compact codes, then re-rank a shortlist with the full vectors (read from disk); fixed when the index is created
+NUMPY_INDEX_QUANTIZATION = os.getenv("NUMPY_INDEX_QUANTIZATION", "none")
+NUMPY_PQ_SUBVECTORS = int(os.getenv("NUMPY_PQ_SUBVECTORS", "48"))  # PQ code bytes per vector; must divide the embedding dimension
+QUANTIZATION_TRAIN_ROWS = int(os.getenv("QUANTIZATION_TRAIN_ROWS", "4096"))  # Vectors stored before codes are trained (search is exact until then)
+QUANTIZATION_RERANK = int(os.getenv("QUANTIZATION_RERANK", "10"))  # Shortlist of n_results x this rows re-ranked exactly
 
 # RAG Configuration
 RAG_SIMILARITY_THRESHOLD = 0.7
 MAX_RETRIEVED_DOCS = 3
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "256"))  # Knowledge tokens packed into a prompt
+CONTEXT_MIN_CHUNK_TOKENS = 16  # A chunk cut to fit the budget must keep at least this many tokens
+MAX_PROMPT_TOKENS = 512  # Context plus user message; bounds prefill cost (also the token ids stored per document)
 KNOWLEDGE_COLLECTION_NAME = "user_knowledge"
+MAX_KNOWLEDGE_CHARS = 5000  # Longer documents are chunked before storage
+KNOWLEDGE_PAGE_SIZE = 100  # Default page size for GET /knowledge
+KNOWLEDGE_PAGE_MAX = 1000
+TEACH_BATCH_MAX_ITEMS = int(os.getenv("TEACH_BATCH_MAX_ITEMS", "1000"))  # Documents per /teach/batch request
+
+# Knowledge Deduplication (a re-taught fact bumps the existing entry's hit_count instead of adding a copy)
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_SIMILARITY = float(os.getenv("DEDUP_SIMILARITY", "0.97"))  # Cosine similarity for a near-duplicate
+
+# Knowledge Store Limits (retrieval usage is tracked per entry; a background job evicts the coldest)
+KNOWLEDGE_MAX_ENTRIES = int(os.getenv("KNOWLEDGE_MAX_ENTRIES", "0"))  # 0 = unlimited
+KNOWLEDGE_TTL = float(os.getenv("KNOWLEDGE_TTL", "0"))  # Seconds since last retrieved or taught, 0 = no expiry
+KNOWLEDGE_COMPACT_INTERVAL = float(os.getenv("KNOWLEDGE_COMPACT_INTERVAL", "3600"))  # Seconds between eviction runs
+KNOWLEDGE_USAGE_FLUSH_INTERVAL = float(os.getenv("KNOWLEDGE_USAGE_FLUSH_INTERVAL", "30"))  # Seconds between usage writes, 0 = no tracking
+
+# Knowledge Snapshots (portable float16 exports, imported without re-embedding)
+SNAPSHOT_DIR = DATA_DIR / "snapshots"  # Exported by and loaded from the /admin/snapshots endpoints
+SNAPSHOT_IMPORT_CHUNK = 5000  # Rows per bulk add when importing
+KNOWLEDGE_STORE_POINTER = DATA_DIR / "knowledge_store.json"  # Active store directory per backend, switched by imports
+
+# Knowledge Ingestion (teach requests go through a write-ahead log and one batching worker)
+INGEST_WAL_PATH = Path(os.getenv("INGEST_WAL_PATH", str(DATA_DIR / "ingest.wal")))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))  # Items per encode/add call
+INGEST_FLUSH_INTERVAL_MS = float(os.getenv("INGEST_FLUSH_INTERVAL_MS", "200"))  # Wait to fill a batch
+INGEST_WAL_FSYNC = os.getenv("INGEST_WAL_FSYNC", "1") == "1"  # fsync before acknowledging a teach
+INGEST_WAL_COMPACT_BYTES = 1024 * 1024  # Truncate the WAL beyond this size once fully flushed
+INGEST_JOB_HISTORY = 10000  # Job statuses kept for lookups
+INGEST_MAX_RETRIES = 3  # Immediate attempts per batch before it is deferred
+INGEST_RETRY_MAX_DELAY = float(os.getenv("INGEST_RETRY_MAX_DELAY", "300"))  # Cap on the backoff before a deferred batch is retried
+INGEST_CLI_BATCH_SIZE = 256  # Chunks per batch for the bulk ingest CLI (python -m app.ingest)
+
+# Response Cache (near-duplicate questions reuse an earlier answer)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))  # 0 disables the cache
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # Seconds, 0 = no expiry
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))  # Cosine similarity for a hit
+
+# Conversation Sessions (keyed by conversation_id)
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "16"))  # Turns kept per conversation
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))  # Idle seconds before a session is dropped, 0 = never
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024)))  # All sessions incl. KV caches; LRU evicted beyond
+SESSION_KV_CACHE = os.getenv("SESSION_KV_CACHE", "0") == "1"  # Keep past_key_values so follow-ups only prefill new tokens
+SESSION_MAX_CONTEXT_TOKENS = 512  # Conversation prompt limit; older turns are dropped beyond it
+
+# Pre-fork Server (python -m app.serve)
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "0"))  # 0 = one worker per CPU core
+KNOWLEDGE_WRITER_SOCKET = Path(os.getenv("KNOWLEDGE_WRITER_SOCKET", str(DATA_DIR / "knowledge-writer.sock")))
+KNOWLEDGE_REFRESH_INTERVAL = 1.0  # Seconds between reloads of a worker's chromadb view after other workers write
+
+# Request profiling (X-Profile-Token header on /chat, downloads under /admin/profiles)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # Empty disables profiling and the admin endpoints
+PROFILE_DIR = DATA_DIR / "profiles"
+PROFILE_MAX_ARTIFACTS = 50  # Oldest profiles are deleted beyond this
+PROFILE_TORCH = os.getenv("PROFILE_TORCH", "1") == "1"  # Include a torch.profiler trace of the model ops
 
 # API Configuration
 API_HOST = os.getenv("API_HOST", "0.0.0.0")
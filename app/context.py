@@ -0,0 +1,142 @@
+"""
+Prompt context assembly
+Packs the best retrieved knowledge into a fixed token budget, using token ids
+computed once when the knowledge was stored
+"""
+import base64
+import logging
+import threading
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from app.config import (
+    MODEL_NAME, MODEL_CACHE_DIR, CONTEXT_TOKEN_BUDGET, CONTEXT_MIN_CHUNK_TOKENS, MAX_PROMPT_TOKENS
+)
+
+logger = logging.getLogger(__name__)
+
+# Knowledge metadata keys written by token_metadata (internal, not shown to API clients)
+TOKEN_METADATA_KEYS = ("token_count", "token_ids", "tokenizer")
+
+CHUNK_SEPARATOR = "\n"  # Between knowledge chunks
+CONTEXT_SEPARATOR = "\n\n"  # Between the context and the user message
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """The chat model's tokenizer, loaded once per process (without the model weights)"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from transformers import AutoTokenizer
+
+                _tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, cache_dir=str(MODEL_CACHE_DIR))
+    return _tokenizer
+
+def use_tokenizer(tokenizer):
+    """Replace the shared tokenizer (benchmark stubs)"""
+    global _tokenizer
+    _tokenizer = tokenizer
+    _text_token_ids.cache_clear()
+    separator_ids.cache_clear()
+
+def encode_texts(texts: Iterable[str]) -> List[List[int]]:
+    """Token ids of each text, without special tokens (one tokenizer call for all of them)"""
+    texts = list(texts)
+    if not texts:
+        return []
+    return get_tokenizer()(texts, add_special_tokens=False)["input_ids"]
+
+def pack_token_ids(ids: Sequence[int]) -> str:
+    """Compact string form of token ids (metadata values must be scalars)"""
+    return base64.b64encode(np.asarray(ids, dtype="<i4").tobytes()).decode("ascii")
+
+def unpack_token_ids(data: str) -> List[int]:
+    return np.frombuffer(base64.b64decode(data), dtype="<i4").tolist()
+
+def token_metadata(texts: Sequence[str]) -> List[Dict]:
+    """
+    Metadata fields recording each document's token count and leading token ids
+
+    Only the first MAX_PROMPT_TOKENS ids are kept: no prompt can use more of a document.
+    """
+    return [
+        {"token_count": len(ids), "token_ids": pack_token_ids(ids[:MAX_PROMPT_TOKENS]), "tokenizer": MODEL_NAME}
+        for ids in encode_texts(texts)
+    ]
+
+def strip_token_metadata(metadata: Dict) -> Dict:
+    """Metadata without the internal token fields"""
+    return {key: value for key, value in metadata.items() if key not in TOKEN_METADATA_KEYS}
+
+@lru_cache(maxsize=4096)
+def _text_token_ids(text: str) -> Tuple[int, ...]:
+    return tuple(encode_texts([text])[0][:MAX_PROMPT_TOKENS])
+
+@lru_cache(maxsize=8)
+def separator_ids(separator: str) -> Tuple[int, ...]:
+    return tuple(encode_texts([separator])[0])
+
+def knowledge_token_ids(text: str, metadata: Optional[Dict] = None) -> List[int]:
+    """
+    Token ids of a stored document
+
+    Read from the metadata written at store time; documents stored before that (or
+    with another chat model) are tokenized now, with a small cache.
+    """
+    metadata = metadata or {}
+    if metadata.get("tokenizer") == MODEL_NAME and metadata.get("token_ids"):
+        return unpack_token_ids(metadata["token_ids"])
+    return list(_text_token_ids(text))
+
+def pack_context(items: List[Dict], budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[List[int], int]:
+    """
+    Fill a token budget with the highest-scoring knowledge chunks
+
+    Chunks are added whole in score order while they fit. The first one that does
+    not fit is cut to the remaining budget (if at least CONTEXT_MIN_CHUNK_TOKENS
+    remain) and packing stops there, so the context never exceeds the budget.
+
+    Args:
+        items: Retrieved knowledge with 'text', 'score' and optionally 'token_ids'
+        budget: Maximum context tokens
+
+    Returns:
+        (context token ids, number of chunks used)
+    """
+    separator = list(separator_ids(CHUNK_SEPARATOR))
+    ids: List[int] = []
+    used = 0
+    for item in sorted(items, key=lambda item: item.get("score", 0.0), reverse=True):
+        chunk = item.get("token_ids")
+        if chunk is None:
+            chunk = knowledge_token_ids(item["text"])
+        gap = separator if ids else []
+        room = budget - len(ids) - len(gap)
+        if len(chunk) <= room:
+            ids += gap + list(chunk)
+            used += 1
+            continue
+        if room >= CONTEXT_MIN_CHUNK_TOKENS:
+            ids += gap + list(chunk[:room])
+            used += 1
+        break
+    return ids, used
+
+def build_prompt_ids(message_ids: Sequence[int], context_ids: Sequence[int] = ()) -> List[int]:
+    """
+    Model prompt token ids: the packed context, a blank line, then the user message
+
+    The result never exceeds MAX_PROMPT_TOKENS: the context is cut to
+    CONTEXT_TOKEN_BUDGET and a long message keeps its last tokens (the ones the
+    model continues from).
+    """
+    if not context_ids:
+        return list(message_ids[-MAX_PROMPT_TOKENS:])
+    prefix = list(context_ids[:CONTEXT_TOKEN_BUDGET]) + list(separator_ids(CONTEXT_SEPARATOR))
+    room = MAX_PROMPT_TOKENS - len(prefix)
+    if room <= 0:
+        return prefix[:MAX_PROMPT_TOKENS]
+    return prefix + list(message_ids[-room:])
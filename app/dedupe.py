@@ -0,0 +1,148 @@
+"""
+Knowledge deduplication CLI
+One-off cleanup of a collection filled before teach-time deduplication: exact
+and near-duplicate entries are merged into the first stored copy, whose
+hit_count and last_taught absorb theirs, and the copies are deleted
+
+Usage:
+    python -m app.dedupe --dry-run
+    python -m app.dedupe --similarity 0.98
+
+Entries are scanned in storage order. An entry is a duplicate when its content
+hash matches an earlier entry's, or when one of its nearest neighbours is an
+earlier entry within --similarity (it is then merged into that entry's keeper).
+Entries that are kept get a content_hash and hit_count if they lack them, so
+later teaches of the same text are caught by the hash lookup.
+Run it while the API server is stopped - both write to the same database.
+"""
+import argparse
+import logging
+import sys
+import time
+from typing import Dict, List, Optional
+import numpy as np
+from app.config import LOG_LEVEL, DEDUP_SIMILARITY, KNOWLEDGE_PAGE_SIZE
+from app.knowledge import KnowledgeStore, content_hash, duplicate_max_distance, merge_hits
+
+logger = logging.getLogger(__name__)
+
+NEIGHBOURS = 8  # Nearest entries checked per entry for near-duplicates
+WRITE_CHUNK = 500  # Ids per metadata update / delete call
+
+def dedupe(similarity: float = DEDUP_SIMILARITY, exact_only: bool = False,
+           dry_run: bool = False, page_size: int = KNOWLEDGE_PAGE_SIZE) -> Dict:
+    """
+    Merge duplicate knowledge entries
+
+    Args:
+        similarity: Cosine similarity at which two entries are near-duplicates
+        exact_only: Only merge entries with identical text (no embedding search)
+        dry_run: Report what would be merged without writing
+        page_size: Entries read per page
+
+    Returns:
+        Counters: scanned, kept, exact and near duplicates, entries that absorbed duplicates
+    """
+    store = KnowledgeStore()
+    backend = store.backend
+    max_distance = duplicate_max_distance(similarity)
+
+    keeper_by_hash: Dict[str, str] = {}
+    owner: Dict[str, str] = {}  # Every scanned id -> id of the entry it is kept as or merged into
+    hits: Dict[str, int] = {}  # Keeper id -> hits absorbed from its duplicates
+    last_taught: Dict[str, float] = {}  # Keeper id -> latest last_taught among its duplicates
+    duplicates: List[str] = []
+    counts = {"scanned": 0, "kept": 0, "exact": 0, "near": 0}
+    started = time.monotonic()
+
+    cursor: Optional[str] = None
+    pages = 0
+    while True:
+        page, cursor = backend.page(limit=page_size, cursor=cursor)
+        if page["ids"]:
+            nearest = None
+            if not exact_only:
+                fetched = backend.get(ids=page["ids"], include_embeddings=True)
+                by_id = dict(zip(fetched["ids"], fetched["embeddings"]))
+                nearest = backend.query(np.asarray([by_id[doc_id] for doc_id in page["ids"]]), n_results=NEIGHBOURS + 1)
+
+            backfill_ids, backfill_metadatas = [], []
+            for row, (doc_id, document, metadata) in enumerate(zip(page["ids"], page["documents"], page["metadatas"])):
+                metadata = metadata or {}
+                counts["scanned"] += 1
+                digest = metadata.get("content_hash") or content_hash(document)
+
+                keeper = keeper_by_hash.get(digest)
+                kind = "exact"
+                if keeper is None and nearest is not None:
+                    kind = "near"
+                    for neighbour, distance in zip(nearest["ids"][row], nearest["distances"][row]):
+                        if distance > max_distance:
+                            break
+                        if neighbour != doc_id and neighbour in owner:
+                            keeper = owner[neighbour]
+                            break
+
+                if keeper is None:
+                    keeper_by_hash[digest] = owner[doc_id] = doc_id
+                    counts["kept"] += 1
+                    if "content_hash" not in metadata or "hit_count" not in metadata:
+                        backfill_ids.append(doc_id)
+                        backfill_metadatas.append({"content_hash": digest, "hit_count": metadata.get("hit_count", 1)})
+                    continue
+
+                owner[doc_id] = keeper
+                counts[kind] += 1
+                duplicates.append(doc_id)
+                hits[keeper] = hits.get(keeper, 0) + int(metadata.get("hit_count", 1))
+                if metadata.get("last_taught") is not None:
+                    last_taught[keeper] = max(last_taught.get(keeper, 0.0), metadata["last_taught"])
+
+            # Adding fields does not move entries, so this is safe mid-scan (deletes wait for the end)
+            if backfill_ids and not dry_run:
+                backend.patch_metadatas(backfill_ids, backfill_metadatas)
+
+        pages += 1
+        if pages % 50 == 0:
+            logger.info(f"{counts['scanned']} entries scanned, {len(duplicates)} duplicates found")
+        if cursor is None:
+            break
+
+    counts["merged_into"] = len(hits)
+    if not dry_run:
+        keepers = list(hits)
+        for start in range(0, len(keepers), WRITE_CHUNK):
+            stored = backend.get(ids=keepers[start:start + WRITE_CHUNK])
+            backend.patch_metadatas(stored["ids"], [
+                merge_hits(metadata, hits[doc_id], last_taught.get(doc_id))
+                for doc_id, metadata in zip(stored["ids"], stored["metadatas"])
+            ])
+        for start in range(0, len(duplicates), WRITE_CHUNK):
+            backend.delete(duplicates[start:start + WRITE_CHUNK])
+
+    logger.info(
+        f"{'Would merge' if dry_run else 'Merged'} {len(duplicates)} duplicates "
+        f"({counts['exact']} exact, {counts['near']} near) into {counts['merged_into']} entries; "
+        f"{counts['kept']} of {counts['scanned']} entries kept ({time.monotonic() - started:.1f}s)"
+    )
+    return counts
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Merge duplicate entries of the knowledge store")
+    parser.add_argument("--similarity", type=float, default=DEDUP_SIMILARITY,
+                        help="Cosine similarity for near-duplicates")
+    parser.add_argument("--exact-only", action="store_true", help="Only merge entries with identical text")
+    parser.add_argument("--dry-run", action="store_true", help="Report duplicates without changing anything")
+    parser.add_argument("--page-size", type=int, default=KNOWLEDGE_PAGE_SIZE, help="Entries read per page")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, LOG_LEVEL),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    dedupe(args.similarity, exact_only=args.exact_only, dry_run=args.dry_run, page_size=max(1, args.page_size))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,143 @@
 """
 Embedding model for RAG (Retrieval Augmented Generation)
 Uses sentence-transformers for generating embeddings
+Backends: fp32 or dynamic int8 PyTorch, ONNX Runtime
 """
 from sentence_transformers import SentenceTransformer
+from sentence_transformers import models as st_models
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import copy
 import logging
-from app.config import EMBEDDING_MODEL, MODEL_CACHE_DIR
+import threading
+import time
+from typing import Dict, List, Optional
+import numpy as np
+import torch
+from app.model import quantize_dynamic_int8
+from app.scheduler import MicroBatcher
+from app.profiling import is_profiling
+from app.config import (
+    EMBEDDING_MODEL, MODEL_CACHE_DIR, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL,
+    EMBEDDING_BACKEND, EMBEDDING_BACKENDS, EMBEDDING_MIN_COSINE,
+    EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_MAX_WAIT_MS, EMBEDDING_BATCH_TIMEOUT
+)
 
 logger = logging.getLogger(__name__)
 
+# Texts a quantized/exported encoder must reproduce before it replaces the fp32 one
+VERIFY_TEXTS = [
+    "How does the king move in chess?",
+    "hello",
+    "In chess, the king can move one square in any direction. The queen can move any number of squares "
+    "horizontally, vertically, or diagonally. The rook moves horizontally or vertically any number of squares.",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "What time does the library open on weekends? I need to return two books before Monday."
+]
+
+def min_cosine_similarity(candidate: np.ndarray, reference: np.ndarray) -> float:
+    """Smallest row-wise cosine similarity between two sets of embeddings"""
+    candidate = np.asarray(candidate, dtype=np.float32)
+    reference = np.asarray(reference, dtype=np.float32)
+    dots = np.sum(candidate * reference, axis=1)
+    norms = np.linalg.norm(candidate, axis=1) * np.linalg.norm(reference, axis=1)
+    return float(np.min(dots / np.maximum(norms, 1e-12)))
+
+class OnnxEncoder:
+    """ONNX Runtime export of a sentence-transformers model with the same encode() interface"""
+
+    def __init__(self, model, tokenizer, max_seq_length: int, normalize: bool):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.normalize = normalize
+
+    def encode(self, texts, show_progress_bar: bool = False, batch_size: int = 32, **kwargs) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="pt"
+            )
+            with torch.no_grad():
+                hidden = self.model(**inputs).last_hidden_state
+            # Mean pooling over real tokens, as the sentence-transformers Pooling module does
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            if self.normalize:
+                pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+            vectors.append(pooled.numpy().astype(np.float32))
+        return np.concatenate(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+class EmbeddingCache:
+    """Thread-safe bounded LRU cache of embedding vectors keyed on normalized text"""
+
+    def __init__(self, max_size: int, ttl: float = 0):
+        self.max_size = max_size
+        self.ttl = ttl  # Seconds; 0 keeps entries until evicted by size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Cache key: case and whitespace are irrelevant to the (uncased) MiniLM encoder"""
+        return " ".join(text.split()).lower()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the cached vector or None (counts a hit or a miss)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                vector, stored_at = entry
+                if not self.ttl or time.monotonic() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, vector: np.ndarray):
+        """Store a vector, evicting the least recently used entries beyond max_size"""
+        vector = np.array(vector, copy=True)
+        vector.setflags(write=False)  # Shared between callers
+        with self._lock:
+            self._entries[key] = (vector, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """Hit/miss counters for sizing the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
 class EmbeddingModel:
     """Lightweight embedding model for knowledge retrieval"""
 
     _instance = None
     _model = None
+    backend = None
+    verified_similarity = None  # Min cosine similarity to fp32 measured at load (quantized/ONNX backends)
 
     def __new__(cls):
         if cls._instance is None:
@@ -20,29 +145,110 @@ class EmbeddingModel:
         return cls._instance
 
     def __init__(self):
+        if not hasattr(self, 'cache'):
+            self.cache = EmbeddingCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL) if EMBEDDING_CACHE_SIZE > 0 else None
+        if not hasattr(self, 'batcher'):
+            # Short encode calls from concurrent requests share one forward pass
+            self.batcher = MicroBatcher(
+                self._encode_batch,
+                max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+                max_wait_ms=EMBEDDING_BATCH_MAX_WAIT_MS,
+                name="embedding-batcher"
+            ) if EMBEDDING_BATCH_MAX_SIZE > 1 else None
         if self._model is None:
             self.load_model()
 
     def load_model(self):
-        """Load the embedding model"""
+        """
+        Load the embedding model for the configured backend
+
+        torch-int8 and onnx encoders are checked against the fp32 model on VERIFY_TEXTS;
+        if any vector's cosine similarity falls below EMBEDDING_MIN_COSINE the fp32
+        model is used instead, so stored and query vectors stay comparable.
+        """
         try:
-            logger.info(f"Loading embedding model: {EMBEDDING_MODEL}")
+            self.backend = EMBEDDING_BACKEND
+            if self.backend not in EMBEDDING_BACKENDS:
+                raise ValueError(f"Unknown embedding backend: {self.backend} (expected one of {', '.join(EMBEDDING_BACKENDS)})")
+            logger.info(f"Loading embedding model: {EMBEDDING_MODEL} (backend: {self.backend})")
             cache_dir = str(MODEL_CACHE_DIR / "embeddings")
-            self._model = SentenceTransformer(
+            reference = SentenceTransformer(
                 EMBEDDING_MODEL,
                 cache_folder=cache_dir
             )
+
+            if self.backend == "torch-fp32":
+                self._model = reference
+            else:
+                candidate = self._load_int8(reference) if self.backend == "torch-int8" else self._load_onnx(reference, cache_dir)
+                self.verified_similarity = min_cosine_similarity(
+                    candidate.encode(VERIFY_TEXTS, show_progress_bar=False),
+                    reference.encode(VERIFY_TEXTS, show_progress_bar=False)
+                )
+                if self.verified_similarity < EMBEDDING_MIN_COSINE:
+                    logger.error(
+                        f"Embedding backend {self.backend} drifts from fp32 (min cosine {self.verified_similarity:.4f} "
+                        f"< {EMBEDDING_MIN_COSINE}), using torch-fp32"
+                    )
+                    self.backend = "torch-fp32"
+                    self._model = reference
+                else:
+                    logger.info(f"Embedding backend {self.backend} verified (min cosine {self.verified_similarity:.4f})")
+                    self._model = candidate
             logger.info("Embedding model loaded successfully")
         except Exception as e:
             logger.error(f"Error loading embedding model: {e}")
             raise
 
-    def encode(self, texts):
+    def _load_int8(self, reference: SentenceTransformer) -> SentenceTransformer:
+        """Dynamic int8 copy of the fp32 model (the reference is kept for verification)"""
+        return quantize_dynamic_int8(copy.deepcopy(reference))
+
+    def _load_onnx(self, reference: SentenceTransformer, cache_dir: str) -> OnnxEncoder:
+        """ONNX Runtime encoder, exported once and reused from the model cache"""
+        try:
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+        except ImportError:
+            raise RuntimeError("EMBEDDING_BACKEND=onnx requires optimum[onnxruntime] (see requirements.txt)")
+
+        pooling = next(module for module in reference if isinstance(module, st_models.Pooling))
+        if not pooling.pooling_mode_mean_tokens:
+            raise RuntimeError(f"EMBEDDING_BACKEND=onnx supports mean pooling only ({EMBEDDING_MODEL} uses another mode)")
+        normalize = any(isinstance(module, st_models.Normalize) for module in reference)
+
+        onnx_dir = MODEL_CACHE_DIR / "onnx" / EMBEDDING_MODEL.replace("/", "--")
+        if (onnx_dir / "config.json").exists():
+            model = ORTModelForFeatureExtraction.from_pretrained(str(onnx_dir))
+        else:
+            logger.info("Exporting embedding model to ONNX (first run only)...")
+            model = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL, export=True, cache_dir=cache_dir)
+            model.save_pretrained(str(onnx_dir))
+        return OnnxEncoder(model, reference.tokenizer, reference.max_seq_length, normalize)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Run the encoder; calls smaller than a batch are merged with concurrent ones"""
+        if self.batcher is None or not texts or len(texts) >= self.batcher.max_batch_size or is_profiling():
+            return self._model.encode(texts, show_progress_bar=False)
+        futures = [self.batcher.submit(text) for text in texts]
+        deadline = time.monotonic() + EMBEDDING_BATCH_TIMEOUT
+        try:
+            return np.stack([future.result(timeout=max(0.0, deadline - time.monotonic())) for future in futures])
+        except FutureTimeoutError:
+            # A stalled batcher must not hang the request
+            logger.warning(f"Batched encode timed out after {EMBEDDING_BATCH_TIMEOUT}s, encoding directly")
+            return self._model.encode(texts, show_progress_bar=False)
+
+    def _encode_batch(self, key, texts: List[str]) -> List[np.ndarray]:
+        """Batch function: one forward pass for texts gathered from several callers"""
+        return list(self._model.encode(texts, show_progress_bar=False))
+
+    def encode(self, texts, use_cache: bool = True):
         """
         Generate embeddings for texts
 
         Args:
             texts: Single string or list of strings
+            use_cache: Look up and store vectors in the query cache (off for bulk documents)
 
         Returns:
             numpy array of embeddings
@@ -54,5 +260,36 @@ class EmbeddingModel:
         if isinstance(texts, str):
             texts = [texts]
 
-        return self._model.encode(texts, show_progress_bar=False)
+        if self.cache is None or not use_cache:
+            return self._encode(texts)
+
+        # Serve cached vectors and only encode the misses
+        keys = [EmbeddingCache.normalize(text) for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        if missing:
+            # Repeated texts within one batch are encoded once
+            to_encode = {}
+            for i in missing:
+                to_encode.setdefault(keys[i], texts[i])
+            encoded = dict(zip(to_encode, self._encode(list(to_encode.values()))))
+            for key, vector in encoded.items():
+                self.cache.put(key, vector)
+            for i in missing:
+                vectors[i] = encoded[keys[i]]
+
+        return np.stack(vectors)
+
+    def cache_stats(self) -> Dict:
+        """Embedding cache statistics"""
+        if self.cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.cache.stats()}
 
+    def batching_stats(self) -> Dict:
+        """Encoder backend and cross-request batching statistics"""
+        stats = {"backend": self.backend, "verified_similarity": self.verified_similarity}
+        if self.batcher is None:
+            return {**stats, "enabled": False}
+        return {**stats, "enabled": True, **self.batcher.stats()}
@@ -0,0 +1,162 @@
+"""
+Bounded executor for blocking inference work
+Keeps embedding, retrieval and generation off the asyncio event loop and
+rejects work early when the queue is full
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator
+from app.config import INFERENCE_CONCURRENCY, INFERENCE_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    """Raised when the inference queue cannot accept more work"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+class InferenceExecutor:
+    """Thread pool with a concurrency limit, a bounded queue and wait-time tracking"""
+
+    def __init__(self, max_concurrency: int = INFERENCE_CONCURRENCY,
+                 max_queue_depth: int = INFERENCE_QUEUE_DEPTH):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue_depth = max(0, max_queue_depth)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0  # Admitted requests (queued + running)
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_ewma = 0.0  # Seconds spent queued (exponential moving average)
+        self._wait_max = 0.0
+        self._service_ewma = 0.0  # Seconds spent running
+
+    def _admit(self):
+        """Reserve a slot or raise QueueFullError"""
+        with self._lock:
+            if self._pending >= self.max_concurrency + self.max_queue_depth:
+                self._rejected += 1
+                raise QueueFullError(self._retry_after())
+            self._pending += 1
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def _retry_after(self) -> int:
+        """Rough estimate of seconds until a slot frees up (lock held)"""
+        waves = self._pending / self.max_concurrency
+        return max(1, int(round(waves * (self._service_ewma or 1.0))))
+
+    def _start(self, enqueued_at: float) -> float:
+        """Record the queue wait of a task that is starting now"""
+        started = time.monotonic()
+        with self._lock:
+            wait = started - enqueued_at
+            self._wait_ewma = 0.9 * self._wait_ewma + 0.1 * wait if self._completed else wait
+            self._wait_max = max(self._wait_max, wait)
+            self._running += 1
+        return started
+
+    def _finish(self, started: float):
+        """Record the service time of a finished task"""
+        with self._lock:
+            service = time.monotonic() - started
+            self._service_ewma = 0.9 * self._service_ewma + 0.1 * service if self._completed else service
+            self._running -= 1
+            self._completed += 1
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Run a blocking callable on the pool
+
+        Raises:
+            QueueFullError: if concurrency + queue depth is exhausted
+        """
+        self._admit()
+        enqueued_at = time.monotonic()
+
+        def task():
+            # The slot is released here rather than by the awaiting coroutine, which
+            # may be cancelled (client disconnect) while this is still running
+            started = self._start(enqueued_at)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._finish(started)
+                self._release()
+
+        try:
+            future = self._pool.submit(task)
+        except BaseException:
+            self._release()
+            raise
+        # A task cancelled before it started never reaches its finally
+        future.add_done_callback(lambda f: self._release() if f.cancelled() else None)
+        return await asyncio.wrap_future(future)
+
+    async def iterate(self, iterator: Iterator) -> AsyncIterator:
+        """
+        Advance a blocking iterator on the pool, holding one admission slot for its lifetime
+
+        Admission happens on the first step, so callers that need to answer 429
+        should await the first item before committing to a response.
+
+        Raises:
+            QueueFullError: if concurrency + queue depth is exhausted
+        """
+        self._admit()
+        enqueued_at = time.monotonic()
+        started = None
+        done = object()
+
+        def first_step():
+            nonlocal started
+            started = self._start(enqueued_at)
+            return next(iterator, done)
+
+        def close(_=None):
+            if started is not None:
+                self._finish(started)
+            self._release()
+
+        step = None
+        try:
+            step = self._pool.submit(first_step)
+            item = await asyncio.wrap_future(step)
+            while item is not done:
+                yield item
+                step = self._pool.submit(next, iterator, done)
+                item = await asyncio.wrap_future(step)
+        finally:
+            if step is not None and not step.done():
+                # Cancelled mid-step: keep the slot until the pool thread is free again
+                step.add_done_callback(close)
+            else:
+                close()
+
+    def stats(self) -> Dict:
+        """Queue depth and wait time statistics"""
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue_depth": self.max_queue_depth,
+                "in_flight": self._pending,
+                "running": self._running,
+                "queued": max(0, self._pending - self._running),
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "avg_wait_ms": self._wait_ewma * 1000.0,
+                "max_wait_ms": self._wait_max * 1000.0,
+                "avg_service_ms": self._service_ewma * 1000.0
+            }
+
+    def shutdown(self):
+        """Stop accepting work and wait for running tasks"""
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,182 @@
+"""
+Bulk knowledge ingestion CLI
+Streams a JSONL or plain-text corpus into the knowledge store in large batches,
+checkpointing progress so an interrupted load can resume
+
+Usage:
+    python -m app.ingest corpus.jsonl
+    python -m app.ingest notes.txt --format text --topic chess
+
+JSONL lines are objects with a "knowledge" (or "text") field and an optional
+"topic". Text files hold one document per blank-line-separated block.
+Run it while the API server is stopped - both write to the same database.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+from app.config import LOG_LEVEL, INGEST_CLI_BATCH_SIZE
+from app.knowledge import KnowledgeStore, chunk_knowledge
+
+logger = logging.getLogger(__name__)
+
+def read_documents(path: Path, fmt: str, offset: int, default_topic: str) -> Iterator[Tuple[Dict, int]]:
+    """
+    Stream documents from a corpus file starting at a byte offset
+
+    Yields:
+        (document, offset just past it) pairs
+    """
+    with open(path, "rb") as corpus:
+        corpus.seek(offset)
+
+        if fmt == "jsonl":
+            for line in iter(corpus.readline, b""):
+                position = corpus.tell()
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping malformed line ending at byte {position}")
+                    continue
+                if isinstance(record, str):
+                    # A bare string line is the knowledge text itself
+                    record = {"knowledge": record}
+                elif not isinstance(record, dict):
+                    logger.warning(f"Skipping non-object line ending at byte {position}")
+                    continue
+                text = record.get("knowledge") or record.get("text") or ""
+                yield {"knowledge": text, "topic": record.get("topic") or default_topic}, position
+        else:
+            block: List[str] = []
+            for line in iter(corpus.readline, b""):
+                if line.strip():
+                    block.append(line.decode("utf-8", errors="replace"))
+                    continue
+                if block:
+                    yield {"knowledge": "".join(block), "topic": default_topic}, corpus.tell()
+                    block = []
+            if block:
+                yield {"knowledge": "".join(block), "topic": default_topic}, corpus.tell()
+
+def new_checkpoint(source: Path) -> Dict:
+    """Checkpoint for a load starting at the beginning of the source"""
+    return {"source": str(source), "offset": 0, "documents": 0, "chunks": 0, "stored": 0, "merged": 0, "rejected": 0}
+
+def load_checkpoint(checkpoint_path: Path, source: Path) -> Dict:
+    """Read the checkpoint for this source (or start from the beginning)"""
+    if not checkpoint_path.exists():
+        return new_checkpoint(source)
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("source") != str(source):
+        logger.warning("Checkpoint belongs to a different source file - starting from the beginning")
+        return new_checkpoint(source)
+    return checkpoint
+
+def save_checkpoint(checkpoint_path: Path, checkpoint: Dict):
+    """Atomically write the checkpoint"""
+    tmp_path = checkpoint_path.with_suffix(checkpoint_path.suffix + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+def ingest(path: Path, fmt: str, batch_size: int, checkpoint_path: Path,
+           resume: bool = True, default_topic: str = "") -> Dict:
+    """
+    Load a corpus into the knowledge store
+
+    Batches are flushed only at document boundaries, so the checkpoint offset
+    always points just past a fully stored document.
+
+    Returns:
+        Final checkpoint with counters
+    """
+    source = path.resolve()
+    checkpoint = load_checkpoint(checkpoint_path, source) if resume else new_checkpoint(source)
+    if checkpoint["offset"]:
+        logger.info(f"Resuming at byte {checkpoint['offset']} ({checkpoint['documents']} documents done)")
+
+    store = KnowledgeStore()
+    started = time.monotonic()
+    start_documents = checkpoint["documents"]
+    last_report = started
+    batch: List[Dict] = []
+    batch_documents = 0
+    batch_offset = checkpoint["offset"]
+
+    def flush():
+        nonlocal batch, batch_documents, last_report
+        if batch:
+            results = store.store_knowledge_batch(batch)
+            stored = sum(1 for result in results if result["status"] == "stored")
+            merged = sum(1 for result in results if result["status"] == "merged")
+            checkpoint["stored"] += stored
+            checkpoint["merged"] = checkpoint.get("merged", 0) + merged
+            checkpoint["rejected"] += len(results) - stored - merged
+            checkpoint["chunks"] += len(batch)
+        checkpoint["documents"] += batch_documents
+        checkpoint["offset"] = batch_offset
+        save_checkpoint(checkpoint_path, checkpoint)
+        batch, batch_documents = [], 0
+
+        now = time.monotonic()
+        if now - last_report >= 10:
+            last_report = now
+            rate = (checkpoint["documents"] - start_documents) / (now - started)
+            logger.info(f"{checkpoint['documents']} documents, {checkpoint['stored']} chunks stored ({rate:.1f} docs/sec)")
+
+    for document, offset in read_documents(path, fmt, checkpoint["offset"], default_topic):
+        for chunk in chunk_knowledge(document["knowledge"]):
+            batch.append({"knowledge": chunk, "topic": document["topic"]})
+        batch_documents += 1
+        batch_offset = offset
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    elapsed = time.monotonic() - started
+    documents = checkpoint["documents"] - start_documents
+    checkpoint["docs_per_sec"] = documents / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"Done: {documents} documents in {elapsed:.1f}s ({checkpoint['docs_per_sec']:.1f} docs/sec), "
+        f"{checkpoint['stored']} chunks stored, {checkpoint.get('merged', 0)} merged into duplicates, "
+        f"{checkpoint['rejected']} rejected"
+    )
+    return checkpoint
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk-load a corpus into the knowledge store")
+    parser.add_argument("path", type=Path, help="Corpus file (JSONL or plain text)")
+    parser.add_argument("--format", choices=["jsonl", "text"], help="Corpus format (default: from extension)")
+    parser.add_argument("--topic", default="", help="Topic for documents without one")
+    parser.add_argument("--batch-size", type=int, default=INGEST_CLI_BATCH_SIZE, help="Chunks per embedding/write batch")
+    parser.add_argument("--checkpoint", type=Path, help="Checkpoint file (default: <path>.checkpoint.json)")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, LOG_LEVEL),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    if not args.path.exists():
+        logger.error(f"Corpus not found: {args.path}")
+        return 1
+
+    fmt = args.format or ("jsonl" if args.path.suffix in (".jsonl", ".ndjson") else "text")
+    checkpoint_path = args.checkpoint or args.path.with_name(args.path.name + ".checkpoint.json")
+    ingest(args.path, fmt, max(1, args.batch_size), checkpoint_path,
+           resume=not args.restart, default_topic=args.topic)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
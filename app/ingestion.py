@@ -0,0 +1,264 @@
+"""
+Durable knowledge ingestion
+A single worker drains an append-only write-ahead log (WAL), coalescing pending
+teach requests into batched embedding and database calls
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from app.config import (
+    INGEST_WAL_PATH, INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL_MS,
+    INGEST_WAL_FSYNC, INGEST_WAL_COMPACT_BYTES, INGEST_JOB_HISTORY, INGEST_MAX_RETRIES, INGEST_RETRY_MAX_DELAY
+)
+
+logger = logging.getLogger(__name__)
+
+class IngestionQueue:
+    """
+    Write-ahead-logged teach queue with one batching worker
+
+    Every submitted item is appended to the WAL (and fsynced) before its job id
+    is returned. The worker marks items done in the WAL once they are stored,
+    so entries without a done record are replayed on the next startup. A batch
+    that keeps failing (e.g. the store is unreachable) is never marked done: it is
+    queued again after a backoff that doubles up to INGEST_RETRY_MAX_DELAY.
+    """
+
+    def __init__(self, knowledge_store, wal_path: Path = INGEST_WAL_PATH,
+                 batch_size: int = INGEST_BATCH_SIZE, flush_interval_ms: float = INGEST_FLUSH_INTERVAL_MS,
+                 on_stored: Optional[Callable[[List[Dict], List[Dict]], None]] = None):
+        self.knowledge_store = knowledge_store
+        self.wal_path = Path(wal_path)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval_ms) / 1000.0
+        self.on_stored = on_stored  # Called with (items, results) after each stored batch
+        self._queue: "queue.Queue[Optional[Dict]]" = queue.Queue()
+        self._wal_lock = threading.Lock()
+        self._jobs_lock = threading.Lock()
+        self._jobs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._outstanding = 0  # Items in the WAL without a done record
+        self._stored = 0
+        self._merged = 0
+        self._retried = 0
+        self._retry_round = 0  # Consecutive deferred batches, for the backoff
+
+        self.wal_path.parent.mkdir(parents=True, exist_ok=True)
+        replayed = self._replay()
+        self._wal = open(self.wal_path, "a", encoding="utf-8")
+        for item in replayed:
+            self._queue.put(item)
+
+        self._worker = threading.Thread(target=self._run, name="knowledge-ingestion", daemon=True)
+        self._worker.start()
+
+    def submit(self, knowledge: str, topic: str = "", metadata: Optional[Dict] = None) -> str:
+        """
+        Durably queue one knowledge item
+
+        Returns:
+            Job id that can be passed to status()
+        """
+        return self.submit_many([{"knowledge": knowledge, "topic": topic, "metadata": metadata}])[0]
+
+    def submit_many(self, items: List[Dict]) -> List[str]:
+        """Durably queue several items with a single WAL write (group commit)"""
+        records = []
+        for item in items:
+            records.append({
+                "op": "add",
+                "job": uuid.uuid4().hex,
+                "knowledge": item["knowledge"],
+                "topic": item.get("topic") or "",
+                "metadata": item.get("metadata") or None,
+                "queued_at": time.time()
+            })
+
+        # Count the items as outstanding under the WAL lock so compaction never drops them
+        with self._wal_lock:
+            self._write(records)
+            with self._jobs_lock:
+                self._outstanding += len(records)
+                for record in records:
+                    self._set_status(record["job"], "queued")
+        for record in records:
+            self._queue.put(record)
+
+        return [record["job"] for record in records]
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        """Status of a job: queued, retrying, stored, merged or rejected (None if unknown)"""
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            return {"job_id": job_id, **job} if job else None
+
+    def backlog(self) -> int:
+        """Number of items not yet flushed to the knowledge store"""
+        with self._jobs_lock:
+            return self._outstanding
+
+    def stats(self) -> Dict:
+        with self._jobs_lock:
+            return {
+                "backlog": self._outstanding,
+                "stored": self._stored,
+                "merged": self._merged,
+                "retried": self._retried,
+                "wal_bytes": self.wal_path.stat().st_size if self.wal_path.exists() else 0
+            }
+
+    def close(self, timeout: Optional[float] = None):
+        """Flush queued items and stop the worker (unflushed items stay in the WAL)"""
+        self._queue.put(None)
+        self._worker.join(timeout)
+        with self._wal_lock:
+            self._wal.close()
+
+    def _write(self, records: List[Dict]):
+        """Append records to the WAL and make them durable (WAL lock held)"""
+        self._wal.write("".join(json.dumps(record) + "\n" for record in records))
+        self._wal.flush()
+        if INGEST_WAL_FSYNC:
+            os.fsync(self._wal.fileno())
+
+    def _set_status(self, job_id: str, status: str):
+        """Record a job status, keeping only the most recent jobs (lock held)"""
+        self._jobs[job_id] = {"status": status, "updated_at": time.time()}
+        self._jobs.move_to_end(job_id)
+        while len(self._jobs) > INGEST_JOB_HISTORY:
+            self._jobs.popitem(last=False)
+
+    def _replay(self) -> List[Dict]:
+        """Read the WAL and return the items that were never marked done"""
+        if not self.wal_path.exists():
+            return []
+
+        pending: "OrderedDict[str, Dict]" = OrderedDict()
+        with open(self.wal_path, "r", encoding="utf-8") as wal:
+            for line in wal:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("Skipping torn WAL record")  # Crash mid-write
+                    continue
+                if record.get("op") == "add":
+                    pending[record["job"]] = record
+                elif record.get("op") == "done":
+                    pending.pop(record["job"], None)
+                    self._set_status(record["job"], record.get("status", "stored"))
+
+        # Rewrite the WAL with only the unflushed entries
+        self._rewrite(list(pending.values()))
+        for job_id in pending:
+            self._set_status(job_id, "queued")
+        self._outstanding = len(pending)
+
+        if pending:
+            logger.info(f"Replaying {len(pending)} unflushed knowledge items from WAL")
+        return list(pending.values())
+
+    def _rewrite(self, records: List[Dict]):
+        """Atomically replace the WAL contents"""
+        tmp_path = self.wal_path.with_suffix(self.wal_path.suffix + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as tmp:
+            for record in records:
+                tmp.write(json.dumps(record) + "\n")
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.replace(tmp_path, self.wal_path)
+
+    def _run(self):
+        """Worker loop: coalesce queued items into batches and store them"""
+        closing = False
+        while not closing:
+            first = self._queue.get()
+            if first is None:
+                break
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            self._store(batch)
+            self._maybe_compact()
+
+    def _store(self, batch: List[Dict]):
+        """Store one batch, retrying transient failures and deferring it if they persist"""
+        for attempt in range(1, INGEST_MAX_RETRIES + 1):
+            try:
+                results = self.knowledge_store.store_knowledge_batch(batch)
+                break
+            except Exception as e:
+                logger.error(f"Knowledge ingestion failed (attempt {attempt}/{INGEST_MAX_RETRIES}): {e}")
+                if attempt == INGEST_MAX_RETRIES:
+                    self._defer(batch)
+                    return
+                time.sleep(min(2 ** attempt, 30))
+        self._retry_round = 0
+
+        with self._wal_lock:
+            self._write([
+                {"op": "done", "job": item["job"], "status": result["status"]}
+                for item, result in zip(batch, results)
+            ])
+
+        with self._jobs_lock:
+            self._outstanding -= len(batch)
+            for item, result in zip(batch, results):
+                self._set_status(item["job"], result["status"])
+                if result["status"] == "stored":
+                    self._stored += 1
+                elif result["status"] == "merged":
+                    self._merged += 1
+
+        stored = sum(1 for result in results if result["status"] == "stored")
+        merged = sum(1 for result in results if result["status"] == "merged")
+        logger.info(f"Ingested batch of {len(batch)} knowledge items ({stored} stored, {merged} merged)")
+
+        if self.on_stored and stored:
+            try:
+                self.on_stored(batch, results)
+            except Exception as e:
+                logger.error(f"Post-ingestion callback failed: {e}")
+
+    def _defer(self, batch: List[Dict]):
+        """Queue a failed batch again after a backoff; it stays in the WAL (and outstanding) meanwhile"""
+        self._retry_round += 1
+        delay = min(INGEST_RETRY_MAX_DELAY, 30.0 * 2 ** (self._retry_round - 1))
+        logger.error(f"Deferring {len(batch)} knowledge items, retrying in {delay:.0f}s")
+        with self._jobs_lock:
+            self._retried += len(batch)
+            for item in batch:
+                self._set_status(item["job"], "retrying")
+        timer = threading.Timer(delay, lambda: [self._queue.put(item) for item in batch])
+        timer.daemon = True  # Items still pending at shutdown are replayed from the WAL
+        timer.start()
+
+    def _maybe_compact(self):
+        """Truncate the WAL once everything in it has been flushed"""
+        with self._jobs_lock:
+            idle = self._outstanding == 0
+        if not idle or self.wal_path.stat().st_size < INGEST_WAL_COMPACT_BYTES:
+            return
+        with self._wal_lock:
+            with self._jobs_lock:
+                if self._outstanding:
+                    return
+            self._wal.close()
+            self._rewrite([])
+            self._wal = open(self.wal_path, "a", encoding="utf-8")
@@ -1,18 +1,108 @@
 """
-Knowledge storage and retrieval using ChromaDB
+Knowledge storage and retrieval using a vector backend (ChromaDB or NumPy)
 Implements RAG (Retrieval Augmented Generation) for learning from user teachings
 """
-import chromadb
-from chromadb.config import Settings
+import hashlib
 import logging
-from typing import List, Dict, Optional
-from app.config import KNOWLEDGE_DB_DIR, KNOWLEDGE_COLLECTION_NAME, RAG_SIMILARITY_THRESHOLD, MAX_RETRIEVED_DOCS
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import Iterator, List, Dict, Optional
+import numpy as np
+from app.config import (
+    RAG_SIMILARITY_THRESHOLD, MAX_RETRIEVED_DOCS, MAX_KNOWLEDGE_CHARS, KNOWLEDGE_PAGE_SIZE,
+    DEDUP_ENABLED, DEDUP_SIMILARITY
+)
 from app.embeddings import EmbeddingModel
+from app.vector_store import VectorBackend
+from app.writer import open_backend, switch_backend
+from app.snapshot import export_snapshot, import_snapshot
+from app.usage import UsageTracker
+from app.metrics import stage
+from app.context import knowledge_token_ids, strip_token_metadata, token_metadata
 
 logger = logging.getLogger(__name__)
 
+def distance_to_similarity(distance: float) -> float:
+    """Convert a backend (squared L2) distance to a similarity score - lower distance = higher similarity"""
+    return 1 / (1 + distance)
+
+def retrieval_max_distance(threshold: float = RAG_SIMILARITY_THRESHOLD) -> float:
+    """Largest distance whose similarity still passes the retrieval threshold"""
+    return 1 / threshold - 1
+
+def duplicate_max_distance(similarity: float = DEDUP_SIMILARITY) -> float:
+    """Largest squared L2 distance between unit embeddings whose cosine similarity reaches the threshold"""
+    return 2.0 * (1.0 - similarity)
+
+def content_hash(text: str) -> str:
+    """Hash identifying a document's text regardless of case and whitespace"""
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def merge_hits(metadata: Dict, hits: int, last_taught: Optional[float]) -> Dict:
+    """
+    Metadata keys to update on an entry that absorbed duplicates
+
+    Args:
+        metadata: The kept entry's metadata
+        hits: Number of times the duplicates were taught
+        last_taught: Latest teach time among the duplicates (None if unknown)
+
+    Returns:
+        Patch for VectorBackend.patch_metadatas: hit_count increased and last_taught updated
+        (other keys, such as the usage counts, are left to their own writers)
+    """
+    metadata = metadata or {}
+    patch = {"hit_count": int(metadata.get("hit_count", 1)) + hits}
+    times = [t for t in (metadata.get("last_taught"), last_taught) if t is not None]
+    if times:
+        patch["last_taught"] = max(times)
+    return patch
+
+def chunk_knowledge(text: str, max_chars: int = MAX_KNOWLEDGE_CHARS) -> List[str]:
+    """
+    Split a long document into chunks that pass validate_knowledge
+
+    Paragraphs and then sentences are packed greedily; a single sentence longer
+    than max_chars is split on whitespace (or hard-cut as a last resort).
+
+    Args:
+        text: Document text
+        max_chars: Maximum chunk length
+
+    Returns:
+        List of chunks (the text itself if it already fits)
+    """
+    text = text.strip()
+    if len(text) <= max_chars:
+        return [text] if text else []
+
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        for sentence in re.split(r'(?<=[.!?])\s+', paragraph.strip()):
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(" ", 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            if sentence:
+                pieces.append(sentence)
+
+    chunks, current = [], ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
 class KnowledgeStore:
-    """Manages knowledge storage and retrieval using ChromaDB"""
+    """Manages knowledge storage and retrieval on top of a pluggable vector backend"""
 
     _instance = None
 
@@ -25,28 +115,25 @@ class KnowledgeStore:
         if not hasattr(self, 'initialized'):
             self.initialized = True
             self.embedding_model = EmbeddingModel()
-            self.client = None
-            self.collection = None
+            self.backend: Optional[VectorBackend] = None
             self._initialize_db()
+            self.usage = UsageTracker(self.backend)  # Retrieval hits, written to metadata in the background
 
-    def _initialize_db(self):
-        """Initialize ChromaDB client and collection"""
-        try:
-            logger.info("Initializing ChromaDB...")
-            self.client = chromadb.PersistentClient(
-                path=str(KNOWLEDGE_DB_DIR),
-                settings=Settings(anonymized_telemetry=False)
-            )
+    @property
+    def epoch(self) -> int:
+        """The backend's epoch: changes when stored knowledge that retrieval can return changes"""
+        return self.backend.epoch
 
-            # Get or create collection
-            self.collection = self.client.get_or_create_collection(
-                name=KNOWLEDGE_COLLECTION_NAME,
-                metadata={"description": "User knowledge storage for RAG"}
-            )
+    def changed_embeddings(self, since: int) -> Optional[np.ndarray]:
+        """Embeddings added or deleted since an earlier epoch (None if not known)"""
+        return self.backend.changed_embeddings(since)
 
-            logger.info(f"ChromaDB initialized. Collection size: {self.collection.count()}")
+    def _initialize_db(self):
+        """Initialize the vector backend selected by VECTOR_BACKEND"""
+        try:
+            self.backend = open_backend()
         except Exception as e:
-            logger.error(f"Error initializing ChromaDB: {e}")
+            logger.error(f"Error initializing vector backend: {e}")
             raise
 
     def validate_knowledge(self, knowledge: str, topic: str = "") -> bool:
@@ -64,7 +151,7 @@ class KnowledgeStore:
             logger.warning("Knowledge too short or empty")
             return False
 
-        if len(knowledge) > 5000:  # Reasonable limit
+        if len(knowledge) > MAX_KNOWLEDGE_CHARS:  # Reasonable limit (use chunk_knowledge for longer documents)
             logger.warning("Knowledge too long")
             return False
 
@@ -80,81 +167,170 @@ class KnowledgeStore:
             metadata: Additional metadata dictionary
 
         Returns:
-            bool: True if stored successfully
+            bool: True if stored (or merged into an existing duplicate) successfully
         """
-        if not self.validate_knowledge(knowledge, topic):
-            return False
-
         try:
-            # Generate embedding
-            embedding = self.embedding_model.encode(knowledge)
-
-            # Prepare metadata
-            doc_metadata = {"topic": topic} if topic else {}
-            if metadata:
-                doc_metadata.update(metadata)
-
-            # Generate unique ID
-            import uuid
-            doc_id = str(uuid.uuid4())
-
-            # Store in ChromaDB
-            self.collection.add(
-                ids=[doc_id],
-                embeddings=[embedding.tolist()],
-                documents=[knowledge],
-                metadatas=[doc_metadata]
-            )
-
-            logger.info(f"Knowledge stored successfully. Topic: {topic}")
-            return True
+            result = self.store_knowledge_batch([{
+                "knowledge": knowledge,
+                "topic": topic,
+                "metadata": metadata
+            }])[0]
+            if result["status"] == "stored":
+                logger.info(f"Knowledge stored successfully. Topic: {topic}")
+            elif result["status"] == "merged":
+                logger.info(f"Knowledge merged into existing entry {result['id']}. Topic: {topic}")
+            return result["status"] in ("stored", "merged")
 
         except Exception as e:
             logger.error(f"Error storing knowledge: {e}")
             return False
 
-    def retrieve_relevant_knowledge(self, query: str, top_k: int = 2) -> List[Dict]:
+    def store_knowledge_batch(self, items: List[Dict]) -> List[Dict]:
+        """
+        Validate, embed and store several knowledge items with one encode and one add call
+
+        With DEDUP_ENABLED, an item with the same text as a stored entry (content
+        hash) or an embedding within DEDUP_SIMILARITY of one - or of an earlier item
+        in the batch - is not inserted again: that entry's hit_count and
+        last_taught are updated instead.
+
+        Args:
+            items: Dictionaries with 'knowledge' and optional 'topic' and 'metadata' keys
+
+        Returns:
+            One result per item: {'status': 'stored' | 'merged' | 'rejected', 'id', 'embedding'}
+            (a merged item has the id of the entry it was merged into and no embedding)
+
+        Raises:
+            Exception: if embedding or the database write fails (nothing is stored then)
+        """
+        results = [{"status": "rejected", "id": None, "embedding": None} for _ in items]
+        valid = [
+            i for i, item in enumerate(items)
+            if self.validate_knowledge(item.get("knowledge", ""), item.get("topic") or "")
+        ]
+        if not valid:
+            return results
+
+        now = time.time()
+        hashes = {i: content_hash(items[i]["knowledge"]) for i in valid}
+        same_as: Dict[int, int] = {}  # Item -> earlier item of this batch it duplicates
+        existing: Dict[int, str] = {}  # Item -> stored entry it duplicates
+
+        # Exact duplicates need no embedding
+        if DEDUP_ENABLED:
+            first_by_hash: Dict[str, int] = {}
+            for i in valid:
+                if hashes[i] in first_by_hash:
+                    same_as[i] = first_by_hash[hashes[i]]
+                else:
+                    first_by_hash[hashes[i]] = i
+            stored = self.backend.find_content_hashes(list(first_by_hash))
+            for digest, doc_id in stored.items():
+                existing[first_by_hash[digest]] = doc_id
+
+        # Generate embeddings (documents bypass the query embedding cache)
+        pending = [i for i in valid if i not in same_as and i not in existing]
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+        if pending:
+            embeddings = self.embedding_model.encode([items[i]["knowledge"] for i in pending], use_cache=False)
+
+        # Near-duplicates of the stored entries, then of the new items kept so far
+        kept_rows = list(range(len(pending)))
+        if DEDUP_ENABLED and pending:
+            max_distance = duplicate_max_distance()
+            nearest = self.backend.query(embeddings, n_results=1)
+            kept_rows = []
+            for row, i in enumerate(pending):
+                if nearest["ids"][row] and nearest["distances"][row][0] <= max_distance:
+                    existing[i] = nearest["ids"][row][0]
+                    continue
+                if kept_rows:
+                    distances = np.sum((embeddings[kept_rows] - embeddings[row]) ** 2, axis=1)
+                    closest = int(np.argmin(distances))
+                    if distances[closest] <= max_distance:
+                        same_as[i] = pending[kept_rows[closest]]
+                        continue
+                kept_rows.append(row)
+
+        def target(i: int) -> int:
+            while i in same_as:
+                i = same_as[i]
+            return i
+
+        extra_hits: Dict[int, int] = {}
+        for i in same_as:
+            extra_hits[target(i)] = extra_hits.get(target(i), 0) + 1
+
+        new = [pending[row] for row in kept_rows]
+        ids = {i: str(uuid.uuid4()) for i in new}
+        if new:
+            # Token ids are computed once here so prompts can be packed without re-tokenizing
+            tokens = token_metadata([items[i]["knowledge"] for i in new])
+
+            metadatas = []
+            for i, token_fields in zip(new, tokens):
+                # Always carry the topic key - ChromaDB rejects empty metadata dicts
+                doc_metadata = {"topic": items[i].get("topic") or ""}
+                if items[i].get("metadata"):
+                    doc_metadata.update(items[i]["metadata"])
+                doc_metadata.update(token_fields)
+                doc_metadata.update({"content_hash": hashes[i], "hit_count": 1 + extra_hits.get(i, 0), "last_taught": now})
+                metadatas.append(doc_metadata)
+
+            # Store in the vector backend
+            self.backend.add(
+                ids=[ids[i] for i in new],
+                embeddings=embeddings[kept_rows],
+                documents=[items[i]["knowledge"] for i in new],
+                metadatas=metadatas
+            )
+
+        # Duplicates of stored entries only touch their metadata
+        hits: Dict[str, int] = {}
+        for i, doc_id in existing.items():
+            hits[doc_id] = hits.get(doc_id, 0) + 1 + extra_hits.get(i, 0)
+        if hits:
+            stored = self.backend.get(ids=list(hits))
+            self.backend.patch_metadatas(
+                stored["ids"],
+                [merge_hits(metadata, hits[doc_id], now) for doc_id, metadata in zip(stored["ids"], stored["metadatas"])]
+            )
+            logger.info(f"Merged {sum(hits.values())} duplicate knowledge items into {len(hits)} existing entries")
+
+        for row, i in zip(kept_rows, new):
+            results[i] = {"status": "stored", "id": ids[i], "embedding": embeddings[row]}
+        for i in valid:
+            if i in same_as or i in existing:
+                root = target(i)
+                results[i] = {"status": "merged", "id": existing.get(root) or ids[root], "embedding": None}
+        return results
+
+    def retrieve_relevant_knowledge(self, query: str, top_k: int = 2,
+                                    query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
         """
         Retrieve relevant knowledge based on query similarity
 
         Args:
             query: Search query
             top_k: Number of results to return
+            query_embedding: Embedding of query if the caller already encoded it
 
         Returns:
-            List of dictionaries with 'text', 'topic', and 'score' keys
+            List of dictionaries with 'id', 'text', 'topic', 'score' and 'token_ids' keys
         """
-        if self.collection.count() == 0:
-            logger.info("No knowledge in database")
-            return []
-
         try:
             # Generate query embedding
-            query_embedding = self.embedding_model.encode(query)
-
-            # Search in ChromaDB
-            results = self.collection.query(
-                query_embeddings=[query_embedding.tolist()],
-                n_results=min(top_k, self.collection.count()),
-                include=["documents", "metadatas", "distances"]
-            )
+            if query_embedding is None:
+                with stage("embed"):
+                    query_embedding = self.embedding_model.encode(query)
 
-            # Format results
-            retrieved_knowledge = []
-            if results['documents'] and len(results['documents'][0]) > 0:
-                for i, doc in enumerate(results['documents'][0]):
-                    # Convert distance to similarity score (ChromaDB returns L2 distance)
-                    # Lower distance = higher similarity
-                    distance = results['distances'][0][i]
-                    similarity = 1 / (1 + distance)  # Simple conversion
-
-                    if similarity >= RAG_SIMILARITY_THRESHOLD:
-                        retrieved_knowledge.append({
-                            'text': doc,
-                            'topic': results['metadatas'][0][i].get('topic', ''),
-                            'score': similarity
-                        })
+            # Search the vector backend (an empty collection returns no results)
+            with stage("search"):
+                results = self.backend.query(query_embedding, n_results=top_k)
 
+            retrieved_knowledge = self._format_matches(results, 0)
+            self.usage.record(item['id'] for item in retrieved_knowledge)
             logger.info(f"Retrieved {len(retrieved_knowledge)} relevant knowledge items")
             return retrieved_knowledge
 
@@ -162,10 +338,111 @@ class KnowledgeStore:
             logger.error(f"Error retrieving knowledge: {e}")
             return []
 
+    def retrieve_relevant_knowledge_batch(self, queries: List[str], top_k: int = 2) -> List[List[Dict]]:
+        """
+        Retrieve knowledge for many queries with one encode call and one multi-query search
+
+        The query embedding cache is bypassed so offline batches do not evict interactive entries.
+
+        Args:
+            queries: Search queries
+            top_k: Number of results per query
+
+        Returns:
+            One list per query, as retrieve_relevant_knowledge returns them
+        """
+        if not queries:
+            return []
+        try:
+            with stage("embed"):
+                embeddings = self.embedding_model.encode(queries, use_cache=False)
+            with stage("search"):
+                results = self.backend.query(embeddings, n_results=top_k)
+
+            retrieved = [self._format_matches(results, q) for q in range(len(queries))]
+            self.usage.record(item['id'] for items in retrieved for item in items)
+            return retrieved
+
+        except Exception as e:
+            logger.error(f"Error retrieving knowledge for {len(queries)} queries: {e}")
+            return [[] for _ in queries]
+
+    @staticmethod
+    def _format_matches(results: Dict, q: int) -> List[Dict]:
+        """Matches of query q in a backend query() result that pass the similarity threshold"""
+        matches = []
+        for i, doc in enumerate(results['documents'][q] if results['documents'] else []):
+            # Convert distance to similarity score (backends return squared L2 distance)
+            # Lower distance = higher similarity
+            similarity = distance_to_similarity(results['distances'][q][i])
+
+            if similarity >= RAG_SIMILARITY_THRESHOLD:
+                metadata = results['metadatas'][q][i] or {}
+                matches.append({
+                    'id': results['ids'][q][i],
+                    'text': doc,
+                    'topic': metadata.get('topic', ''),
+                    'score': similarity,
+                    'token_ids': knowledge_token_ids(doc, metadata)
+                })
+        return matches
+
+    @staticmethod
+    def _format_rows(results: Dict) -> List[Dict]:
+        """Turn a backend get() result into knowledge dictionaries"""
+        knowledge_list = []
+        for i, doc_id in enumerate(results['ids']):
+            metadata = strip_token_metadata(results['metadatas'][i] or {})
+            metadata.pop('content_hash', None)
+            knowledge_list.append({
+                'id': doc_id,
+                'text': results['documents'][i],
+                'topic': metadata.get('topic', ''),
+                'metadata': metadata
+            })
+        return knowledge_list
+
+    def list_knowledge(self, topic: Optional[str] = None, limit: int = KNOWLEDGE_PAGE_SIZE,
+                       cursor: Optional[str] = None) -> Dict:
+        """
+        One page of stored knowledge, optionally filtered by topic
+
+        Args:
+            topic: Optional topic filter
+            limit: Page size
+            cursor: Cursor from the previous page (None for the first page)
+
+        Returns:
+            Dictionary with 'knowledge' (list) and 'next_cursor' (None on the last page)
+        """
+        results, next_cursor = self.backend.page(
+            where={"topic": topic} if topic else None,
+            limit=limit,
+            cursor=cursor
+        )
+        return {"knowledge": self._format_rows(results), "next_cursor": next_cursor}
+
+    def iter_knowledge(self, topic: Optional[str] = None,
+                       chunk_size: int = KNOWLEDGE_PAGE_SIZE) -> Iterator[Dict]:
+        """Yield all stored knowledge page by page, without holding the collection in memory"""
+        cursor = None
+        while True:
+            page = self.list_knowledge(topic=topic, limit=chunk_size, cursor=cursor)
+            yield from page["knowledge"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    def count_knowledge(self, topic: Optional[str] = None) -> int:
+        """Number of stored knowledge items, optionally filtered by topic"""
+        return self.backend.count(where={"topic": topic} if topic else None)
+
     def get_all_knowledge(self, topic: Optional[str] = None) -> List[Dict]:
         """
         Get all stored knowledge, optionally filtered by topic
 
+        Prefer list_knowledge/iter_knowledge on large collections.
+
         Args:
             topic: Optional topic filter
 
@@ -173,28 +450,38 @@ class KnowledgeStore:
             List of knowledge dictionaries
         """
         try:
-            if topic:
-                results = self.collection.get(
-                    where={"topic": topic},
-                    include=["documents", "metadatas"]
-                )
-            else:
-                results = self.collection.get(
-                    include=["documents", "metadatas"]
-                )
-
-            knowledge_list = []
-            if results['ids']:
-                for i, doc_id in enumerate(results['ids']):
-                    knowledge_list.append({
-                        'id': doc_id,
-                        'text': results['documents'][i],
-                        'topic': results['metadatas'][i].get('topic', ''),
-                        'metadata': results['metadatas'][i]
-                    })
-
-            return knowledge_list
+            return list(self.iter_knowledge(topic=topic))
         except Exception as e:
             logger.error(f"Error getting all knowledge: {e}")
             return []
 
+    def export_snapshot(self, path: Path) -> Dict:
+        """
+        Write the whole store to a snapshot file (see app/snapshot.py)
+
+        Returns:
+            The snapshot header
+        """
+        self.usage.flush()  # Recent retrieval counts go into the snapshot
+        return export_snapshot(self.backend, path)
+
+    def load_snapshot(self, path: Path) -> Dict:
+        """
+        Replace the stored knowledge with a snapshot's, without re-embedding it
+
+        The snapshot is bulk-loaded into a new store directory while the current
+        store keeps serving, then every process switches to it. Knowledge taught
+        during the load stays in the old store.
+
+        Args:
+            path: Snapshot file
+
+        Returns:
+            The snapshot header
+        """
+        loaded, header = import_snapshot(path, self.backend.name)
+        self.usage.flush()
+        self.backend = switch_backend(self.backend, loaded)
+        self.usage.backend = self.backend
+        logger.info(f"Switched knowledge store to {loaded.location} ({header['count']} documents)")
+        return header
@@ -1,16 +1,29 @@
 """
 FastAPI application for LLM Chat System
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, constr
+from starlette.concurrency import run_in_threadpool
+import json
 import logging
-from typing import Optional
+import secrets
+import threading
+from typing import List, Optional
 import uvicorn
 
 from app.chat import ChatHandler
-from app.config import API_HOST, API_PORT, SSL_CERT_PATH, SSL_KEY_PATH, ALLOWED_ORIGINS, LOG_LEVEL
+from app.startup import Startup
+from app.executor import InferenceExecutor, QueueFullError
+from app import metrics
+from app.profiling import ProfilerBusyError, list_profiles, profile_call, profile_path
+from app.snapshot import list_snapshots, new_snapshot_name, snapshot_path
+from app.config import (
+    API_HOST, API_PORT, SSL_CERT_PATH, SSL_KEY_PATH, ALLOWED_ORIGINS, LOG_LEVEL, TEACH_BATCH_MAX_ITEMS,
+    KNOWLEDGE_PAGE_SIZE, KNOWLEDGE_PAGE_MAX, STOP_STRINGS_MAX, STOP_STRING_MAX_CHARS, ADMIN_TOKEN,
+    CHAT_BATCH_MAX_ITEMS
+)
 
 # Configure logging
 logging.basicConfig(
@@ -35,13 +48,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize chat handler (singleton pattern used internally)
-chat_handler = ChatHandler()
+# Models and stores load in the background once the server is up (see /ready)
+startup = Startup()
+
+# Bounded pool for blocking inference (keeps the event loop and /health responsive)
+inference_executor = InferenceExecutor()
 
 # Request/Response Models
 class ChatRequest(BaseModel):
     message: str = Field(..., description="User message")
     conversation_id: Optional[str] = Field(None, description="Optional conversation ID")
+    stop: Optional[List[constr(min_length=1, max_length=STOP_STRING_MAX_CHARS)]] = Field(
+        None,
+        description="Extra stop strings that end the response (dialogue labels like 'Human:' always do)",
+        max_length=STOP_STRINGS_MAX
+    )
+
+class ChatBatchRequest(BaseModel):
+    messages: List[constr(min_length=1)] = Field(..., description="Messages, answered independently",
+                                                 min_length=1, max_length=CHAT_BATCH_MAX_ITEMS)
+    stop: Optional[List[constr(min_length=1, max_length=STOP_STRING_MAX_CHARS)]] = Field(
+        None,
+        description="Extra stop strings for every message",
+        max_length=STOP_STRINGS_MAX
+    )
 
 class ChatResponse(BaseModel):
     response: str
@@ -55,28 +85,97 @@ class TeachRequest(BaseModel):
 class TeachResponse(BaseModel):
     success: bool
     message: str
+    job_id: Optional[str] = None
+
+class TeachBatchRequest(BaseModel):
+    items: List[TeachRequest] = Field(..., description="Documents to store (long ones are chunked)",
+                                      min_length=1, max_length=TEACH_BATCH_MAX_ITEMS)
+
+class TeachBatchResponse(BaseModel):
+    success: bool
+    message: str
+    job_ids: List[str] = []
+
+def queue_full_error(error: QueueFullError) -> HTTPException:
+    """429 response telling the client when to retry"""
+    return HTTPException(
+        status_code=429,
+        detail="Server is busy, please retry later",
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+def get_chat_handler() -> ChatHandler:
+    """The chat handler, or a 503 while the models are still loading"""
+    if startup.chat_handler is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Service is starting up" if startup.state != "failed" else f"Startup failed: {startup.error}",
+            headers={"Retry-After": "5"}
+        )
+    return startup.chat_handler
+
+def require_admin(token: Optional[str]):
+    """403 unless token matches ADMIN_TOKEN (always 403 when no admin token is configured)"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin features are disabled (set ADMIN_TOKEN)")
+    if not token or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.on_event("startup")
+def begin_startup():
+    """Load models and stores in the background so the port is bound right away"""
+    startup.start()
 
 # Endpoints
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
+    """Health check endpoint (liveness - answers while models are loading)"""
     return {
         "status": "healthy",
         "service": "LLM Chat API"
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness endpoint: 200 once the models and knowledge store are loaded, 503 before
+
+    Includes per-phase load timings.
+    """
+    return JSONResponse(status_code=200 if startup.ready else 503, content=startup.status())
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, response: Response,
+                        x_profile_token: Optional[str] = Header(None)):
     """
     Chat with the model
 
     The model will retrieve relevant learned knowledge and use it in the response.
+    Sending the admin token in X-Profile-Token profiles this request; the artifact id
+    is returned in the X-Profile-Id response header (download it from /admin/profiles).
     """
+    chat_handler = get_chat_handler()
+    if x_profile_token is not None:
+        require_admin(x_profile_token)
     try:
-        result = chat_handler.chat(
-            user_message=request.message,
-            conversation_id=request.conversation_id
-        )
+        with metrics.IN_FLIGHT.track_inprogress():
+            if x_profile_token is None:
+                result = await inference_executor.run(
+                    chat_handler.chat,
+                    user_message=request.message,
+                    conversation_id=request.conversation_id,
+                    stop=request.stop
+                )
+            else:
+                result, profile_id = await inference_executor.run(
+                    profile_call,
+                    chat_handler.chat,
+                    label="/chat",
+                    user_message=request.message,
+                    conversation_id=request.conversation_id,
+                    stop=request.stop
+                )
+                response.headers["X-Profile-Id"] = profile_id
 
         if result.get("error"):
             raise HTTPException(status_code=500, detail=result.get("response"))
@@ -87,10 +186,99 @@ async def chat_endpoint(request: ChatRequest):
             conversation_id=result.get("conversation_id")
         )
 
+    except QueueFullError as e:
+        raise queue_full_error(e)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         logger.error(f"Error in chat endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Chat with the model, streaming the response as server-sent events
+
+    Each decoded fragment is sent as `data: {"token": "..."}`; the stream ends with
+    an `event: done` message carrying the full response and metadata.
+    """
+    chat_handler = get_chat_handler()
+    cancel_event = threading.Event()
+    events = inference_executor.iterate(chat_handler.chat_stream(
+        user_message=request.message,
+        conversation_id=request.conversation_id,
+        cancel_event=cancel_event,
+        stop=request.stop
+    ))
+
+    # Take the first event before responding so a full queue still gets a proper 429
+    metrics.IN_FLIGHT.inc()
+    try:
+        first_event = await events.__anext__()
+    except QueueFullError as e:
+        metrics.IN_FLIGHT.dec()
+        raise queue_full_error(e)
+    except Exception:
+        metrics.IN_FLIGHT.dec()
+        raise
+
+    def format_event(event: dict) -> str:
+        if event.get("done"):
+            return f"event: done\ndata: {json.dumps(event)}\n\n"
+        return f"data: {json.dumps(event)}\n\n"
+
+    async def event_source():
+        try:
+            yield format_event(first_event)
+            # Retrieval and decoding block, so the generator is advanced on the inference pool
+            async for event in events:
+                yield format_event(event)
+        finally:
+            # Client went away (or stream finished) - stop decoding
+            cancel_event.set()
+            await events.aclose()
+            metrics.IN_FLIGHT.dec()
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(request: ChatBatchRequest):
+    """
+    Answer many messages in one call, streaming one JSON object per line
+
+    Messages are embedded and searched together, then generated in batches of
+    similar prompt length. Lines ({"index", "response", "knowledge_used"}) arrive as
+    batches finish, not in request order; "index" is the message's position.
+    """
+    chat_handler = get_chat_handler()
+    results = inference_executor.iterate(chat_handler.chat_batch(request.messages, stop=request.stop))
+
+    # Take the first result before responding so a full queue still gets a proper 429
+    metrics.IN_FLIGHT.inc()
+    try:
+        first_result = await results.__anext__()
+    except QueueFullError as e:
+        metrics.IN_FLIGHT.dec()
+        raise queue_full_error(e)
+    except Exception:
+        metrics.IN_FLIGHT.dec()
+        raise
+
+    async def rows():
+        try:
+            yield json.dumps(first_result) + "\n"
+            async for result in results:
+                yield json.dumps(result) + "\n"
+        finally:
+            await results.aclose()
+            metrics.IN_FLIGHT.dec()
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
 @app.post("/teach", response_model=TeachResponse)
 async def teach_endpoint(request: TeachRequest):
     """
@@ -102,36 +290,236 @@ async def teach_endpoint(request: TeachRequest):
 
     Later, when someone asks about chess, this knowledge will be retrieved and used.
     """
+    chat_handler = get_chat_handler()
     try:
-        result = chat_handler.teach(
+        # The write-ahead log append fsyncs, so it runs off the event loop
+        result = await run_in_threadpool(
+            chat_handler.teach,
             knowledge=request.knowledge,
             topic=request.topic or ""
         )
 
         return TeachResponse(
             success=result["success"],
-            message=result["message"]
+            message=result["message"],
+            job_id=result.get("job_id")
         )
 
     except Exception as e:
         logger.error(f"Error in teach endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/teach/batch", response_model=TeachBatchResponse)
+async def teach_batch_endpoint(request: TeachBatchRequest):
+    """
+    Teach many documents in one call
+
+    Documents longer than the knowledge size limit are split into chunks; all chunks
+    are queued with a single write-ahead log append and embedded in large batches.
+    """
+    chat_handler = get_chat_handler()
+    try:
+        result = await run_in_threadpool(chat_handler.teach_batch, [
+            {"knowledge": item.knowledge, "topic": item.topic or ""}
+            for item in request.items
+        ])
+        return TeachBatchResponse(**result)
+
+    except Exception as e:
+        logger.error(f"Error in teach batch endpoint: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/teach/{job_id}")
+async def teach_status(job_id: str):
+    """
+    Status of a teach job: queued, retrying (storage failed, it will be retried), stored, merged
+    (into an existing duplicate) or rejected
+    """
+    status = get_chat_handler().teach_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return status
+
 @app.get("/knowledge")
-async def get_knowledge(topic: Optional[str] = None):
+async def get_knowledge(
+    topic: Optional[str] = None,
+    limit: int = Query(KNOWLEDGE_PAGE_SIZE, ge=1, le=KNOWLEDGE_PAGE_MAX),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
     """
-    Get all stored knowledge, optionally filtered by topic
+    Get stored knowledge, optionally filtered by topic
+
+    - json (default): one page of `limit` items plus `next_cursor` for the following page
+    - ndjson: streams every matching item, one JSON object per line, fetched `limit` at a time
     """
+    store = get_chat_handler().knowledge_store
+
+    if format == "ndjson":
+        def rows():
+            for item in store.iter_knowledge(topic=topic, chunk_size=limit):
+                yield json.dumps(item) + "\n"
+
+        # Sync generators are advanced on the threadpool by StreamingResponse
+        return StreamingResponse(rows(), media_type="application/x-ndjson")
+
     try:
-        knowledge_list = chat_handler.knowledge_store.get_all_knowledge(topic=topic)
+        page = await run_in_threadpool(store.list_knowledge, topic=topic, limit=limit, cursor=cursor)
         return {
-            "count": len(knowledge_list),
-            "knowledge": knowledge_list
+            "count": len(page["knowledge"]),
+            "knowledge": page["knowledge"],
+            "next_cursor": page["next_cursor"]
         }
     except Exception as e:
         logger.error(f"Error getting knowledge: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/knowledge/count")
+async def get_knowledge_count(topic: Optional[str] = None):
+    """
+    Number of stored knowledge items (cheap - no documents are loaded)
+    """
+    chat_handler = get_chat_handler()
+    try:
+        count = await run_in_threadpool(chat_handler.knowledge_store.count_knowledge, topic=topic)
+        return {"count": count, "topic": topic}
+    except Exception as e:
+        logger.error(f"Error counting knowledge: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def runtime_stats() -> dict:
+    """Statistics of every component that is up (only the inference pool while loading)"""
+    stats = {"inference": inference_executor.stats()}
+    chat_handler = startup.chat_handler
+    if chat_handler is None:
+        return stats
+    return {
+        **stats,
+        "batching": chat_handler.scheduler.stats(),
+        "speculative": chat_handler.model.speculative_stats(),
+        "embedding_cache": chat_handler.knowledge_store.embedding_model.cache_stats(),
+        "embedding_batching": chat_handler.knowledge_store.embedding_model.batching_stats(),
+        "response_cache": chat_handler.response_cache.stats() if chat_handler.response_cache else {"enabled": False},
+        "ingestion": chat_handler.ingestion.stats(),
+        "knowledge_usage": chat_handler.knowledge_store.usage.stats(),
+        "compaction": chat_handler.compactor.stats() if chat_handler.compactor else {"enabled": False},
+        "sessions": chat_handler.sessions.stats()
+    }
+
+# Gauges on /metrics are read from the same statistics at scrape time
+metrics.register_stats(runtime_stats)
+
+@app.get("/stats")
+async def get_stats():
+    """
+    Runtime statistics: inference queue depth and wait times, generation batching, caches, ingestion backlog
+    """
+    get_chat_handler()
+    return runtime_stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus metrics: per-stage latency histograms, token counters, in-flight requests,
+    ingestion backlog and cache hit rates
+    """
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/admin/profiles")
+async def get_profiles(x_admin_token: Optional[str] = Header(None)):
+    """Stored request profiles, newest first (requires X-Admin-Token)"""
+    require_admin(x_admin_token)
+    return {"profiles": list_profiles()}
+
+@app.get("/admin/profiles/{profile_id}")
+async def download_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """
+    Download a request profile (requires X-Admin-Token)
+
+    The zip holds summary.json (per-stage wall/CPU times), cProfile output
+    (cprofile.txt, cprofile.pstats) and the torch profiler op table and trace.
+    """
+    require_admin(x_admin_token)
+    path = profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Profile not found: {profile_id}")
+    return FileResponse(path, media_type="application/zip", filename=f"profile-{profile_id}.zip")
+
+# One snapshot export or load at a time in this process
+_snapshot_lock = threading.Lock()
+
+@app.get("/admin/snapshots")
+async def get_snapshots(x_admin_token: Optional[str] = Header(None)):
+    """Knowledge snapshots in the snapshot directory, newest first (requires X-Admin-Token)"""
+    require_admin(x_admin_token)
+    return {"snapshots": await run_in_threadpool(list_snapshots)}
+
+@app.post("/admin/snapshots")
+async def create_snapshot(x_admin_token: Optional[str] = Header(None)):
+    """
+    Export the knowledge store to a new snapshot (requires X-Admin-Token)
+
+    The store keeps serving while it is read; download the file from
+    /admin/snapshots/{name} to provision another node.
+    """
+    require_admin(x_admin_token)
+    store = get_chat_handler().knowledge_store
+    if not _snapshot_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A snapshot export or load is already running")
+    try:
+        name = new_snapshot_name()
+        header = await run_in_threadpool(store.export_snapshot, snapshot_path(name))
+    except Exception as e:
+        logger.error(f"Error exporting snapshot: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        _snapshot_lock.release()
+    return {"name": name, "count": header["count"], "bytes": snapshot_path(name).stat().st_size}
+
+@app.get("/admin/snapshots/{name}")
+async def download_snapshot(name: str, x_admin_token: Optional[str] = Header(None)):
+    """Download a knowledge snapshot (requires X-Admin-Token)"""
+    require_admin(x_admin_token)
+    path = snapshot_path(name)
+    if path is None or not path.exists():
+        raise HTTPException(status_code=404, detail=f"Snapshot not found: {name}")
+    return FileResponse(path, media_type="application/octet-stream", filename=name)
+
+@app.post("/admin/snapshots/{name}/load")
+async def load_snapshot(name: str, x_admin_token: Optional[str] = Header(None)):
+    """
+    Switch the knowledge store to a snapshot without downtime (requires X-Admin-Token)
+
+    The snapshot is bulk-loaded into a new store while the current one keeps
+    answering; then the writer and every worker switch to it. Knowledge taught
+    during the load is not carried over.
+    """
+    require_admin(x_admin_token)
+    chat_handler = get_chat_handler()
+    path = snapshot_path(name)
+    if path is None or not path.exists():
+        raise HTTPException(status_code=404, detail=f"Snapshot not found: {name}")
+    if not _snapshot_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A snapshot export or load is already running")
+    try:
+        header = await run_in_threadpool(chat_handler.load_snapshot, path)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error loading snapshot {name}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        _snapshot_lock.release()
+    return {"name": name, "count": header["count"], "created": header.get("created")}
+
+@app.on_event("shutdown")
+def shutdown():
+    """Flush queued knowledge to the store before exiting"""
+    if startup.chat_handler is not None:
+        startup.chat_handler.close()
+    inference_executor.shutdown()
+
 if __name__ == "__main__":
     # Check if SSL files exist
     use_ssl = SSL_CERT_PATH.exists() and SSL_KEY_PATH.exists()
@@ -0,0 +1,135 @@
+"""
+Prometheus metrics
+Per-stage latency histograms, token counters and runtime gauges for /metrics
+"""
+import os
+from typing import Callable, Dict, List, Optional
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+)
+from prometheus_client.core import GaugeMetricFamily
+
+# Request stages timed with stage()
+STAGES = ("embed", "search", "tokenize", "generate", "postprocess")
+
+# Sub-millisecond (cache hits, small searches) up to the slowest CPU generations
+_STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Time spent in each stage of a chat request",
+    ["stage"],
+    buckets=_STAGE_BUCKETS
+)
+PROMPT_TOKENS = Counter("chat_prompt_tokens_total", "Prompt tokens fed to the model")
+GENERATED_TOKENS = Counter("chat_generated_tokens_total", "Tokens generated by the model")
+TOKENS_PER_SECOND = Histogram(
+    "chat_generation_tokens_per_second",
+    "Decode throughput of each generate call",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+IN_FLIGHT = Gauge(
+    "chat_requests_in_flight",
+    "Chat requests currently being processed",
+    multiprocess_mode="livesum"
+)
+
+# Label children resolved once so timing a stage is a dict lookup plus two clock reads
+_stage_timers = {name: STAGE_SECONDS.labels(stage=name) for name in STAGES}
+
+# Registered stats collectors, re-added to the per-scrape registry in multiprocess mode
+_stats_collectors: List["StatsCollector"] = []
+
+# Set only while a request is being profiled (see app.profiling); wraps the stage timers
+_stage_observer: Optional[Callable] = None
+
+def stage(name: str):
+    """
+    Context manager timing one request stage
+
+    Example:
+        with stage("search"):
+            results = backend.query(...)
+    """
+    timer = _stage_timers[name].time()
+    if _stage_observer is not None:
+        return _stage_observer(name, timer)
+    return timer
+
+def observe_stages(observer: Optional[Callable]):
+    """
+    Route stage() through observer(name, timer), which returns the context manager to use
+
+    Pass None to restore plain timers.
+    """
+    global _stage_observer
+    _stage_observer = observer
+
+def record_generation(prompt_tokens: int, generated_tokens: int, seconds: float):
+    """Count the tokens of one generate call and its throughput"""
+    PROMPT_TOKENS.inc(prompt_tokens)
+    GENERATED_TOKENS.inc(generated_tokens)
+    if seconds > 0 and generated_tokens:
+        TOKENS_PER_SECOND.observe(generated_tokens / seconds)
+
+class StatsCollector:
+    """
+    Exposes runtime statistics (ingestion backlog, cache hit rates, ...) as gauges
+
+    The stats provider is only called when /metrics is scraped, so nothing is
+    recorded on the request path.
+    """
+
+    def __init__(self, provider: Callable[[], Dict]):
+        self.provider = provider
+
+    def collect(self):
+        stats = self.provider()
+        if not stats:
+            return
+
+        ingestion = stats.get("ingestion", {})
+        yield GaugeMetricFamily("chat_ingestion_backlog", "Teach items not yet stored", value=ingestion.get("backlog", 0))
+
+        hit_rate = GaugeMetricFamily("chat_cache_hit_rate", "Cache hit rate since startup", labels=["cache"])
+        size = GaugeMetricFamily("chat_cache_entries", "Entries in each cache", labels=["cache"])
+        for name in ("embedding_cache", "response_cache"):
+            cache = stats.get(name) or {}
+            if "hit_rate" in cache:
+                hit_rate.add_metric([name], cache["hit_rate"])
+                size.add_metric([name], cache.get("size", 0))
+        yield hit_rate
+        yield size
+
+        inference = stats.get("inference", {})
+        for key, description in (("queued", "Requests waiting for an inference slot"),
+                                 ("running", "Requests holding an inference slot")):
+            if key in inference:
+                yield GaugeMetricFamily(f"chat_inference_{key}", description, value=inference[key])
+
+def register_stats(provider: Callable[[], Dict]):
+    """Expose the stats returned by provider() on /metrics"""
+    collector = StatsCollector(provider)
+    REGISTRY.register(collector)
+    _stats_collectors.append(collector)
+
+def render() -> tuple:
+    """
+    Current metrics in the Prometheus text format
+
+    With PROMETHEUS_MULTIPROC_DIR set (pre-fork workers), samples from all
+    worker processes are aggregated; the runtime stats gauges come from the
+    worker answering the scrape.
+
+    Returns:
+        (body, content type)
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in _stats_collectors:
+            registry.register(collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
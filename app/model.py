@@ -1,20 +1,82 @@
 """
 Phi-2 model loading and inference
-Uses 4-bit quantization to fit in 4GB RAM
+Backends: 4-bit bitsandbytes (GPU), fp32 or dynamic int8 PyTorch (CPU), ONNX Runtime
 """
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+import transformers
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig,
+    StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+)
 import logging
-from app.config import MODEL_NAME, MODEL_CACHE_DIR, MAX_NEW_TOKENS, TEMPERATURE, TOP_P, TOP_K
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional, Union
+from app.config import (
+    MODEL_NAME, MODEL_CACHE_DIR, MAX_NEW_TOKENS, TEMPERATURE, TOP_P, TOP_K, STREAM_TOKEN_TIMEOUT, MAX_RESPONSE_CHARS,
+    INFERENCE_BACKEND, INFERENCE_BACKENDS, MODEL_SNAPSHOT, MODEL_SNAPSHOT_DIR,
+    SPECULATIVE_DRAFT_MODEL, SPECULATIVE_DRAFT_TOKENS, SPECULATIVE_BASELINE_EVERY
+)
+from app.postprocess import clean_response, find_response_end, stop_strings_for, IncrementalCleaner
+from app.context import build_prompt_ids, get_tokenizer
+from app.metrics import stage, record_generation
 
 logger = logging.getLogger(__name__)
 
+# Prefix of the text returned when generation fails (such responses must not be cached)
+GENERATION_ERROR_PREFIX = "Error generating response"
+
+# Backends whose loaded model is a plain torch module that can be snapshotted
+SNAPSHOT_BACKENDS = ("torch-fp32", "torch-int8")
+
+def resolve_inference_backend(name: str = INFERENCE_BACKEND) -> str:
+    """Pick the concrete backend for "auto": 4-bit bitsandbytes on GPU, dynamic int8 on CPU"""
+    if name == "auto":
+        return "bnb-4bit" if torch.cuda.is_available() else "torch-int8"
+    if name not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend: {name} (expected one of {', '.join(INFERENCE_BACKENDS)})")
+    return name
+
+def tokenizers_compatible(target, draft) -> bool:
+    """Whether a draft model's tokens mean the same thing to the target (same vocabulary and EOS)"""
+    return target.get_vocab() == draft.get_vocab() and target.eos_token_id == draft.eos_token_id
+
+def _conv1d_to_linear(module: torch.nn.Module):
+    """
+    Replace GPT-2 style Conv1D layers with equivalent nn.Linear layers
+
+    Dynamic quantization only targets nn.Linear; Conv1D stores the transposed weight.
+    """
+    from transformers.pytorch_utils import Conv1D
+
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+def quantize_dynamic_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamic int8 quantization of the Linear layers (weights int8, activations quantized on the fly)"""
+    logger.info("Applying dynamic int8 quantization to Linear layers...")
+    _conv1d_to_linear(model)
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8).eval()
+
 class Phi2Model:
-    """Phi-2 model with 4-bit quantization for memory efficiency"""
+    """Causal LM wrapper with selectable CPU/GPU inference backends"""
 
     _instance = None
     _model = None
     _tokenizer = None
+    _draft_model = None
+    speculative = None  # SpeculativeStats when a draft model is loaded
+    backend = None
+    load_timings = {}  # Seconds per load phase
 
     def __new__(cls):
         if cls._instance is None:
@@ -26,52 +88,238 @@ class Phi2Model:
             self.load_model()
 
     def load_model(self):
-        """Load Phi-2 model with 4-bit quantization"""
+        """Load the tokenizer and the model for the configured inference backend"""
         try:
-            logger.info(f"Loading model: {MODEL_NAME}")
-            logger.info("Using 4-bit quantization for memory efficiency...")
-
-            # Configure 4-bit quantization
-            quantization_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_compute_dtype=torch.float16,
-                bnb_4bit_use_double_quant=True,
-                bnb_4bit_quant_type="nf4"
-            )
+            self.backend = resolve_inference_backend()
+            self.load_timings = {}
+            logger.info(f"Loading model: {MODEL_NAME} (backend: {self.backend})")
 
             cache_dir = str(MODEL_CACHE_DIR)
 
             # Load tokenizer
             logger.info("Loading tokenizer...")
-            self._tokenizer = AutoTokenizer.from_pretrained(
-                MODEL_NAME,
-                cache_dir=cache_dir,
-                force_download=False  # Set to True to force re-download if corrupted
-            )
+            started = time.monotonic()
+            self._tokenizer = get_tokenizer()  # Shared with context packing and knowledge storage
 
             # Add padding token if missing
             if self._tokenizer.pad_token is None:
                 self._tokenizer.pad_token = self._tokenizer.eos_token
 
-            # Load model with quantization (GPT-2 works great with 4-bit)
-            logger.info("Loading model (this may take a minute)...")
-            self._model = AutoModelForCausalLM.from_pretrained(
-                MODEL_NAME,
-                quantization_config=quantization_config,
-                device_map="auto",
-                cache_dir=cache_dir,
-                torch_dtype=torch.float16,
-                force_download=False  # Set to True to force re-download if corrupted
-            )
+            # Decoder-only models must be left-padded for batched generation
+            self._tokenizer.padding_side = "left"
+            self.load_timings["tokenizer"] = time.monotonic() - started
 
-            logger.info("Model loaded successfully!")
+            logger.info("Loading model (this may take a minute)...")
+            started = time.monotonic()
+            self._model = self._load_snapshot()
+            if self._model is not None:
+                self.load_timings["snapshot"] = time.monotonic() - started
+            elif self.backend == "bnb-4bit":
+                self._model = self._load_bnb_4bit(cache_dir)
+                self.load_timings["weights"] = time.monotonic() - started
+            elif self.backend == "torch-fp32":
+                self._model = self._load_torch(cache_dir)
+                self.load_timings["weights"] = time.monotonic() - started
+            elif self.backend == "torch-int8":
+                model = self._load_torch(cache_dir)
+                self.load_timings["weights"] = time.monotonic() - started
+                started = time.monotonic()
+                self._model = quantize_dynamic_int8(model)
+                self.load_timings["quantize"] = time.monotonic() - started
+            elif self.backend == "onnx":
+                self._model = self._load_onnx(cache_dir)
+                self.load_timings["weights"] = time.monotonic() - started
+
+            if "snapshot" not in self.load_timings:
+                self._save_snapshot()
+
+            if SPECULATIVE_DRAFT_MODEL:
+                started = time.monotonic()
+                self._load_draft_model(cache_dir)
+                self.load_timings["draft_model"] = time.monotonic() - started
+
+            timings = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.load_timings.items())
+            logger.info(f"Model loaded successfully! ({timings})")
 
         except Exception as e:
             logger.error(f"Error loading model: {e}")
             raise
 
+    def _load_draft_model(self, cache_dir: str):
+        """
+        Load the speculative decoding draft model (SPECULATIVE_DRAFT_MODEL)
+
+        Leaves speculative decoding off, with a warning, when the backend cannot use
+        an assistant model or the draft tokenizer does not match the target's.
+        """
+        self._draft_model = None
+        self.speculative = None
+        if self.backend == "onnx":
+            logger.warning("Speculative decoding disabled: not supported with the onnx backend")
+            return
+
+        try:
+            draft_tokenizer = AutoTokenizer.from_pretrained(SPECULATIVE_DRAFT_MODEL, cache_dir=cache_dir)
+            if not tokenizers_compatible(self._tokenizer, draft_tokenizer):
+                logger.warning(
+                    f"Speculative decoding disabled: {SPECULATIVE_DRAFT_MODEL} tokenizer "
+                    f"is incompatible with {MODEL_NAME}"
+                )
+                return
+
+            logger.info(f"Loading draft model for speculative decoding: {SPECULATIVE_DRAFT_MODEL}")
+            if self.backend == "bnb-4bit":
+                draft = AutoModelForCausalLM.from_pretrained(
+                    SPECULATIVE_DRAFT_MODEL,
+                    cache_dir=cache_dir,
+                    torch_dtype=torch.float16
+                ).to(self._model.device).eval()
+            else:
+                draft = self._load_torch(cache_dir, SPECULATIVE_DRAFT_MODEL)
+                if self.backend == "torch-int8":
+                    draft = quantize_dynamic_int8(draft)
+
+            # Fixed draft length per verification step
+            draft.generation_config.num_assistant_tokens = SPECULATIVE_DRAFT_TOKENS
+            draft.generation_config.num_assistant_tokens_schedule = "constant"
+
+            self._draft_model = draft
+            self.speculative = SpeculativeStats(draft, self._model)
+        except Exception as e:
+            logger.error(f"Speculative decoding disabled: could not load {SPECULATIVE_DRAFT_MODEL}: {e}")
+
+    def speculative_stats(self) -> dict:
+        """Acceptance rate and measured speedup of speculative decoding"""
+        if self.speculative is None:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "draft_model": SPECULATIVE_DRAFT_MODEL,
+            "draft_tokens": SPECULATIVE_DRAFT_TOKENS,
+            **self.speculative.stats()
+        }
+
+    def _snapshot_path(self) -> Optional[Path]:
+        """
+        Snapshot file for the current backend, or None when snapshots are off
+
+        The name includes the torch/transformers versions because the snapshot is a
+        pickled module and only loads back into the same library versions.
+        """
+        if not MODEL_SNAPSHOT or self.backend not in SNAPSHOT_BACKENDS:
+            return None
+        name = f"{MODEL_NAME.replace('/', '--')}-{self.backend}-torch{torch.__version__}-transformers{transformers.__version__}.pt"
+        return MODEL_SNAPSHOT_DIR / name
+
+    def _load_snapshot(self):
+        """Load the already-quantized model from its snapshot (None if there is none)"""
+        path = self._snapshot_path()
+        if path is None or not path.exists():
+            return None
+        try:
+            logger.info(f"Loading model snapshot: {path.name}")
+            return torch.load(path, map_location="cpu").eval()
+        except Exception as e:
+            logger.error(f"Error loading model snapshot (falling back to a full load): {e}")
+            return None
+
+    def _save_snapshot(self):
+        """Write the loaded model to its snapshot file for faster reloads"""
+        path = self._snapshot_path()
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            torch.save(self._model, tmp_path)
+            os.replace(tmp_path, path)
+            logger.info(f"Saved model snapshot: {path.name}")
+        except Exception as e:
+            logger.error(f"Error saving model snapshot: {e}")
+
+    def _load_bnb_4bit(self, cache_dir: str):
+        """bitsandbytes 4-bit quantization (GPU-oriented)"""
+        logger.info("Using 4-bit quantization for memory efficiency...")
+
+        # Configure 4-bit quantization
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4"
+        )
+
+        # Load model with quantization (GPT-2 works great with 4-bit)
+        return AutoModelForCausalLM.from_pretrained(
+            MODEL_NAME,
+            quantization_config=quantization_config,
+            device_map="auto",
+            cache_dir=cache_dir,
+            torch_dtype=torch.float16,
+            force_download=False  # Set to True to force re-download if corrupted
+        )
+
+    def _load_torch(self, cache_dir: str, model_name: str = MODEL_NAME):
+        """Plain fp32 PyTorch model (CPU)"""
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            cache_dir=cache_dir,
+            torch_dtype=torch.float32,
+            force_download=False
+        )
+        return model.eval()
+
+    def _load_onnx(self, cache_dir: str):
+        """ONNX Runtime model with KV cache, exported once and reused from the model cache"""
+        try:
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError:
+            raise RuntimeError("INFERENCE_BACKEND=onnx requires optimum[onnxruntime] (see requirements.txt)")
+
+        onnx_dir = MODEL_CACHE_DIR / "onnx" / MODEL_NAME.replace("/", "--")
+        if (onnx_dir / "config.json").exists():
+            return ORTModelForCausalLM.from_pretrained(str(onnx_dir), use_cache=True, use_io_binding=False)
+
+        logger.info("Exporting model to ONNX (first run only)...")
+        model = ORTModelForCausalLM.from_pretrained(
+            MODEL_NAME,
+            export=True,
+            use_cache=True,
+            use_io_binding=False,
+            cache_dir=cache_dir
+        )
+        model.save_pretrained(str(onnx_dir))
+        return model
+
+    def _prompt_inputs(self, rows: List[List[int]]) -> dict:
+        """Left-padded input_ids/attention_mask tensors for prompt token ids"""
+        length = max(len(row) for row in rows)
+        input_ids = torch.full((len(rows), length), self._tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), length), dtype=torch.long)
+        for i, row in enumerate(rows):
+            if row:
+                input_ids[i, length - len(row):] = torch.tensor(row, dtype=torch.long)
+                attention_mask[i, length - len(row):] = 1
+        device = self._model.device
+        return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
+
+    def _generation_kwargs(self, max_tokens: int) -> dict:
+        """Sampling parameters shared by single and batched generation (optimized for speed on CPU)"""
+        return dict(
+            max_new_tokens=min(max_tokens, 25),  # Even shorter for speed (3-8 seconds)
+            temperature=0.7,  # Lower for more consistent, shorter responses
+            top_p=0.85,
+            top_k=25,
+            do_sample=True,
+            pad_token_id=self._tokenizer.pad_token_id,
+            eos_token_id=self._tokenizer.eos_token_id,
+            repetition_penalty=1.4,  # Strong penalty to prevent repetition
+            no_repeat_ngram_size=3  # Prevent phrase repetition
+        )
+
     def generate(self, prompt: str, max_tokens: int = MAX_NEW_TOKENS,
-                 temperature: float = TEMPERATURE, context: str = "") -> str:
+                 temperature: float = TEMPERATURE, context: Union[str, List[int]] = "",
+                 stop: Optional[List[str]] = None) -> str:
         """
         Generate text from prompt
 
@@ -79,120 +327,383 @@ class Phi2Model:
             prompt: Input prompt
             max_tokens: Maximum tokens to generate
             temperature: Sampling temperature
-            context: Additional context (e.g., retrieved knowledge)
+            context: Retrieved knowledge, as packed token ids (see app.context.pack_context) or text
+            stop: Extra stop strings (the dialogue labels always stop generation)
 
         Returns:
             Generated text
         """
+        return self.generate_batch([prompt], max_tokens=max_tokens, contexts=[context], stop=stop)[0]
+
+    def generate_batch(self, prompts: List[str], max_tokens: int = MAX_NEW_TOKENS,
+                       contexts: Optional[List[Union[str, List[int]]]] = None,
+                       stop: Optional[List[str]] = None,
+                       prompt_ids: Optional[List[List[int]]] = None) -> List[str]:
+        """
+        Generate responses for several prompts in one left-padded forward pass
+
+        Decoding stops as soon as every row has reached its first sentence end, a
+        stop string or the character budget, instead of always running max_tokens.
+
+        Args:
+            prompts: Input prompts
+            max_tokens: Maximum tokens to generate (shared by the whole batch)
+            contexts: Optional per-prompt context, aligned with prompts
+            stop: Extra stop strings (the dialogue labels always stop generation)
+            prompt_ids: Model prompt token ids already built for each prompt (see
+                encode_prompt); contexts are ignored when given
+
+        Returns:
+            Generated text for each prompt, in the same order
+        """
         if self._model is None or self._tokenizer is None:
             self.load_model()
 
+        contexts = contexts or [""] * len(prompts)
+
         try:
-            # Minimal prompt - GPT-2 works better with simple text continuation
-            # Just complete the user's message naturally
-            if context:
-                # Include context but keep it minimal
-                full_prompt = f"{prompt}"
-            else:
-                full_prompt = prompt
-
-            # Add minimal context hint only if we have learned knowledge
-            if context:
-                # Very subtle context inclusion
-                full_prompt = f"{prompt}"
-
-            # Tokenize - keep prompt short for faster generation
-            inputs = self._tokenizer(
-                full_prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=512  # Shorter input = faster processing
-            ).to(self._model.device)
-
-            # Generate (optimized for speed on CPU)
-            with torch.no_grad():
+            # Prompts are at most MAX_PROMPT_TOKENS (left padding keeps every prompt
+            # adjacent to its generated tokens)
+            with stage("tokenize"):
+                if prompt_ids is None:
+                    prompt_ids = [self.encode_prompt(p, c) for p, c in zip(prompts, contexts)]
+                inputs = self._prompt_inputs(prompt_ids)
+
+            prompt_length = inputs['input_ids'].shape[1]
+            stopper = _ResponseStopCriteria(self._tokenizer, prompt_length, stop_strings_for(stop))
+            kwargs = self._generation_kwargs(max_tokens)
+            kwargs["stopping_criteria"] = StoppingCriteriaList([stopper])
+            # Assisted generation only supports a batch of one; a sample of those runs
+            # without the draft so the speedup can be measured
+            measured = self.speculative is not None and len(prompts) == 1
+            assisted = measured and self.speculative.use_draft()
+            if assisted:
+                kwargs["assistant_model"] = self._draft_model
+
+            if measured:
+                self.speculative.begin()
+            started = time.perf_counter()
+            with stage("generate"), torch.no_grad():
+                outputs = self._model.generate(**inputs, **kwargs)
+            elapsed = time.perf_counter() - started
+
+            if measured:
+                self.speculative.record(assisted, outputs.shape[1] - prompt_length, elapsed)
+            new_tokens = outputs[:, prompt_length:]
+            record_generation(
+                int(inputs['attention_mask'].sum()),
+                int((new_tokens != self._tokenizer.pad_token_id).sum()),
+                elapsed
+            )
+
+            with stage("postprocess"):
+                # Decode only the new tokens of each row, cut where the row's response ended
+                generated = self._tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+                generated = [
+                    text if end is None else text[:end]
+                    for text, end in zip(generated, stopper.ends(len(generated)))
+                ]
+                return [clean_response(p, text) for p, text in zip(prompts, generated)]
+
+        except Exception as e:
+            logger.error(f"Error during generation: {e}")
+            return [f"{GENERATION_ERROR_PREFIX}: {str(e)}"] * len(prompts)
+
+    def encode_text(self, text: str) -> List[int]:
+        """Token ids for text, without special tokens"""
+        return self._tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def encode_prompt(self, prompt: str, context: Union[str, List[int]] = "") -> List[int]:
+        """
+        Token ids of the model prompt for a user message (at most MAX_PROMPT_TOKENS)
+
+        Args:
+            prompt: User message
+            context: Retrieved knowledge, as packed token ids (see app.context.pack_context) or text
+        """
+        context_ids = self.encode_text(context) if isinstance(context, str) and context else list(context or [])
+        return build_prompt_ids(self.encode_text(prompt), context_ids)
+
+    def generate_with_history(self, prompt_ids: List[int], prompt: str, max_tokens: int = MAX_NEW_TOKENS,
+                              stop: Optional[List[str]] = None, past_ids: Optional[List[int]] = None,
+                              past_key_values=None) -> dict:
+        """
+        Generate the next turn of a conversation, reusing the key/value cache of earlier turns
+
+        Only the prompt tokens not covered by the cache are prefilled.
+
+        Args:
+            prompt_ids: Token ids of the conversation so far, ending with the new user message
+            prompt: The new user message (for response cleanup)
+            max_tokens: Maximum tokens to generate
+            stop: Extra stop strings
+            past_ids: Token ids covered by past_key_values
+            past_key_values: Cache from an earlier turn (ignored unless past_ids is a prefix of the prompt)
+
+        Returns:
+            {"response", "cache_ids", "cache"}: the cleaned response and the cache covering
+            all prompt tokens but the last (None when the backend cannot reuse caches)
+        """
+        if self._model is None or self._tokenizer is None:
+            self.load_model()
+
+        try:
+            prefix = prompt_ids[:-1]
+            cache, cache_ids = None, []
+            reuse = self.backend != "onnx"  # ORT sessions manage their own cache layout
+            if reuse and past_key_values is not None and past_ids and prefix[:len(past_ids)] == list(past_ids):
+                cache, cache_ids = past_key_values, list(past_ids)
+            reused = len(cache_ids)
+            if reuse and len(prefix) > len(cache_ids):
+                cache = self.extend_cache(cache_ids, cache, prefix)
+                cache_ids = prefix
+
+            input_ids = torch.tensor([prompt_ids], device=self._model.device)
+            stopper = _ResponseStopCriteria(self._tokenizer, len(prompt_ids), stop_strings_for(stop))
+            started = time.perf_counter()
+            with stage("generate"), torch.no_grad():
                 outputs = self._model.generate(
-                    **inputs,
-                    max_new_tokens=min(max_tokens, 25),  # Even shorter for speed (3-8 seconds)
-                    temperature=0.7,  # Lower for more consistent, shorter responses
-                    top_p=0.85,
-                    top_k=25,
-                    do_sample=True,
-                    pad_token_id=self._tokenizer.eos_token_id,
-                    eos_token_id=self._tokenizer.eos_token_id,
-                    repetition_penalty=1.4,  # Strong penalty to prevent repetition
-                    no_repeat_ngram_size=3  # Prevent phrase repetition
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    past_key_values=cache,
+                    stopping_criteria=StoppingCriteriaList([stopper]),
+                    **self._generation_kwargs(max_tokens)
                 )
-
-            # Decode
-            generated_text = self._tokenizer.decode(
-                outputs[0][inputs['input_ids'].shape[1]:],
-                skip_special_tokens=True
+            new_tokens = outputs[0, len(prompt_ids):]
+            # Prompt tokens count only what was actually prefilled
+            record_generation(
+                len(prompt_ids) - reused,
+                int((new_tokens != self._tokenizer.pad_token_id).sum()),
+                time.perf_counter() - started
             )
 
-            # Clean up and format response
-            cleaned = generated_text.strip()
-
-            # Remove the original prompt if it appears in response
-            if prompt.lower() in cleaned.lower() and len(cleaned) > len(prompt) + 10:
-                # Only remove if there's additional text
-                cleaned = cleaned.replace(prompt, "").strip()
-
-            # Remove unwanted phrases that reveal learning
-            unwanted_phrases = [
-                "I know", "I understand", "I learned", "I remember",
-                "Based on", "According to", "From what", "As I recall"
-            ]
-            for phrase in unwanted_phrases:
-                if phrase.lower() in cleaned.lower():
-                    # Try to remove just the phrase
-                    import re
-                    cleaned = re.sub(rf'\b{re.escape(phrase)}\b', '', cleaned, flags=re.IGNORECASE).strip()
-
-            # Remove any label patterns
-            for label in ["User:", "Human:", "Assistant:", "Question:", "Answer:", "Response:", "Q:", "A:"]:
-                if label in cleaned:
-                    parts = cleaned.split(label)
-                    if len(parts) > 1:
-                        cleaned = parts[-1].strip()  # Take last part
-                    else:
-                        cleaned = cleaned.replace(label, "").strip()
-
-            # Remove Human: and Assistant: if they appear (from few-shot examples)
-            if cleaned.startswith("Assistant:"):
-                cleaned = cleaned[10:].strip()
-            if "Human:" in cleaned:
-                cleaned = cleaned.split("Human:")[0].strip()
-
-            # Clean whitespace
-            cleaned = " ".join(cleaned.split())
-
-            # Get first complete sentence or limit to 60 chars (shorter = faster to read)
-            if len(cleaned) > 60:
-                for sep in ['. ', '! ', '? ', '\n']:
-                    if sep in cleaned:
-                        first_part = cleaned.split(sep)[0].strip()
-                        if len(first_part) > 8:  # Only if meaningful
-                            cleaned = first_part + (sep.strip() if sep != '\n' else '.')
-                            break
-                else:
-                    cleaned = cleaned[:60].strip()
-                    if not cleaned.endswith(('.', '!', '?')):
-                        cleaned += "."
-
-            # Fallback responses for common greetings
-            if not cleaned or len(cleaned) < 5:
-                prompt_lower = prompt.lower()
-                if any(word in prompt_lower for word in ["hi", "hello", "hey"]):
-                    cleaned = "Hello!"
-                elif "?" in prompt:
-                    cleaned = "I can help with that."
-                else:
-                    cleaned = "I'm here to help."
-
-            return cleaned
+            with stage("postprocess"):
+                text = self._tokenizer.decode(new_tokens, skip_special_tokens=True)
+                end = stopper.ends(1)[0]
+                if end is not None:
+                    text = text[:end]
+                return {"response": clean_response(prompt, text), "cache_ids": cache_ids, "cache": cache}
 
         except Exception as e:
             logger.error(f"Error during generation: {e}")
-            return f"Error generating response: {str(e)}"
+            return {"response": f"{GENERATION_ERROR_PREFIX}: {str(e)}", "cache_ids": [], "cache": None}
+
+    def extend_cache(self, past_ids: List[int], past_key_values, token_ids: List[int]):
+        """
+        Key/value cache covering token_ids, computed by prefilling only what past_ids lacks
+
+        Args:
+            past_ids: Token ids covered by past_key_values
+            past_key_values: Existing cache (None to start from scratch)
+            token_ids: Token ids the new cache should cover
+
+        Returns:
+            The extended past_key_values
+        """
+        if past_key_values is None or list(token_ids[:len(past_ids)]) != list(past_ids):
+            past_key_values, past_ids = None, []
+        new_ids = token_ids[len(past_ids):]
+        if not new_ids:
+            return past_key_values
+        with torch.no_grad():
+            outputs = self._model(
+                input_ids=torch.tensor([new_ids], device=self._model.device),
+                past_key_values=past_key_values,
+                use_cache=True
+            )
+        return outputs.past_key_values
 
+    def stream(self, prompt: str, max_tokens: int = MAX_NEW_TOKENS, context: Union[str, List[int]] = "",
+               cancel_event: Optional[threading.Event] = None,
+               stop: Optional[List[str]] = None) -> Iterator[str]:
+        """
+        Stream a cleaned response while it is being decoded
+
+        Generation runs on a worker thread feeding a TextIteratorStreamer; the
+        label/phrase cleanup is applied incrementally to the decoded text.
+
+        Args:
+            prompt: Input prompt
+            max_tokens: Maximum tokens to generate
+            context: Retrieved knowledge, as packed token ids (see app.context.pack_context) or text
+            cancel_event: Optional event that stops generation when set (e.g. client disconnected)
+            stop: Extra stop strings (the dialogue labels always stop generation)
+
+        Yields:
+            Cleaned text fragments
+        """
+        if self._model is None or self._tokenizer is None:
+            self.load_model()
+
+        cancel_event = cancel_event or threading.Event()
+        stop_strings = stop_strings_for(stop)
+        cleaner = IncrementalCleaner(prompt, stop_strings=stop_strings)
+
+        with stage("tokenize"):
+            inputs = self._prompt_inputs([self.encode_prompt(prompt, context)])
+
+        streamer = TextIteratorStreamer(
+            self._tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=STREAM_TOKEN_TIMEOUT
+        )
+
+        def run_generation():
+            try:
+                started = time.perf_counter()
+                with stage("generate"), torch.no_grad():
+                    outputs = self._model.generate(
+                        **inputs,
+                        **self._generation_kwargs(max_tokens),
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([
+                            _CancelCriteria(cancel_event),
+                            _ResponseStopCriteria(self._tokenizer, inputs['input_ids'].shape[1], stop_strings)
+                        ])
+                    )
+                record_generation(
+                    inputs['input_ids'].shape[1],
+                    outputs.shape[1] - inputs['input_ids'].shape[1],
+                    time.perf_counter() - started
+                )
+            except Exception as e:
+                logger.error(f"Error during streaming generation: {e}")
+                streamer.end()
+
+        worker = threading.Thread(target=run_generation, name="stream-generate", daemon=True)
+        worker.start()
+
+        try:
+            for text in streamer:
+                piece = cleaner.feed(text)
+                if piece:
+                    yield piece
+                if cleaner.done:
+                    break
+            tail = cleaner.finish()
+            if tail:
+                yield tail
+        finally:
+            # Stop decoding as soon as the consumer is done with the stream
+            cancel_event.set()
+
+class _CancelCriteria(StoppingCriteria):
+    """Stops generation once the stream consumer has gone away"""
+
+    def __init__(self, cancel_event: threading.Event):
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.cancel_event.is_set()
+
+class _ResponseStopCriteria(StoppingCriteria):
+    """
+    Stops decoding once every row's response is complete (see find_response_end)
+
+    Checked after each decode step on the text decoded so far. Rows that emitted
+    EOS count as complete. Until the whole batch is done, finished rows keep
+    decoding, and ends() tells where to cut each row's text.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, stop_strings: List[str],
+                 max_chars: int = MAX_RESPONSE_CHARS):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_strings = stop_strings
+        self.max_chars = max_chars
+        self._ends = {}  # Row -> cut offset (None for rows ended by EOS)
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        eos_token_id = self.tokenizer.eos_token_id
+        for row in range(input_ids.shape[0]):
+            if row in self._ends:
+                continue
+            tokens = input_ids[row, self.prompt_length:]
+            if len(tokens) and int(tokens[-1]) == eos_token_id:
+                self._ends[row] = None
+                continue
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            end = find_response_end(text, self.stop_strings, self.max_chars)
+            if end is not None:
+                self._ends[row] = end
+        return len(self._ends) == input_ids.shape[0]
+
+    def ends(self, rows: int) -> List[Optional[int]]:
+        """Cut offset for each row's decoded text (None = keep everything)"""
+        return [self._ends.get(row) for row in range(rows)]
+
+class SpeculativeStats:
+    """
+    Acceptance rate and speedup of assisted generation
+
+    Forward hooks count draft and target model calls for the generation running
+    on the current thread. Each draft call proposes one token and each target call
+    verifies a run of them, adding one token of its own, so
+    accepted = new tokens - target calls.
+    """
+
+    def __init__(self, draft_model, target_model):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._single_generations = 0
+        self.reset()
+        draft_model.register_forward_hook(self._counter("draft"))
+        target_model.register_forward_hook(self._counter("target"))
+
+    def reset(self):
+        """Zero the counters"""
+        self.generations = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.verifications = 0
+        self.assisted_tokens = 0
+        self.assisted_seconds = 0.0
+        self.baseline_tokens = 0
+        self.baseline_seconds = 0.0
+
+    def _counter(self, key: str):
+        def hook(module, inputs, output):
+            counts = getattr(self._local, "counts", None)
+            if counts is not None:
+                counts[key] += 1
+        return hook
+
+    def use_draft(self) -> bool:
+        """False for every SPECULATIVE_BASELINE_EVERY-th generation, which measures the baseline"""
+        with self._lock:
+            self._single_generations += 1
+            return SPECULATIVE_BASELINE_EVERY <= 0 or self._single_generations % SPECULATIVE_BASELINE_EVERY != 0
+
+    def begin(self):
+        """Start counting model calls for a generation on this thread"""
+        self._local.counts = {"draft": 0, "target": 0}
+
+    def record(self, assisted: bool, new_tokens: int, seconds: float):
+        """Finish a generation started with begin()"""
+        counts = self._local.counts
+        self._local.counts = None
+        with self._lock:
+            if assisted:
+                self.generations += 1
+                self.proposed += counts["draft"]
+                self.accepted += max(0, new_tokens - counts["target"])
+                self.verifications += counts["target"]
+                self.assisted_tokens += new_tokens
+                self.assisted_seconds += seconds
+            else:
+                self.baseline_tokens += new_tokens
+                self.baseline_seconds += seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            assisted_ms = 1000 * self.assisted_seconds / self.assisted_tokens if self.assisted_tokens else None
+            baseline_ms = 1000 * self.baseline_seconds / self.baseline_tokens if self.baseline_tokens else None
+            return {
+                "generations": self.generations,
+                "acceptance_rate": self.accepted / self.proposed if self.proposed else 0.0,
+                "tokens_per_verification": self.assisted_tokens / self.verifications if self.verifications else 0.0,
+                "assisted_ms_per_token": assisted_ms,
+                "baseline_ms_per_token": baseline_ms,
+                "speedup": baseline_ms / assisted_ms if assisted_ms and baseline_ms else None
+            }
@@ -0,0 +1,263 @@
+"""
+Response post-processing
+Cleans decoded model output, either all at once or incrementally while streaming
+"""
+import re
+from typing import List, Optional, Sequence
+from app.config import MAX_RESPONSE_CHARS
+
+# Phrases that reveal the model is using learned knowledge
+UNWANTED_PHRASES = [
+    "I know", "I understand", "I learned", "I remember",
+    "Based on", "According to", "From what", "As I recall"
+]
+
+# Dialogue labels the model tends to hallucinate
+RESPONSE_LABELS = ["User:", "Human:", "Assistant:", "Question:", "Answer:", "Response:", "Q:", "A:"]
+
+def fallback_response(prompt: str) -> str:
+    """Fallback responses for common greetings when nothing useful was generated"""
+    prompt_lower = prompt.lower()
+    if any(word in prompt_lower for word in ["hi", "hello", "hey"]):
+        return "Hello!"
+    elif "?" in prompt:
+        return "I can help with that."
+    return "I'm here to help."
+
+def stop_strings_for(extra: Optional[Sequence[str]] = None) -> List[str]:
+    """The built-in dialogue labels plus any per-request stop strings"""
+    stops = list(RESPONSE_LABELS)
+    for stop in extra or []:
+        if stop and stop not in stops:
+            stops.append(stop)
+    return stops
+
+_UNWANTED_PATTERN = re.compile(
+    r'\b(?:' + "|".join(re.escape(phrase) for phrase in UNWANTED_PHRASES) + r')\b',
+    re.IGNORECASE
+)
+
+def find_response_end(text: str, stop_strings: Sequence[str] = RESPONSE_LABELS,
+                      max_chars: int = MAX_RESPONSE_CHARS) -> Optional[int]:
+    """
+    Where a partially decoded response is complete, by the same rules clean_response
+    and IncrementalCleaner use to cut it
+
+    The response ends at a stop string following real content (leading ones are
+    skipped), at the end of the first sentence longer than 8 characters, or once
+    more than max_chars of visible text exist.
+
+    Args:
+        text: Decoded new tokens so far
+        stop_strings: Labels/stop strings that end the response
+        max_chars: Character budget
+
+    Returns:
+        Offset in text to cut at (keep text[:offset]), or None to keep decoding
+    """
+    # Skip leading whitespace and labels
+    start = 0
+    while True:
+        while start < len(text) and text[start].isspace():
+            start += 1
+        label = next((stop for stop in stop_strings if text.startswith(stop, start)), None)
+        if label is None:
+            break
+        start += len(label)
+
+    ends = []
+    for stop in stop_strings:
+        index = text.find(stop, start)
+        if index > start and text[start:index].strip():
+            ends.append(index)
+
+    # A terminator only ends a sentence once the following whitespace has been decoded
+    for match in re.finditer(r'[.!?](?=\s)|\n', text[start:]):
+        if len(text[start:start + match.start()].strip()) > 8:
+            ends.append(start + match.end())
+            break
+
+    if ends:
+        return min(ends)
+
+    visible = " ".join(_UNWANTED_PATTERN.sub("", text[start:]).split())
+    if len(visible) > max_chars:
+        return len(text)
+    return None
+
+def clean_response(prompt: str, generated_text: str) -> str:
+    """
+    Clean up and format a decoded response
+
+    Args:
+        prompt: The user's prompt
+        generated_text: Decoded model output (new tokens only)
+
+    Returns:
+        Cleaned response text
+    """
+    cleaned = generated_text.strip()
+
+    # Remove the original prompt if it appears in response
+    if prompt.lower() in cleaned.lower() and len(cleaned) > len(prompt) + 10:
+        # Only remove if there's additional text
+        cleaned = cleaned.replace(prompt, "").strip()
+
+    # Remove unwanted phrases that reveal learning
+    for phrase in UNWANTED_PHRASES:
+        if phrase.lower() in cleaned.lower():
+            # Try to remove just the phrase
+            cleaned = re.sub(rf'\b{re.escape(phrase)}\b', '', cleaned, flags=re.IGNORECASE).strip()
+
+    # Remove any label patterns
+    for label in RESPONSE_LABELS:
+        if label in cleaned:
+            parts = cleaned.split(label)
+            if len(parts) > 1:
+                cleaned = parts[-1].strip()  # Take last part
+            else:
+                cleaned = cleaned.replace(label, "").strip()
+
+    # Remove Human: and Assistant: if they appear (from few-shot examples)
+    if cleaned.startswith("Assistant:"):
+        cleaned = cleaned[10:].strip()
+    if "Human:" in cleaned:
+        cleaned = cleaned.split("Human:")[0].strip()
+
+    # Clean whitespace
+    cleaned = " ".join(cleaned.split())
+
+    # Get first complete sentence or limit to MAX_RESPONSE_CHARS (shorter = faster to read)
+    if len(cleaned) > MAX_RESPONSE_CHARS:
+        for sep in ['. ', '! ', '? ', '\n']:
+            if sep in cleaned:
+                first_part = cleaned.split(sep)[0].strip()
+                if len(first_part) > 8:  # Only if meaningful
+                    cleaned = first_part + (sep.strip() if sep != '\n' else '.')
+                    break
+        else:
+            cleaned = cleaned[:MAX_RESPONSE_CHARS].strip()
+            if not cleaned.endswith(('.', '!', '?')):
+                cleaned += "."
+
+    # Fallback responses for common greetings
+    if not cleaned or len(cleaned) < 5:
+        cleaned = fallback_response(prompt)
+
+    return cleaned
+
+class IncrementalCleaner:
+    """
+    Streaming counterpart of clean_response
+
+    Text is fed in as it is decoded; feed() returns the part that is safe to
+    send to the client. A short tail is held back so labels and unwanted
+    phrases split across chunks are still caught. The stream ends (done=True)
+    at a label following real content, at the end of the first sentence, or
+    when the character budget is spent.
+
+    The terminator is kept, and only ends a sentence once the following
+    whitespace has been decoded (fed one character at a time):
+
+        "Assistant: Sure thing! It is good."   -> "Sure thing!"
+        " Is that really what you want? Yes."  -> "Is that really what you want?"
+        " The price is 3.5 dollars each. More" -> "The price is 3.5 dollars each."
+    """
+
+    def __init__(self, prompt: str, max_chars: int = MAX_RESPONSE_CHARS,
+                 stop_strings: Sequence[str] = RESPONSE_LABELS):
+        self.prompt = prompt
+        self.max_chars = max_chars
+        self.stop_strings = list(stop_strings)
+        self.done = False
+        self._pending = ""
+        self._emitted = ""
+        self._truncated = False
+        self._holdback = max(len(text) for text in self.stop_strings + UNWANTED_PHRASES) + 1
+        phrases = "|".join(re.escape(phrase) for phrase in UNWANTED_PHRASES)
+        # A phrase is only removed once the character after it is known
+        self._phrase_open = re.compile(rf'\b(?:{phrases})(?=\W)', re.IGNORECASE)
+        self._phrase_final = re.compile(rf'\b(?:{phrases})\b', re.IGNORECASE)
+
+    @property
+    def text(self) -> str:
+        """Everything emitted so far"""
+        return self._emitted
+
+    def feed(self, chunk: str) -> str:
+        """Add decoded text and return the cleaned text that can be emitted"""
+        if self.done:
+            return ""
+        self._pending += chunk
+        return self._drain(final=False)
+
+    def finish(self) -> str:
+        """Flush the held-back tail at the end of generation"""
+        sent = self._emitted
+        tail = "" if self.done else self._drain(final=True)
+        self.done = True
+
+        if not sent and len(self._emitted.strip()) < 5:
+            # Nothing useful was generated - replace with the usual fallback
+            tail = fallback_response(self.prompt)
+            self._emitted = tail
+        elif self._truncated and not self._emitted.endswith(('.', '!', '?')):
+            tail += "."
+            self._emitted += "."
+
+        return tail
+
+    def _drain(self, final: bool) -> str:
+        """Filter the pending buffer and move its safe prefix to the output"""
+        phrase_pattern = self._phrase_final if final else self._phrase_open
+        self._pending = phrase_pattern.sub("", self._pending)
+
+        # Labels: drop leading ones, stop at the first one that follows content
+        while True:
+            hits = [(self._pending.find(label), label) for label in self.stop_strings]
+            hits = [(index, label) for index, label in hits if index >= 0]
+            if not hits:
+                break
+            index, label = min(hits)
+            if self._emitted.strip() or self._pending[:index].strip():
+                self._pending = self._pending[:index]
+                self.done = True
+                break
+            self._pending = self._pending[index + len(label):]
+
+        if final or self.done:
+            cut = len(self._pending)
+        else:
+            cut = max(0, len(self._pending) - self._holdback)
+        if cut == 0:
+            return ""
+
+        emit = re.sub(r'\s+', ' ', self._pending[:cut])
+        self._pending = self._pending[cut:]
+        if not self._emitted or self._emitted.endswith(" "):
+            emit = emit.lstrip()
+
+        # Stop at the end of the first meaningful sentence. As in find_response_end, a
+        # terminator only ends a sentence once the following whitespace has been decoded;
+        # the first held-back characters may hold the terminator or that whitespace.
+        scan = self._emitted + emit + self._pending[:2]
+        for match in re.finditer(r'[.!?](?=\s)', scan):
+            end = match.end()
+            if end <= len(self._emitted):
+                continue
+            if len(scan[:match.start()].strip()) > 8:
+                emit = re.sub(r'\s+', ' ', scan[len(self._emitted):end])
+                self.done = True
+                break
+
+        # Character budget
+        if len(self._emitted) + len(emit) > self.max_chars:
+            emit = emit[:max(0, self.max_chars - len(self._emitted))].rstrip()
+            self._truncated = True
+            self.done = True
+
+        if self.done or final:
+            emit = emit.rstrip()
+
+        self._emitted += emit
+        return emit
@@ -0,0 +1,195 @@
+"""
+On-demand profiling of single requests
+Runs one call under cProfile and the torch profiler, records the wall and CPU
+time of each request stage and writes everything to a zip artifact in PROFILE_DIR
+"""
+import cProfile
+import io
+import json
+import logging
+import pstats
+import re
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import torch
+from app import metrics
+from app.config import PROFILE_DIR, PROFILE_MAX_ARTIFACTS, PROFILE_TORCH
+
+logger = logging.getLogger(__name__)
+
+_PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+# The profiled call's thread; stages run on other threads are not attributed to it
+_local = threading.local()
+
+# torch.profiler is process-wide, so one request is profiled at a time
+_busy = threading.Lock()
+
+class ProfilerBusyError(Exception):
+    """Raised when another request is already being profiled"""
+
+class RequestProfile:
+    """Stage timings of one profiled call"""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict] = {}
+
+    def add_stage(self, name: str, wall: float, cpu: float):
+        entry = self.stages.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+        entry["calls"] += 1
+        entry["wall_seconds"] += wall
+        entry["cpu_seconds"] += cpu
+
+@contextmanager
+def _observed_stage(name: str, timer):
+    """Stage timer that also records wall/CPU time when the current thread is being profiled"""
+    profile = getattr(_local, "profile", None)
+    if profile is None:
+        with timer:
+            yield
+        return
+
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        with timer:
+            yield
+    finally:
+        profile.add_stage(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+def is_profiling() -> bool:
+    """Whether the current thread is running a profiled call"""
+    return getattr(_local, "profile", None) is not None
+
+def profile_path(profile_id: str) -> Optional[Path]:
+    """Artifact file for an id (None if the id is malformed or the file does not exist)"""
+    if not _PROFILE_ID.match(profile_id):
+        return None
+    path = PROFILE_DIR / f"{profile_id}.zip"
+    return path if path.exists() else None
+
+def list_profiles() -> List[Dict]:
+    """Stored artifacts, newest first"""
+    if not PROFILE_DIR.exists():
+        return []
+    artifacts = sorted(PROFILE_DIR.glob("*.zip"), key=lambda path: path.stat().st_mtime, reverse=True)
+    return [
+        {
+            "profile_id": path.stem,
+            "created": datetime.fromtimestamp(path.stat().st_mtime, timezone.utc).isoformat(timespec="seconds"),
+            "bytes": path.stat().st_size
+        }
+        for path in artifacts
+    ]
+
+def _torch_profiler():
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(activities=activities)
+
+def profile_call(fn: Callable, *args, label: str = "", **kwargs) -> Tuple[Any, str]:
+    """
+    Run fn(*args, **kwargs) under cProfile and the torch profiler and store the artifact
+
+    Work the call hands to other threads (e.g. generation batching) is not seen by
+    cProfile, so callers should run it inline while is_profiling() is true.
+
+    Args:
+        fn: Callable to profile (runs on the calling thread)
+        label: Free-form description stored in the summary (e.g. the endpoint)
+
+    Returns:
+        (fn's result, profile id)
+
+    Raises:
+        ProfilerBusyError: if another call is being profiled
+    """
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusyError("Another request is being profiled")
+    try:
+        profile = RequestProfile()
+        profiler = cProfile.Profile()
+        torch_profiler = _torch_profiler() if PROFILE_TORCH else None
+
+        _local.profile = profile
+        metrics.observe_stages(_observed_stage)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            if torch_profiler is not None:
+                torch_profiler.start()
+            profiler.enable()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                profiler.disable()
+                if torch_profiler is not None:
+                    torch_profiler.stop()
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            metrics.observe_stages(None)
+            _local.profile = None
+
+        profile_id = uuid.uuid4().hex
+        summary = {
+            "profile_id": profile_id,
+            "label": label,
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "stages": profile.stages,
+            # Time outside the instrumented stages (cache lookups, context building, locking, ...)
+            "unstaged_wall_seconds": wall - sum(entry["wall_seconds"] for entry in profile.stages.values())
+        }
+        try:
+            _write_artifact(profile_id, summary, profiler, torch_profiler)
+        except Exception as e:
+            logger.error(f"Error writing profile {profile_id}: {e}")
+            raise
+        logger.info(f"Profiled {label or fn.__name__} in {wall:.3f}s (profile {profile_id})")
+        return result, profile_id
+    finally:
+        _busy.release()
+
+def _write_artifact(profile_id: str, summary: Dict, profiler: cProfile.Profile, torch_profiler):
+    """Zip the summary, cProfile stats and torch profiler output into PROFILE_DIR"""
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    path = PROFILE_DIR / f"{profile_id}.zip"
+    temp_path = path.with_suffix(".tmp")
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(60)
+
+    with tempfile.TemporaryDirectory() as scratch, zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("summary.json", json.dumps(summary, indent=2))
+        archive.writestr("cprofile.txt", report.getvalue())
+        stats_path = Path(scratch) / "cprofile.pstats"
+        profiler.dump_stats(str(stats_path))  # Load with pstats or snakeviz
+        archive.write(stats_path, "cprofile.pstats")
+
+        if torch_profiler is not None:
+            archive.writestr(
+                "torch_ops.txt",
+                torch_profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=50)
+            )
+            trace_path = Path(scratch) / "torch_trace.json"
+            torch_profiler.export_chrome_trace(str(trace_path))  # Open in chrome://tracing or Perfetto
+            archive.write(trace_path, "torch_trace.json")
+
+    temp_path.replace(path)
+    _prune()
+
+def _prune():
+    """Delete the oldest artifacts beyond PROFILE_MAX_ARTIFACTS"""
+    artifacts = sorted(PROFILE_DIR.glob("*.zip"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for path in artifacts[PROFILE_MAX_ARTIFACTS:]:
+        try:
+            path.unlink()
+        except OSError as e:
+            logger.warning(f"Could not delete old profile {path.name}: {e}")
@@ -0,0 +1,213 @@
+"""
+Embedding quantizers for the NumPy vector backend
+Compress stored vectors into short uint8 codes that are searched with
+asymmetric distances: queries stay float32 and are compared with the codes'
+reconstructions, so only the stored side loses precision
+
+    int8 - one byte per dimension, scaled per dimension (4x smaller than float32)
+    pq   - product quantization: the vector is cut into sub-vectors and each is
+           replaced by the index of its nearest of 256 learned centroids
+           (NUMPY_PQ_SUBVECTORS bytes per vector, 32x smaller at 48 for 384 dims)
+"""
+import logging
+from pathlib import Path
+from typing import Optional
+import numpy as np
+from app.config import NUMPY_PQ_SUBVECTORS
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ["none", "int8", "pq"]
+TRAIN_SAMPLE_ROWS = 16384  # Vectors sampled to fit the quantizer
+PQ_CENTROIDS = 256  # One byte per sub-vector code
+PQ_TRAIN_ITERATIONS = 10
+ENCODE_CHUNK_ROWS = 16384
+DECODE_CHUNK_ROWS = 2048  # int8 codes widened to float32 at a time, so the copy stays in cache
+
+class Quantizer:
+    """Trained codebook: encodes vectors to codes and scores queries against codes"""
+
+    kind = "none"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    @property
+    def code_size(self) -> int:
+        """Bytes per encoded vector"""
+        raise NotImplementedError
+
+    def train(self, vectors: np.ndarray):
+        raise NotImplementedError
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """(n, dim) float vectors -> (n, code_size) uint8 codes"""
+        raise NotImplementedError
+
+    def sq_norms(self, codes: np.ndarray) -> Optional[np.ndarray]:
+        """Squared norms of the codes' reconstructions, if distances() needs them"""
+        return None
+
+    def prepare(self, queries: np.ndarray):
+        """Per-query state reused for every block of codes"""
+        return queries
+
+    def distances(self, prepared, codes: np.ndarray, sq_norms: Optional[np.ndarray] = None) -> np.ndarray:
+        """Approximate squared L2 distances, (n_queries, n_codes)"""
+        raise NotImplementedError
+
+    def arrays(self) -> dict:
+        raise NotImplementedError
+
+    def save(self, path: Path):
+        with open(path, "wb") as f:
+            np.savez(f, kind=np.array(self.kind), dim=np.array(self.dim), **self.arrays())
+
+def load_quantizer(path: Path) -> Quantizer:
+    """Quantizer saved with Quantizer.save"""
+    with np.load(path) as data:
+        kind, dim = str(data["kind"]), int(data["dim"])
+        if kind == "int8":
+            quantizer = ScalarQuantizer(dim)
+            quantizer.low, quantizer.scale = data["low"], data["scale"]
+        elif kind == "pq":
+            centroids = data["centroids"]
+            quantizer = ProductQuantizer(dim, centroids.shape[0])
+            quantizer.centroids = centroids
+            quantizer._centroid_sq_norms = np.einsum("mkd,mkd->mk", centroids, centroids)
+        else:
+            raise ValueError(f"Unknown quantizer in {path}: {kind}")
+    return quantizer
+
+def create_quantizer(kind: str, dim: int) -> Optional[Quantizer]:
+    """Untrained quantizer for a NUMPY_INDEX_QUANTIZATION setting (None for "none")"""
+    if kind == "none":
+        return None
+    if kind == "int8":
+        return ScalarQuantizer(dim)
+    if kind == "pq":
+        return ProductQuantizer(dim, NUMPY_PQ_SUBVECTORS)
+    raise ValueError(f"Unknown quantization: {kind} (expected one of {', '.join(QUANTIZATIONS)})")
+
+class ScalarQuantizer(Quantizer):
+    """Each dimension mapped linearly onto 0..255 over its trained range"""
+
+    kind = "int8"
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.low = np.zeros(dim, dtype=np.float32)
+        self.scale = np.ones(dim, dtype=np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return self.dim
+
+    def train(self, vectors: np.ndarray):
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        self.low = low.astype(np.float32)
+        self.scale = np.maximum((high - low) / 255.0, 1e-12).astype(np.float32)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.low) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def sq_norms(self, codes):
+        norms = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), DECODE_CHUNK_ROWS):
+            decoded = codes[start:start + DECODE_CHUNK_ROWS] * self.scale + self.low
+            norms[start:start + len(decoded)] = np.einsum("ij,ij->i", decoded, decoded)
+        return norms
+
+    def prepare(self, queries):
+        # x.q = low.q + codes @ (scale * q), so the codes are never rescaled
+        return np.ascontiguousarray((queries * self.scale).T), queries @ self.low, np.einsum("ij,ij->i", queries, queries)
+
+    def distances(self, prepared, codes, sq_norms=None):
+        weights, offsets, q_norms = prepared
+        dots = np.empty((len(codes), weights.shape[1]), dtype=np.float32)
+        widened = np.empty((min(len(codes), DECODE_CHUNK_ROWS), self.dim), dtype=np.float32)
+        for start in range(0, len(codes), DECODE_CHUNK_ROWS):
+            chunk = codes[start:start + DECODE_CHUNK_ROWS]
+            np.copyto(widened[:len(chunk)], chunk, casting="unsafe")
+            np.matmul(widened[:len(chunk)], weights, out=dots[start:start + len(chunk)])
+        return sq_norms + q_norms[:, None] - 2.0 * (dots.T + offsets[:, None])
+
+    def arrays(self) -> dict:
+        return {"low": self.low, "scale": self.scale}
+
+class ProductQuantizer(Quantizer):
+    """Sub-vectors replaced by their nearest of PQ_CENTROIDS k-means centroids"""
+
+    kind = "pq"
+
+    def __init__(self, dim: int, subvectors: int):
+        super().__init__(dim)
+        if subvectors <= 0 or dim % subvectors:
+            raise ValueError(f"NUMPY_PQ_SUBVECTORS ({subvectors}) must divide the embedding dimension ({dim})")
+        self.subvectors = subvectors
+        self.subdim = dim // subvectors
+        self.centroids = np.zeros((subvectors, PQ_CENTROIDS, self.subdim), dtype=np.float32)
+        self._centroid_sq_norms = np.zeros((subvectors, PQ_CENTROIDS), dtype=np.float32)
+
+    @property
+    def code_size(self) -> int:
+        return self.subvectors
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """(n, dim) -> (subvectors, n, subdim)"""
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.subvectors, self.subdim).transpose(1, 0, 2)
+
+    def _nearest(self, m: int, parts: np.ndarray) -> np.ndarray:
+        distances = self._centroid_sq_norms[m] - 2.0 * (parts @ self.centroids[m].T)
+        return distances.argmin(axis=1)
+
+    def train(self, vectors: np.ndarray):
+        """k-means per sub-space (Lloyd iterations from a random sample of the vectors)"""
+        rng = np.random.default_rng(0)
+        parts = self._split(vectors)
+        n = parts.shape[1]
+        for m in range(self.subvectors):
+            # Fewer vectors than centroids: some centroids repeat
+            self.centroids[m] = parts[m][rng.choice(n, PQ_CENTROIDS, replace=n < PQ_CENTROIDS)]
+            self._centroid_sq_norms[m] = np.einsum("kd,kd->k", self.centroids[m], self.centroids[m])
+            for _ in range(PQ_TRAIN_ITERATIONS):
+                assignment = self._nearest(m, parts[m])
+                counts = np.bincount(assignment, minlength=PQ_CENTROIDS)
+                sums = np.stack([
+                    np.bincount(assignment, weights=parts[m][:, d], minlength=PQ_CENTROIDS)
+                    for d in range(self.subdim)
+                ], axis=1)
+                filled = counts > 0  # Empty clusters keep their centroid
+                self.centroids[m][filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+                self._centroid_sq_norms[m] = np.einsum("kd,kd->k", self.centroids[m], self.centroids[m])
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        parts = self._split(vectors)
+        codes = np.empty((parts.shape[1], self.subvectors), dtype=np.uint8)
+        for m in range(self.subvectors):
+            codes[:, m] = self._nearest(m, parts[m])
+        return codes
+
+    def prepare(self, queries: np.ndarray):
+        """Lookup tables: squared distance from each query sub-vector to every centroid"""
+        parts = self._split(queries)  # (subvectors, n_queries, subdim)
+        q_norms = np.einsum("mqd,mqd->mq", parts, parts)
+        tables = (
+            q_norms[:, :, None] + self._centroid_sq_norms[:, None, :]
+            - 2.0 * np.einsum("mqd,mkd->mqk", parts, self.centroids)
+        )
+        return np.ascontiguousarray(tables.transpose(1, 0, 2))  # (n_queries, subvectors, PQ_CENTROIDS)
+
+    def distances(self, prepared, codes, sq_norms=None):
+        columns = np.ascontiguousarray(codes.T)  # One contiguous code array per sub-vector
+        distances = np.empty((len(prepared), len(codes)), dtype=np.float32)
+        for q, tables in enumerate(prepared):
+            total = np.take(tables[0], columns[0])
+            for m in range(1, self.subvectors):
+                total += np.take(tables[m], columns[m])
+            distances[q] = total
+        return distances
+
+    def arrays(self) -> dict:
+        return {"centroids": self.centroids}
@@ -0,0 +1,205 @@
+"""
+Dynamic micro-batching for model inference
+Gathers concurrent requests for a short window and runs them as one batch
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+from app.config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, MAX_NEW_TOKENS
+from app.profiling import is_profiling
+
+logger = logging.getLogger(__name__)
+
+class _BatchItem:
+    """A single queued call waiting for its batch"""
+
+    __slots__ = ("key", "payload", "future")
+
+    def __init__(self, key: Hashable, payload: Any):
+        self.key = key
+        self.payload = payload
+        self.future: Future = Future()
+
+class MicroBatcher:
+    """
+    Collects concurrent calls and runs them through one batch function
+
+    Calls are grouped by key (only calls with equal keys share a batch). A batch
+    is dispatched as soon as it holds max_batch_size items, or max_wait_ms after
+    its first item arrived, whichever comes first.
+    """
+
+    def __init__(self, batch_fn: Callable[[Hashable, List[Any]], List[Any]],
+                 max_batch_size: int, max_wait_ms: float, name: str = "micro-batcher"):
+        self._batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: "queue.Queue[Optional[_BatchItem]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._largest_batch = 0
+        self._name = name
+        # Started on first submit, so forked pre-fork workers each get their own thread
+        self._worker: Optional[threading.Thread] = None
+        self._worker_pid: Optional[int] = None
+
+    def submit(self, payload: Any, key: Hashable = None) -> Future:
+        """Queue a call and return a future resolved with its result"""
+        self._ensure_worker()
+        item = _BatchItem(key, payload)
+        self._queue.put(item)
+        return item.future
+
+    def close(self):
+        """Stop the worker after the queued calls have been dispatched"""
+        if self._worker is not None and self._worker_pid == os.getpid():
+            self._queue.put(None)
+
+    def _ensure_worker(self):
+        """Start the worker thread in this process (threads do not survive fork)"""
+        if self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            if self._worker_pid is not None:
+                # Forked from a process that used the batcher: its queued calls are not ours
+                self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._run, name=self._name, daemon=True)
+            self._worker.start()
+            self._worker_pid = os.getpid()
+
+    def stats(self) -> Dict:
+        """Batching counters (useful to tune max batch size and wait time)"""
+        with self._lock:
+            return {
+                "batches": self._batches,
+                "items": self._items,
+                "avg_batch_size": self._items / self._batches if self._batches else 0.0,
+                "largest_batch": self._largest_batch,
+                "queued": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0
+            }
+
+    def _run(self):
+        """Worker loop: build one batch at a time and dispatch it"""
+        carry: List[_BatchItem] = []  # Items that arrived for a different key
+        closing = False
+
+        while True:
+            if carry:
+                first = carry.pop(0)
+            elif closing:
+                return
+            else:
+                first = self._queue.get()
+                if first is None:
+                    return
+
+            batch = [first]
+            remaining = []
+            for item in carry:
+                if item.key == first.key and len(batch) < self.max_batch_size:
+                    batch.append(item)
+                else:
+                    remaining.append(item)
+            carry = remaining
+
+            deadline = time.monotonic() + self.max_wait
+            while not closing and len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                elif item.key == first.key:
+                    batch.append(item)
+                else:
+                    carry.append(item)
+
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: List[_BatchItem]):
+        """Run one batch and route each result back to its caller"""
+        with self._lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._largest_batch = max(self._largest_batch, len(batch))
+
+        try:
+            results = self._batch_fn(batch[0].key, [item.payload for item in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"Batch function returned {len(results)} results for {len(batch)} items")
+            for item, result in zip(batch, results):
+                item.future.set_result(result)
+        except Exception as e:
+            logger.error(f"Error running batch of {len(batch)}: {e}")
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+
+class GenerationScheduler:
+    """Request scheduler in front of Phi2Model that batches concurrent prompts"""
+
+    def __init__(self, model, max_batch_size: int = BATCH_MAX_SIZE,
+                 max_wait_ms: float = BATCH_MAX_WAIT_MS):
+        self.model = model
+        self._batcher = None
+        if max_batch_size > 1:
+            self._batcher = MicroBatcher(
+                self._generate_batch,
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms,
+                name="generation-scheduler"
+            )
+            logger.info(f"Generation batching enabled (max batch {max_batch_size}, max wait {max_wait_ms}ms)")
+
+    def generate(self, prompt: str, max_tokens: int = MAX_NEW_TOKENS, context: Union[str, List[int]] = "",
+                 stop: Optional[List[str]] = None) -> str:
+        """
+        Generate a response, sharing the forward pass with concurrent callers
+
+        Args:
+            prompt: Input prompt
+            max_tokens: Maximum tokens to generate
+            context: Retrieved knowledge, as packed token ids or text
+            stop: Extra stop strings for this request
+
+        Returns:
+            Generated text
+        """
+        # A profiled request generates on its own thread so the profilers see it
+        if self._batcher is None or is_profiling():
+            return self.model.generate(prompt=prompt, context=context, max_tokens=max_tokens, stop=stop)
+
+        # Prompts are batched only with prompts sharing the same generation settings
+        key = (max_tokens, tuple(stop or ()))
+        return self._batcher.submit((prompt, context), key=key).result()
+
+    def _generate_batch(self, key, payloads: List) -> List[str]:
+        """Batch function: one left-padded generate call for all payloads"""
+        max_tokens, stop = key
+        prompts = [prompt for prompt, _ in payloads]
+        contexts = [context for _, context in payloads]
+        return self.model.generate_batch(prompts, max_tokens=max_tokens, contexts=contexts, stop=list(stop))
+
+    def stats(self) -> Dict:
+        """Batching statistics"""
+        if self._batcher is None:
+            return {"enabled": False}
+        return {"enabled": True, **self._batcher.stats()}
+
+    def close(self):
+        """Stop the scheduler worker"""
+        if self._batcher is not None:
+            self._batcher.close()
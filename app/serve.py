@@ -0,0 +1,163 @@
+"""
+Pre-fork server
+Loads the chat and embedding models once in a parent process, then forks uvicorn
+workers that share the weight memory copy-on-write and accept on one socket.
+Knowledge writes from all workers go through a single writer process.
+
+Usage:
+    python -m app.serve                # one worker per CPU core
+    python -m app.serve --workers 4
+"""
+import argparse
+import gc
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+# Forked workers must not inherit a half-used tokenizers thread pool
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+import torch
+import uvicorn
+
+from app import main as api
+from app.writer import serve_writer, use_writer
+from app.config import (
+    API_HOST, API_PORT, SSL_CERT_PATH, SSL_KEY_PATH, LOG_LEVEL,
+    SERVE_WORKERS, KNOWLEDGE_WRITER_SOCKET, INGEST_WAL_PATH
+)
+
+logger = logging.getLogger(__name__)
+
+_fork = multiprocessing.get_context("fork")
+
+def worker_wal_path(index: int) -> Path:
+    """Teach WAL for a worker; worker 0 keeps the single-process path so its backlog carries over"""
+    if index == 0:
+        return INGEST_WAL_PATH
+    return INGEST_WAL_PATH.with_name(f"{INGEST_WAL_PATH.stem}-{index}{INGEST_WAL_PATH.suffix}")
+
+def run_worker(index: int, workers: int, config: uvicorn.Config, sock):
+    """Worker process: serve the API on the inherited socket"""
+    # Split the cores between workers instead of every worker using all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    api.startup.ingest_wal_path = worker_wal_path(index)
+    api.startup.run_compaction = index == 0
+    logger.info(f"Worker {index} started (pid {os.getpid()})")
+    uvicorn.Server(config).run(sockets=[sock])
+
+def start_writer(authkey: bytes, generation) -> multiprocessing.Process:
+    """Start the writer process and wait until it accepts connections"""
+    writer = _fork.Process(
+        target=serve_writer,
+        args=(KNOWLEDGE_WRITER_SOCKET, authkey, generation),
+        name="knowledge-writer",
+        daemon=True
+    )
+    if KNOWLEDGE_WRITER_SOCKET.exists():
+        KNOWLEDGE_WRITER_SOCKET.unlink()
+    writer.start()
+
+    deadline = time.monotonic() + 60
+    while not KNOWLEDGE_WRITER_SOCKET.exists():
+        if not writer.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError("Knowledge writer failed to start")
+        time.sleep(0.05)
+    return writer
+
+def serve(workers: int, host: str = API_HOST, port: int = API_PORT) -> int:
+    """
+    Load models, start the writer and supervise the workers until SIGTERM/SIGINT
+
+    Returns:
+        Process exit code
+    """
+    KNOWLEDGE_WRITER_SOCKET.parent.mkdir(parents=True, exist_ok=True)
+
+    # Load weights once; forked workers share these pages until something writes to them
+    api.startup.load_models()
+
+    authkey = os.urandom(32)
+    generation = _fork.Value("Q", 0)  # Bumped by the writer after every write
+    use_writer(KNOWLEDGE_WRITER_SOCKET, authkey, generation)
+    writer = start_writer(authkey, generation)
+
+    use_ssl = SSL_CERT_PATH.exists() and SSL_KEY_PATH.exists()
+    config = uvicorn.Config(
+        api.app,
+        host=host,
+        port=port,
+        ssl_certfile=str(SSL_CERT_PATH) if use_ssl else None,
+        ssl_keyfile=str(SSL_KEY_PATH) if use_ssl else None,
+        log_level=LOG_LEVEL.lower()
+    )
+    sock = config.bind_socket()
+
+    # Move everything allocated so far out of the collector's view: without this the
+    # first gc pass in each worker touches every object header and un-shares its page
+    gc.collect()
+    gc.freeze()
+
+    def spawn(index: int) -> multiprocessing.Process:
+        process = _fork.Process(target=run_worker, args=(index, workers, config, sock), name=f"api-worker-{index}")
+        process.start()
+        return process
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    processes = {index: spawn(index) for index in range(workers)}
+    logger.info(f"Serving on {host}:{port} with {workers} workers (pid {os.getpid()})")
+
+    while not stopping:
+        multiprocessing.connection.wait(
+            [process.sentinel for process in processes.values()] + [writer.sentinel],
+            timeout=1.0
+        )
+        if stopping:
+            break
+        if not writer.is_alive():
+            logger.error(f"Knowledge writer exited with code {writer.exitcode}, restarting")
+            writer = start_writer(authkey, generation)
+        for index, process in list(processes.items()):
+            if not process.is_alive():
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                processes[index] = spawn(index)
+
+    # Workers flush their teach queues on shutdown, so stop them before the writer
+    logger.info("Shutting down workers...")
+    for process in processes.values():
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+    for process in processes.values():
+        process.join(30)
+        if process.is_alive():
+            process.kill()
+    writer.terminate()
+    writer.join(10)
+    sock.close()
+    return 0
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Pre-fork API server sharing model weights between workers")
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS, help="Worker processes (0 = one per CPU core)")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    args = parser.parse_args(argv)
+
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    return serve(workers, args.host, args.port)
+
+if __name__ == "__main__":
+    sys.exit(main())
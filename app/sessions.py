@@ -0,0 +1,160 @@
+"""
+Conversation sessions
+Per-conversation turn history with bounded memory, optionally holding the
+model's key/value cache so follow-up turns only prefill their new tokens
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+from app.config import SESSION_MAX_TURNS, SESSION_TTL, SESSION_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+def kv_cache_bytes(past_key_values) -> int:
+    """Memory held by a past_key_values structure (tuple of per-layer key/value tensors)"""
+    if past_key_values is None:
+        return 0
+    return sum(tensor.element_size() * tensor.nelement() for layer in past_key_values for tensor in layer)
+
+class Session:
+    """One conversation: a ring of recent turns and the model state after the last one"""
+
+    def __init__(self, conversation_id: str, max_turns: int):
+        self.conversation_id = conversation_id
+        self.turns = deque(maxlen=max_turns)
+        self.token_ids: Optional[List[int]] = []  # Prompt tokens of the conversation (None = rebuild from turns)
+        self.past_key_values = None  # Cache covering past_ids (None when not kept)
+        self.past_ids: List[int] = []
+        self.last_used = time.monotonic()
+
+    def size_bytes(self) -> int:
+        """Approximate memory held by the session"""
+        text = sum(len(turn["user"]) + len(turn["assistant"]) for turn in self.turns)
+        tokens = len(self.token_ids or []) + len(self.past_ids)
+        return text + 8 * tokens + kv_cache_bytes(self.past_key_values)
+
+class SessionStore:
+    """
+    Sessions keyed by conversation_id
+
+    Each session keeps at most max_turns turns. Idle sessions expire after ttl
+    seconds, and the least recently used sessions are evicted whole while the
+    store holds more than max_bytes (KV caches included).
+    """
+
+    def __init__(self, max_turns: int = SESSION_MAX_TURNS, ttl: float = SESSION_TTL,
+                 max_bytes: int = SESSION_MAX_BYTES):
+        self.max_turns = max(1, max_turns)
+        self.ttl = ttl  # Seconds; 0 keeps idle sessions until evicted by size
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, conversation_id: str) -> Optional[Session]:
+        """The session for a conversation (None if unknown or expired)"""
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(conversation_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self._sessions.move_to_end(conversation_id)
+            return session
+
+    def history(self, conversation_id: str) -> List[Dict]:
+        """Turns of a conversation, oldest first"""
+        session = self.get(conversation_id)
+        return list(session.turns) if session else []
+
+    def add_turn(self, conversation_id: str, user: str, assistant: str, knowledge_used: int = 0,
+                 token_ids: Optional[List[int]] = None):
+        """
+        Record a finished turn
+
+        Args:
+            conversation_id: Conversation the turn belongs to
+            user: User message
+            assistant: Response
+            knowledge_used: Number of knowledge items used
+            token_ids: Prompt tokens of the conversation including this turn (None = rebuild from the turns)
+        """
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is None:
+                session = self._sessions[conversation_id] = Session(conversation_id, self.max_turns)
+            session.turns.append({"user": user, "assistant": assistant, "knowledge_used": knowledge_used})
+            session.token_ids = None if token_ids is None else list(token_ids)
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(conversation_id)
+            self._resize(session)
+
+    def set_cache(self, conversation_id: str, past_ids: List[int], past_key_values):
+        """Keep the key/value cache covering past_ids for the next turn"""
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is None:
+                return
+            session.past_ids = list(past_ids)
+            session.past_key_values = past_key_values
+            self._sessions.move_to_end(conversation_id)
+            if self._resize(session) > self.max_bytes:
+                # A cache that cannot fit on its own is not worth evicting everything else for
+                session.past_ids = []
+                session.past_key_values = None
+                self._resize(session)
+
+    def clear(self, conversation_id: Optional[str] = None):
+        """Drop one conversation, or all of them"""
+        with self._lock:
+            if conversation_id is None:
+                self._sessions.clear()
+                self._sizes.clear()
+                self._total_bytes = 0
+            elif conversation_id in self._sessions:
+                self._remove(conversation_id)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "cached_kv": sum(1 for session in self._sessions.values() if session.past_key_values is not None),
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def _resize(self, session: Session) -> int:
+        """Update a session's accounted size and evict LRU sessions over the cap (lock held)"""
+        size = session.size_bytes()
+        self._total_bytes += size - self._sizes.get(session.conversation_id, 0)
+        self._sizes[session.conversation_id] = size
+        while self._total_bytes > self.max_bytes and len(self._sessions) > 1:
+            oldest = next(iter(self._sessions))
+            if oldest == session.conversation_id:
+                break
+            self._remove(oldest)
+            self.evictions += 1
+        return size
+
+    def _remove(self, conversation_id: str):
+        """Forget a session (lock held)"""
+        del self._sessions[conversation_id]
+        self._total_bytes -= self._sizes.pop(conversation_id, 0)
+
+    def _expire(self):
+        """Remove sessions idle for longer than the TTL (lock held)"""
+        if not self.ttl:
+            return
+        cutoff = time.monotonic() - self.ttl
+        while self._sessions:
+            conversation_id, session = next(iter(self._sessions.items()))
+            if session.last_used >= cutoff:
+                break
+            self._remove(conversation_id)
+            self.expirations += 1
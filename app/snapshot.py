@@ -0,0 +1,332 @@
+"""
+Knowledge snapshots
+A portable copy of the knowledge store in one file: float16 embeddings as one
+contiguous array plus the ids, documents and metadata as columns. Importing
+bulk-loads the stored vectors into a fresh store directory without running the
+embedding model, then switches to it
+
+Usage:
+    python -m app.snapshot export data/snapshots/knowledge.ksnap
+    python -m app.snapshot import data/snapshots/knowledge.ksnap
+    python -m app.snapshot info data/snapshots/knowledge.ksnap
+
+The import command is for provisioning a stopped node; a running server loads
+snapshots with POST /admin/snapshots/{name}/load instead.
+
+File layout (little-endian):
+    8 bytes   magic b"KSNAPSHT"
+    4 bytes   header length (uint32)
+    header    JSON: version, count, dim, embedding_model, sections
+    padding   to a 64-byte boundary, where the data starts
+    sections  at header["sections"][name]["offset"] bytes from the data start:
+              "embeddings" (count x dim float16), then for each column
+              "<column>.offsets" (count + 1 uint64) and "<column>.data" (UTF-8;
+              metadata is one JSON object per row)
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from app.config import (
+    LOG_LEVEL, EMBEDDING_MODEL, VECTOR_BACKEND, KNOWLEDGE_PAGE_MAX, SNAPSHOT_DIR, SNAPSHOT_IMPORT_CHUNK
+)
+from app.vector_store import DEFAULT_LOCATIONS, VectorBackend, create_backend, set_current_location
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"KSNAPSHT"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = ".ksnap"
+COLUMNS = ("ids", "documents", "metadatas")
+ALIGNMENT = 64  # Section boundaries, so the embeddings can be memory-mapped in place
+_SNAPSHOT_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*\.ksnap$")
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def export_snapshot(backend: VectorBackend, path: Path) -> Dict:
+    """
+    Write every stored document to a snapshot file
+
+    The store is read page by page (bounded memory) while it keeps serving; the
+    file appears atomically once complete.
+
+    Args:
+        backend: Vector backend to export
+        path: Snapshot file to write
+
+    Returns:
+        The snapshot header
+    """
+    started = time.monotonic()
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    count, dim = 0, None
+    with tempfile.TemporaryDirectory(dir=path.parent, prefix=".snapshot-") as scratch:
+        scratch = Path(scratch)
+        embeddings = open(scratch / "embeddings", "wb")
+        columns = {column: open(scratch / f"{column}.data", "wb") for column in COLUMNS}
+        offsets = {column: open(scratch / f"{column}.offsets", "wb") for column in COLUMNS}
+        ends = dict.fromkeys(COLUMNS, 0)
+        for handle in offsets.values():
+            handle.write(np.zeros(1, dtype="<u8").tobytes())
+        try:
+            cursor = None
+            while True:
+                page, cursor = backend.page(limit=KNOWLEDGE_PAGE_MAX, cursor=cursor)
+                if page["ids"]:
+                    fetched = backend.get(ids=page["ids"], include_embeddings=True)
+                    rows = {
+                        doc_id: (document, metadata, embedding)
+                        for doc_id, document, metadata, embedding in zip(
+                            fetched["ids"], fetched["documents"], fetched["metadatas"], fetched["embeddings"]
+                        )
+                    }
+                    # Deleted since the page was read
+                    page_ids = [doc_id for doc_id in page["ids"] if doc_id in rows]
+                    vectors = np.asarray([rows[doc_id][2] for doc_id in page_ids], dtype="<f2")
+                    if page_ids:
+                        if dim is None:
+                            dim = vectors.shape[1]
+                        embeddings.write(vectors.tobytes())
+                    page_ends = {column: [] for column in COLUMNS}
+                    for doc_id in page_ids:
+                        document, metadata, _ = rows[doc_id]
+                        values = (doc_id, document or "", json.dumps(metadata or {}, separators=(",", ":")))
+                        for column, value in zip(COLUMNS, values):
+                            encoded = value.encode("utf-8")
+                            columns[column].write(encoded)
+                            ends[column] += len(encoded)
+                            page_ends[column].append(ends[column])
+                    for column in COLUMNS:
+                        offsets[column].write(np.asarray(page_ends[column], dtype="<u8").tobytes())
+                    count += len(page_ids)
+                if cursor is None:
+                    break
+        finally:
+            embeddings.close()
+            for handle in (*columns.values(), *offsets.values()):
+                handle.close()
+
+        # Section order and offsets, relative to the data start
+        sections, parts, position = {}, [], 0
+        for name in ("embeddings", *(f"{column}.{part}" for column in COLUMNS for part in ("offsets", "data"))):
+            position = _aligned(position)
+            source = scratch / name
+            sections[name] = {"offset": position, "length": source.stat().st_size}
+            parts.append((position, source))
+            position += sections[name]["length"]
+
+        header = {
+            "format": "knowledge-snapshot",
+            "version": SNAPSHOT_VERSION,
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "count": count,
+            "dim": dim or 0,
+            "dtype": "float16",
+            "embedding_model": EMBEDDING_MODEL,
+            "source_backend": backend.name,
+            "columns": list(COLUMNS),
+            "metadata_encoding": "json",
+            "sections": sections
+        }
+        header_bytes = json.dumps(header).encode("utf-8")
+        data_start = _aligned(len(SNAPSHOT_MAGIC) + 4 + len(header_bytes))
+
+        temp_path = scratch / "snapshot"
+        with open(temp_path, "wb") as output:
+            output.write(SNAPSHOT_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+            for offset, source in parts:
+                output.write(b"\0" * (data_start + offset - output.tell()))
+                with open(source, "rb") as part:
+                    shutil.copyfileobj(part, output, 1024 * 1024)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temp_path, path)
+
+    logger.info(
+        f"Exported {count} documents to {path} "
+        f"({path.stat().st_size} bytes, {time.monotonic() - started:.1f}s)"
+    )
+    return header
+
+class Snapshot:
+    """Read access to a snapshot file (the sections are memory-mapped, not loaded)"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError(f"Not a knowledge snapshot: {self.path}")
+            header_length, = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_length).decode("utf-8"))
+        if self.header.get("version", 0) > SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Snapshot version {self.header.get('version')} is newer than supported ({SNAPSHOT_VERSION})"
+            )
+        self.count = int(self.header["count"])
+        self.dim = int(self.header["dim"])
+        self._data_start = _aligned(len(SNAPSHOT_MAGIC) + 4 + header_length)
+
+    def _section(self, name: str, dtype, shape) -> np.ndarray:
+        section = self.header["sections"][name]
+        if section["length"] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=self._data_start + section["offset"], shape=shape)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """(count, dim) float16 embeddings"""
+        return self._section("embeddings", "<f2", (self.count, self.dim))
+
+    def column(self, name: str, start: int, end: int) -> List[str]:
+        """Values of rows [start, end) of a column"""
+        offsets = self._section(f"{name}.offsets", "<u8", (self.count + 1,))
+        first, last = int(offsets[start]), int(offsets[end])
+        section = self.header["sections"][f"{name}.data"]
+        if last == first:
+            data = b""
+        else:
+            data = bytes(self._section(f"{name}.data", np.uint8, (section["length"],))[first:last])
+        bounds = (offsets[start:end + 1].astype(np.int64) - first).tolist()
+        return [data[bounds[i]:bounds[i + 1]].decode("utf-8") for i in range(end - start)]
+
+    def rows(self, start: int, end: int) -> Tuple[List[str], np.ndarray, List[str], List[Dict]]:
+        """(ids, float32 embeddings, documents, metadatas) of rows [start, end)"""
+        return (
+            self.column("ids", start, end),
+            np.asarray(self.embeddings[start:end], dtype=np.float32),
+            self.column("documents", start, end),
+            [json.loads(value) for value in self.column("metadatas", start, end)]
+        )
+
+def load_snapshot(snapshot: Snapshot, backend: VectorBackend, chunk_size: int = SNAPSHOT_IMPORT_CHUNK) -> int:
+    """
+    Bulk-add a snapshot's documents with their stored embeddings
+
+    Returns:
+        Number of documents added
+    """
+    for start in range(0, snapshot.count, chunk_size):
+        end = min(snapshot.count, start + chunk_size)
+        ids, embeddings, documents, metadatas = snapshot.rows(start, end)
+        backend.add(ids, embeddings, documents, metadatas)
+    return snapshot.count
+
+def new_store_location(name: str = VECTOR_BACKEND) -> Path:
+    """Unused directory next to the backend's default store, for an import"""
+    default = DEFAULT_LOCATIONS[name]
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    location = default.parent / f"{default.name}-{stamp}"
+    suffix = 1
+    while location.exists():
+        suffix += 1
+        location = default.parent / f"{default.name}-{stamp}-{suffix}"
+    return location
+
+def import_snapshot(path: Path, name: str = VECTOR_BACKEND) -> Tuple[VectorBackend, Dict]:
+    """
+    Load a snapshot into a new store directory (the active store is untouched)
+
+    Args:
+        path: Snapshot file
+        name: Vector backend to load into
+
+    Returns:
+        (backend opened on the new store, snapshot header) - make it active with
+        writer.switch_backend or vector_store.set_current_location
+    """
+    started = time.monotonic()
+    snapshot = Snapshot(path)
+    if snapshot.header.get("embedding_model") != EMBEDDING_MODEL:
+        raise ValueError(
+            f"Snapshot embeddings are from {snapshot.header.get('embedding_model')}, "
+            f"this server uses {EMBEDDING_MODEL}"
+        )
+    location = new_store_location(name)
+    backend = create_backend(name, location)
+    try:
+        load_snapshot(snapshot, backend)
+    except Exception:
+        shutil.rmtree(location, ignore_errors=True)
+        raise
+    logger.info(
+        f"Imported {snapshot.count} documents from {path} into {location} "
+        f"({time.monotonic() - started:.1f}s)"
+    )
+    return backend, snapshot.header
+
+def snapshot_path(name: str) -> Optional[Path]:
+    """Snapshot file in SNAPSHOT_DIR for a name (None if the name is malformed)"""
+    if not _SNAPSHOT_NAME.match(name):
+        return None
+    return SNAPSHOT_DIR / name
+
+def new_snapshot_name() -> str:
+    return f"knowledge-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}{SNAPSHOT_SUFFIX}"
+
+def list_snapshots() -> List[Dict]:
+    """Snapshots in SNAPSHOT_DIR, newest first"""
+    if not SNAPSHOT_DIR.exists():
+        return []
+    snapshots = []
+    for path in sorted(SNAPSHOT_DIR.glob(f"*{SNAPSHOT_SUFFIX}"), key=lambda p: p.stat().st_mtime, reverse=True):
+        try:
+            header = Snapshot(path).header
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Skipping unreadable snapshot {path.name}: {e}")
+            continue
+        snapshots.append({
+            "name": path.name,
+            "created": header.get("created"),
+            "count": header.get("count"),
+            "embedding_model": header.get("embedding_model"),
+            "bytes": path.stat().st_size
+        })
+    return snapshots
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export or import a knowledge snapshot")
+    parser.add_argument("command", choices=["export", "import", "info"])
+    parser.add_argument("path", type=Path, help="Snapshot file")
+    parser.add_argument("--backend", choices=sorted(DEFAULT_LOCATIONS), default=VECTOR_BACKEND,
+                        help="Vector backend to export from or import into")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, LOG_LEVEL),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    if args.command == "export":
+        export_snapshot(create_backend(args.backend), args.path)
+        return 0
+
+    if not args.path.exists():
+        logger.error(f"Snapshot not found: {args.path}")
+        return 1
+    try:
+        if args.command == "info":
+            header = Snapshot(args.path).header
+            print(json.dumps({key: value for key, value in header.items() if key != "sections"}, indent=2))
+            return 0
+        backend, _ = import_snapshot(args.path, args.backend)
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    set_current_location(backend.name, backend.location)
+    logger.info(f"{backend.location} is now the active {backend.name} store")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
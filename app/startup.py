@@ -0,0 +1,97 @@
+"""
+Background startup
+Loads the chat model and the embedding model in parallel, then opens the
+knowledge store, so the API can bind its port (and answer /health) immediately
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Optional
+from app.model import Phi2Model
+from app.embeddings import EmbeddingModel
+from app.knowledge import KnowledgeStore
+from app.chat import ChatHandler
+
+logger = logging.getLogger(__name__)
+
+class Startup:
+    """Runs component initialization on a background thread and tracks readiness"""
+
+    def __init__(self):
+        self.state = "pending"  # pending, loading, ready or failed
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}  # Seconds per phase
+        self.chat_handler: Optional[ChatHandler] = None
+        self.ingest_wal_path: Optional[Path] = None  # Set per worker by the pre-fork server
+        self.run_compaction = True  # Only one pre-fork worker runs the knowledge eviction job
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Begin loading in the background (no-op if already started)"""
+        if self._thread is not None:
+            return
+        self.state = "loading"
+        self._thread = threading.Thread(target=self._run, name="startup", daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until loading finishes; True if the service is ready"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.state == "ready"
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def status(self) -> Dict:
+        """Readiness state with per-phase load timings"""
+        status = {"status": self.state, "timings": {phase: round(seconds, 3) for phase, seconds in self.timings.items()}}
+        if self.state == "ready":
+            status["model_timings"] = {
+                phase: round(seconds, 3) for phase, seconds in Phi2Model().load_timings.items()
+            }
+        if self.error:
+            status["error"] = self.error
+        return status
+
+    def _timed(self, phase: str, load: Callable):
+        """Run one load phase and record how long it took"""
+        started = time.monotonic()
+        result = load()
+        self.timings[phase] = time.monotonic() - started
+        logger.info(f"Startup phase {phase}: {self.timings[phase]:.2f}s")
+        return result
+
+    def load_models(self):
+        """
+        Load the chat model and the embedding model in parallel
+
+        Both loads are dominated by file reads and native code, so they overlap well.
+        The pre-fork server calls this in the parent so workers share the weights.
+        """
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup") as pool:
+            chat_model = pool.submit(self._timed, "chat_model", Phi2Model)
+            embedding_model = pool.submit(self._timed, "embedding_model", EmbeddingModel)
+            chat_model.result()
+            embedding_model.result()
+
+    def _run(self):
+        started = time.monotonic()
+        try:
+            if "chat_model" not in self.timings:  # Already loaded by a pre-fork parent
+                self.load_models()
+
+            self._timed("knowledge_store", KnowledgeStore)
+            self.chat_handler = self._timed("chat_handler", lambda: ChatHandler(self.ingest_wal_path, self.run_compaction))
+
+            self.timings["total"] = time.monotonic() - started
+            self.state = "ready"
+            logger.info(f"Service ready in {self.timings['total']:.2f}s")
+        except Exception as e:
+            self.timings["total"] = time.monotonic() - started
+            self.error = str(e)
+            self.state = "failed"
+            logger.error(f"Startup failed: {e}")
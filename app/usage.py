@@ -0,0 +1,100 @@
+"""
+Knowledge usage tracking
+Counts retrievals per document in memory and adds them to the documents'
+metadata (retrieval_hits, last_used) with one batched write per flush interval,
+so retrieval itself never writes to the store
+"""
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+from app.config import KNOWLEDGE_USAGE_FLUSH_INTERVAL
+from app.vector_store import VectorBackend
+
+logger = logging.getLogger(__name__)
+
+class UsageTracker:
+    """Retrieval counts waiting to be written, flushed by a background thread"""
+
+    def __init__(self, backend: VectorBackend, flush_interval: float = KNOWLEDGE_USAGE_FLUSH_INTERVAL):
+        """
+        Args:
+            backend: Vector backend holding the documents
+            flush_interval: Seconds between writes (0 disables tracking)
+        """
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, List] = {}  # Document id -> [hits, last used]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self._flushes = 0
+        self._documents_flushed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.flush_interval > 0
+
+    def record(self, ids: Iterable[str]):
+        """Count one retrieval of each document (memory only)"""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            for doc_id in ids:
+                entry = self._pending.get(doc_id)
+                if entry is None:
+                    self._pending[doc_id] = [1, now]
+                else:
+                    entry[0] += 1
+                    entry[1] = now
+            # Started on first use, so forked pre-fork workers each get their own thread
+            if self._flusher is None and not self._stop.is_set():
+                self._flusher = threading.Thread(target=self._run, name="knowledge-usage", daemon=True)
+                self._flusher.start()
+
+    def flush(self) -> int:
+        """
+        Write the pending counts to the backend
+
+        Returns:
+            Number of documents updated (0 if the write failed - the counts are kept for the next flush)
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            self.backend.record_usage({doc_id: (hits, last_used) for doc_id, (hits, last_used) in pending.items()})
+        except Exception as e:
+            logger.error(f"Error writing knowledge usage: {e}")
+            with self._lock:
+                for doc_id, (hits, last_used) in pending.items():
+                    entry = self._pending.setdefault(doc_id, [0, last_used])
+                    entry[0] += hits
+                    entry[1] = max(entry[1], last_used)
+            return 0
+        with self._lock:
+            self._flushes += 1
+            self._documents_flushed += len(pending)
+        return len(pending)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Stop the flusher and write what is pending"""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join(5)
+        self.flush()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "pending_documents": len(self._pending),
+                "flushes": self._flushes,
+                "documents_flushed": self._documents_flushed
+            }
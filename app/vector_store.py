@@ -0,0 +1,988 @@
+"""
+Vector storage backends for the knowledge store
+ChromaDB for general use, or an in-process NumPy index over a memory-mapped
+embedding matrix that worker processes share through the page cache
+"""
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from app.config import (
+    VECTOR_BACKEND, KNOWLEDGE_DB_DIR, KNOWLEDGE_COLLECTION_NAME,
+    NUMPY_INDEX_DIR, NUMPY_INDEX_DTYPE, NUMPY_INDEX_QUANTIZATION, QUANTIZATION_TRAIN_ROWS, QUANTIZATION_RERANK,
+    KNOWLEDGE_STORE_POINTER
+)
+from app.quantization import (
+    QUANTIZATIONS, TRAIN_SAMPLE_ROWS, ENCODE_CHUNK_ROWS, Quantizer, create_quantizer, load_quantizer
+)
+
+logger = logging.getLogger(__name__)
+
+_epochs = itertools.count(1)  # Epoch values are unique across the backends of a process
+CHANGE_JOURNAL_ROWS = 16384  # Changed embeddings a ChangeJournal remembers
+CHANGE_JOURNAL_EPOCHS = 1024
+
+class ChangeJournal:
+    """
+    Embeddings added or deleted at each epoch of a store
+
+    Lets SemanticResponseCache drop only the answers near what changed. Older
+    epochs are forgotten beyond CHANGE_JOURNAL_ROWS embeddings; asking about
+    them returns None (unknown), as does any epoch whose changes were not known.
+    """
+
+    def __init__(self, max_rows: int = CHANGE_JOURNAL_ROWS, max_epochs: int = CHANGE_JOURNAL_EPOCHS):
+        self.max_rows = max_rows
+        self.max_epochs = max_epochs
+        self._entries = deque()  # (epoch, (n, dim) float32 embeddings or None if unknown)
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    def record(self, epoch: int, embeddings: Optional[np.ndarray]):
+        """Remember what changed on the way to epoch (None: unknown)"""
+        if embeddings is not None:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if embeddings.ndim != 2:
+                embeddings = embeddings.reshape(len(embeddings), -1) if len(embeddings) else np.zeros((0, 0), dtype=np.float32)
+        with self._lock:
+            self._entries.append((epoch, embeddings))
+            self._rows += 0 if embeddings is None else len(embeddings)
+            while len(self._entries) > 1 and (self._rows > self.max_rows or len(self._entries) > self.max_epochs):
+                _, dropped = self._entries.popleft()
+                self._rows -= 0 if dropped is None else len(dropped)
+
+    def since(self, epoch: int) -> Optional[np.ndarray]:
+        """
+        Embeddings changed after epoch
+
+        Returns:
+            (n, dim) array (no rows if nothing changed), or None if the changes are not known
+        """
+        with self._lock:
+            entries = list(self._entries)
+        epochs = [entry_epoch for entry_epoch, _ in entries]
+        if epoch not in epochs:
+            return None
+        changed = [embeddings for _, embeddings in entries[epochs.index(epoch) + 1:]]
+        if any(embeddings is None for embeddings in changed):
+            return None
+        changed = [embeddings for embeddings in changed if len(embeddings)]
+        return np.concatenate(changed) if changed else np.zeros((0, 0), dtype=np.float32)
+
+def _empty_query_result(n_queries: int) -> Dict:
+    return {
+        "ids": [[] for _ in range(n_queries)],
+        "documents": [[] for _ in range(n_queries)],
+        "metadatas": [[] for _ in range(n_queries)],
+        "distances": [[] for _ in range(n_queries)]
+    }
+
+class VectorBackend:
+    """
+    Interface for vector storage behind KnowledgeStore
+
+    Results use ChromaDB's shapes: query() returns one list per query embedding
+    under 'ids', 'documents', 'metadatas' and 'distances' (squared L2); get()
+    returns flat 'ids', 'documents', 'metadatas' (and 'embeddings' on request).
+    """
+
+    name = "base"
+    _epoch = 0
+    _journal: Optional[ChangeJournal] = None
+
+    @property
+    def epoch(self) -> int:
+        """
+        Changes whenever the documents query() can return may have changed
+
+        Bumped by add and delete (metadata updates leave it alone) and when a
+        refresh picks up other processes' writes; SemanticResponseCache drops
+        the answers near changed_embeddings() when it moves.
+        """
+        return self._epoch
+
+    def changed_embeddings(self, since: int) -> Optional[np.ndarray]:
+        """Embeddings added or deleted after an earlier epoch (None if not known, see ChangeJournal)"""
+        return self._journal.since(since) if self._journal is not None else None
+
+    def _changed(self, embeddings: Optional[np.ndarray] = None):
+        """Start a new epoch, recording the embeddings that changed (None: unknown)"""
+        if self._journal is None:
+            self._journal = ChangeJournal()
+        self._epoch = next(_epochs)
+        self._journal.record(self._epoch, embeddings)
+
+    def add(self, ids: List[str], embeddings: np.ndarray, documents: List[str], metadatas: List[Dict]):
+        raise NotImplementedError
+
+    def query(self, embeddings: np.ndarray, n_results: int) -> Dict:
+        raise NotImplementedError
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None,
+            limit: Optional[int] = None, offset: Optional[int] = None,
+            include_embeddings: bool = False) -> Dict:
+        raise NotImplementedError
+
+    def count(self, where: Optional[Dict] = None) -> int:
+        raise NotImplementedError
+
+    def page(self, where: Optional[Dict] = None, limit: int = 100,
+             cursor: Optional[str] = None) -> Tuple[Dict, Optional[str]]:
+        """
+        One page of documents in storage order
+
+        Args:
+            where: Optional metadata equality filter
+            limit: Page size
+            cursor: Opaque cursor returned by the previous page (None for the first)
+
+        Returns:
+            (get()-shaped result, cursor for the next page or None at the end)
+        """
+        offset = int(cursor) if cursor else 0
+        result = self.get(where=where, limit=limit, offset=offset)
+        next_cursor = str(offset + len(result["ids"])) if len(result["ids"]) == limit else None
+        return result, next_cursor
+
+    def find_content_hashes(self, hashes: List[str]) -> Dict[str, str]:
+        """
+        Stored documents whose metadata carries one of these content hashes
+
+        Args:
+            hashes: content_hash values (see app.knowledge.content_hash)
+
+        Returns:
+            Hash -> id of a live document with that hash (hashes not stored are left out)
+        """
+        found = {}
+        for digest in hashes:
+            match = self.get(where={"content_hash": digest}, limit=1)
+            if match["ids"]:
+                found[digest] = match["ids"][0]
+        return found
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    def update_metadatas(self, ids: List[str], metadatas: List[Dict]):
+        """Replace the metadata of existing documents"""
+        raise NotImplementedError
+
+    def patch_metadatas(self, ids: List[str], patches: List[Dict]):
+        """
+        Set some metadata keys of existing documents, keeping their other keys
+
+        Writers that own different keys (usage counts, duplicate merges) use this
+        so that neither overwrites the other's updates with a stale copy.
+        """
+        stored = self.get(ids=ids)
+        by_id = dict(zip(ids, patches))
+        self.update_metadatas(stored["ids"], [
+            {**(metadata or {}), **by_id[doc_id]} for doc_id, metadata in zip(stored["ids"], stored["metadatas"])
+        ])
+
+    def record_usage(self, usage: Dict[str, Tuple[int, float]]):
+        """
+        Add retrieval hits to documents' metadata
+
+        Args:
+            usage: Document id -> (retrievals since the last call, time of the latest one)
+        """
+        ids = list(usage)
+        if not ids:
+            return
+        stored = self.get(ids=ids)
+        patches = []
+        for doc_id, metadata in zip(stored["ids"], stored["metadatas"]):
+            hits, last_used = usage[doc_id]
+            metadata = metadata or {}
+            patches.append({
+                "retrieval_hits": int(metadata.get("retrieval_hits", 0)) + hits,
+                "last_used": max(float(metadata.get("last_used", 0.0)), last_used)
+            })
+        self.patch_metadatas(stored["ids"], patches)
+
+    def compact(self) -> Dict:
+        """Reclaim the space held by deleted documents (returns backend-specific details)"""
+        return {}
+
+    def storage_bytes(self) -> int:
+        """Bytes the store occupies on disk"""
+        return 0
+
+    @property
+    def location(self) -> Path:
+        """Directory holding the store"""
+        raise NotImplementedError
+
+    def refresh(self):
+        """Pick up writes made by other processes (no-op for backends that see them already)"""
+
+def _directory_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+class ChromaBackend(VectorBackend):
+    """ChromaDB persistent collection"""
+
+    name = "chromadb"
+
+    def __init__(self, path: Path = KNOWLEDGE_DB_DIR, collection_name: str = KNOWLEDGE_COLLECTION_NAME):
+        self.path = path
+        self.collection_name = collection_name
+        logger.info("Initializing ChromaDB...")
+        self._open()
+        self._changed()
+        logger.info(f"ChromaDB initialized. Collection size: {self.collection.count()}")
+
+    def _open(self):
+        import chromadb
+        from chromadb.config import Settings
+
+        self.client = chromadb.PersistentClient(
+            path=str(self.path),
+            settings=Settings(anonymized_telemetry=False)
+        )
+
+        # Get or create collection
+        self.collection = self.client.get_or_create_collection(
+            name=self.collection_name,
+            metadata={"description": "User knowledge storage for RAG"}
+        )
+
+    @property
+    def location(self) -> Path:
+        return Path(self.path)
+
+    def refresh(self):
+        """
+        Reopen the collection from disk
+
+        Chroma's in-memory index only follows writes made through its own client,
+        so a reader process must reload to see another process's writes.
+        """
+        self.client.clear_system_cache()
+        self._open()
+        self._changed()
+
+    def add(self, ids, embeddings, documents, metadatas):
+        self.collection.add(
+            ids=ids,
+            embeddings=np.asarray(embeddings).tolist(),
+            documents=documents,
+            metadatas=metadatas
+        )
+        self._changed(embeddings)
+
+    def query(self, embeddings, n_results):
+        embeddings = np.atleast_2d(embeddings)
+        # ChromaDB errors on n_results larger than the collection
+        n_results = min(n_results, self.collection.count())
+        if n_results == 0:
+            return _empty_query_result(len(embeddings))
+        return self.collection.query(
+            query_embeddings=embeddings.tolist(),
+            n_results=n_results,
+            include=["documents", "metadatas", "distances"]
+        )
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include_embeddings=False):
+        include = ["documents", "metadatas"] + (["embeddings"] if include_embeddings else [])
+        return self.collection.get(ids=ids, where=where or None, limit=limit, offset=offset, include=include)
+
+    def count(self, where=None):
+        if where:
+            return len(self.collection.get(where=where, include=[])["ids"])
+        return self.collection.count()
+
+    def find_content_hashes(self, hashes):
+        if not hashes:
+            return {}
+        stored = self.collection.get(where={"content_hash": {"$in": list(hashes)}}, include=["metadatas"])
+        found = {}
+        for doc_id, metadata in zip(stored["ids"], stored["metadatas"]):
+            found.setdefault(metadata["content_hash"], doc_id)
+        return found
+
+    def delete(self, ids):
+        if ids:
+            removed = self.collection.get(ids=ids, include=["embeddings"])["embeddings"]
+            self.collection.delete(ids=ids)
+            self._changed(np.asarray(removed or [], dtype=np.float32))
+
+    def update_metadatas(self, ids, metadatas):
+        if ids:
+            self.collection.update(ids=ids, metadatas=metadatas)
+
+    def patch_metadatas(self, ids, patches):
+        # ChromaDB's update merges the given keys into the stored metadata
+        if ids:
+            self.collection.update(ids=ids, metadatas=patches)
+
+    def compact(self):
+        # Deleted rows leave free pages in ChromaDB's SQLite file; its HNSW files are managed by ChromaDB
+        db_path = Path(self.path) / "chroma.sqlite3"
+        if not db_path.exists():
+            return {}
+        before = db_path.stat().st_size
+        conn = sqlite3.connect(str(db_path), timeout=30, isolation_level=None)
+        try:
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+        return {"sqlite_bytes_before": before, "sqlite_bytes_after": db_path.stat().st_size}
+
+    def storage_bytes(self):
+        return _directory_bytes(self.path)
+
+class NumpyBackend(VectorBackend):
+    """
+    Contiguous embedding matrix searched with one matmul plus argpartition
+
+    Embeddings live in a memory-mapped file (row i of the matrix belongs to
+    row i of the SQLite table holding ids, documents and metadata), so every
+    worker process maps the same pages. Writers append under a SQLite write
+    transaction; readers notice other processes' commits through
+    PRAGMA data_version and remap when a commit changed the rows (a
+    rows_version kept in meta; metadata-only updates do not reload).
+
+    With quantization ("int8" or "pq"), a second file holds each row's code
+    and search scans the codes, re-ranking a shortlist of QUANTIZATION_RERANK
+    candidates per result against the full vectors - which then stay on disk
+    except for the shortlisted rows. The quantizer is trained once
+    QUANTIZATION_TRAIN_ROWS vectors are stored; smaller indexes are searched exactly.
+    """
+
+    name = "numpy"
+    SEARCH_BLOCK_ROWS = 65536  # Rows scored per matmul (bounds temporary memory for float16)
+    SEARCH_MAX_CELLS = 1 << 24  # Query x row distances held at once (multi-query searches use smaller blocks)
+
+    def __init__(self, directory: Path = NUMPY_INDEX_DIR, dtype: str = NUMPY_INDEX_DTYPE,
+                 quantization: str = NUMPY_INDEX_QUANTIZATION):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.matrix_path = self.directory / "embeddings.bin"
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(str(self.directory / "index.db"), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA busy_timeout = 30000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT, "
+            "metadata TEXT, deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Duplicate detection looks documents up by content hash (find_content_hashes)
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS docs_content_hash ON docs (json_extract(metadata, '$.content_hash'))"
+        )
+
+        stored = dict(self._db.execute("SELECT key, value FROM meta").fetchall())
+        self.dtype = np.dtype(stored.get("dtype", dtype))
+        self.dim = int(stored["dim"]) if "dim" in stored else None
+        if "dtype" not in stored:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dtype', ?)", (self.dtype.name,))
+        self.quantization = stored.get("quantization", quantization)
+        if self.quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {self.quantization} (expected one of {', '.join(QUANTIZATIONS)})")
+        if "quantization" not in stored:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('quantization', ?)", (self.quantization,))
+
+        self._matrix = None
+        self._layout = 0  # Number of compactions seen (each renumbers the rows)
+        self._n_rows = 0
+        self._live = np.zeros(0, dtype=bool)
+        self._sq_norms = np.zeros(0, dtype=np.float32)
+        self._data_version = None
+        self._rows_version = None  # meta 'rows_version' last loaded (see _bump_rows_version)
+        self.quantizer: Optional[Quantizer] = None  # Set once trained
+        self._quantizer_file = None
+        self.codes_path = self.directory / "codes.bin"
+        self._codes = None
+        self._code_sq_norms: Optional[np.ndarray] = None
+        with self._lock:
+            self._refresh(force=True)
+        logger.info(
+            f"NumPy index initialized ({self.dtype.name}"
+            f"{', ' + self.quantization + ' codes' if self.quantization != 'none' else ''}). "
+            f"Collection size: {self.count()}"
+        )
+
+    # Internal state
+
+    def _map(self, rows_needed: int):
+        """(Re)map the embedding file, growing it to hold rows_needed rows (lock held)"""
+        if self.dim is None:
+            return
+        row_bytes = self.dim * self.dtype.itemsize
+        size = self.matrix_path.stat().st_size if self.matrix_path.exists() else 0
+        capacity = size // row_bytes
+        if rows_needed > capacity:
+            capacity = max(1024, rows_needed, capacity * 2)
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+        if capacity == 0:
+            self._matrix = None  # Empty files cannot be mapped
+        elif self._matrix is None or self._matrix.shape[0] != capacity:
+            self._matrix = np.memmap(self.matrix_path, dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+
+    def _map_codes(self, rows_needed: int):
+        """(Re)map the code file like _map, once the quantizer is trained (lock held)"""
+        if self.quantizer is None:
+            self._codes = None
+            return
+        code_size = self.quantizer.code_size
+        size = self.codes_path.stat().st_size if self.codes_path.exists() else 0
+        capacity = size // code_size
+        if rows_needed > capacity:
+            capacity = max(1024, rows_needed, capacity * 2)
+            with open(self.codes_path, "ab") as f:
+                f.truncate(capacity * code_size)
+        if capacity == 0:
+            self._codes = None
+        elif self._codes is None or self._codes.shape[0] != capacity:
+            self._codes = np.memmap(self.codes_path, dtype=np.uint8, mode="r+", shape=(capacity, code_size))
+
+    def _refresh(self, force: bool = False, changed: Optional[np.ndarray] = None):
+        """
+        Reload row state if another process changed the rows (lock held)
+
+        Args:
+            force: Reload even without a new commit
+            changed: For a forced reload, the embeddings the caller knows changed (None: unknown)
+        """
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if not force and version == self._data_version:
+            return
+        self._data_version = version
+        # Metadata-only commits (usage counts, duplicate merges) leave the rows as they are
+        rows_version = self._read_rows_version()
+        if not force and rows_version == self._rows_version:
+            return
+        self._rows_version = rows_version
+        old_rows, old_live, old_layout = self._n_rows, self._live, self._layout
+
+        if self.dim is None:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+            self.dim = int(row[0]) if row else None
+
+        # compact() moves the rows to a new embedding file
+        self._layout = self._read_layout()
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'matrix_file'").fetchone()
+        matrix_path = self.directory / (row[0] if row else "embeddings.bin")
+        if matrix_path != self.matrix_path:
+            self.matrix_path = matrix_path
+            self._matrix = None
+
+        stored = dict(self._db.execute(
+            "SELECT key, value FROM meta WHERE key IN ('quantizer_file', 'codes_file')"
+        ).fetchall())
+        if stored.get("quantizer_file") != self._quantizer_file:
+            self._quantizer_file = stored.get("quantizer_file")
+            self.quantizer = load_quantizer(self.directory / self._quantizer_file) if self._quantizer_file else None
+            self._codes = None
+        codes_path = self.directory / stored.get("codes_file", "codes.bin")
+        if codes_path != self.codes_path:
+            self.codes_path = codes_path
+            self._codes = None
+
+        rows = self._db.execute("SELECT row, deleted FROM docs").fetchall()
+        self._n_rows = max((r for r, _ in rows), default=-1) + 1
+        self._live = np.zeros(self._n_rows, dtype=bool)
+        for r, deleted in rows:
+            self._live[r] = not deleted
+        self._map(self._n_rows)
+        self._map_codes(self._n_rows)
+        # Quantized search never reads the full matrix, so its pages stay out of memory
+        self._sq_norms = self._row_sq_norms(0, self._n_rows) if self.quantizer is None else np.zeros(0, dtype=np.float32)
+        self._code_sq_norms = self._codes_sq_norms(0, self._n_rows)
+
+        if not force and self._layout == old_layout and self._matrix is not None:
+            # Appended rows plus rows deleted since the last reload (a compaction renumbers rows: unknown)
+            old_rows = min(old_rows, self._n_rows)
+            rows = np.concatenate([
+                np.flatnonzero(old_live[:old_rows] & ~self._live[:old_rows]), np.arange(old_rows, self._n_rows)
+            ])
+            changed = np.asarray(self._matrix[rows], dtype=np.float32)
+        self._changed(changed)
+
+    def _codes_sq_norms(self, start: int, end: int) -> Optional[np.ndarray]:
+        if self.quantizer is None:
+            return None
+        if self._codes is None or end <= start:
+            return self.quantizer.sq_norms(np.zeros((0, self.quantizer.code_size), dtype=np.uint8))
+        return self.quantizer.sq_norms(self._codes[start:end])
+
+    def _read_rows_version(self) -> int:
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'rows_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _bump_rows_version(self):
+        """Record that rows were added, deleted or moved, so other processes reload (write transaction held)"""
+        self._rows_version = self._read_rows_version() + 1
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('rows_version', ?)", (str(self._rows_version),))
+
+    def _read_layout(self) -> int:
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'compactions'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _row_sq_norms(self, start: int, end: int) -> np.ndarray:
+        if self._matrix is None or end <= start:
+            return np.zeros(0, dtype=np.float32)
+        block = np.asarray(self._matrix[start:end], dtype=np.float32)
+        return np.einsum("ij,ij->i", block, block)
+
+    @staticmethod
+    def _where_sql(where: Optional[Dict]):
+        """Translate simple equality filters ({'topic': 'chess'}) into SQL"""
+        clauses, params = ["deleted = 0"], []
+        for key, value in (where or {}).items():
+            clauses.append("json_extract(metadata, ?) = ?")
+            params.extend([f"$.{key}", value])
+        return " AND ".join(clauses), params
+
+    # VectorBackend interface
+
+    def add(self, ids, embeddings, documents, metadatas):
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")  # Serializes writers across processes
+            try:
+                self._refresh()
+                if self.dim is None:
+                    self.dim = embeddings.shape[1]
+                    self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self.dim),))
+                elif embeddings.shape[1] != self.dim:
+                    raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match index ({self.dim})")
+
+                start = self._n_rows
+                end = start + len(ids)
+                self._map(end)
+                # Vectors are written (and flushed) before the rows become visible
+                self._matrix[start:end] = embeddings.astype(self.dtype)
+                self._matrix.flush()
+                if self.quantizer is not None:
+                    self._map_codes(end)
+                    self._codes[start:end] = self.quantizer.encode(embeddings)
+                    self._codes.flush()
+                self._db.executemany(
+                    "INSERT INTO docs (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                    [(start + i, doc_id, doc, json.dumps(meta or {}))
+                     for i, (doc_id, doc, meta) in enumerate(zip(ids, documents, metadatas))]
+                )
+                trained = self.quantization != "none" and self.quantizer is None and end >= QUANTIZATION_TRAIN_ROWS
+                if trained:
+                    self._train_quantizer(end)
+                self._bump_rows_version()
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+            if trained:
+                self._refresh(force=True, changed=embeddings)
+                return
+            self._changed(embeddings)
+            self._n_rows = end
+            self._live = np.concatenate([self._live, np.ones(end - start, dtype=bool)])
+            if self.quantizer is None:
+                self._sq_norms = np.concatenate([self._sq_norms, self._row_sq_norms(start, end)])
+            elif self._code_sq_norms is not None:
+                self._code_sq_norms = np.concatenate([self._code_sq_norms, self._codes_sq_norms(start, end)])
+
+    def _train_quantizer(self, n_rows: int):
+        """
+        Fit the quantizer on a sample of the stored vectors and encode every row
+
+        Runs inside the caller's write transaction: the quantizer and code files
+        become current for all processes when it commits.
+        """
+        started = time.monotonic()
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(n_rows, min(n_rows, TRAIN_SAMPLE_ROWS), replace=False))
+        quantizer = create_quantizer(self.quantization, self.dim)
+        quantizer.train(np.asarray(self._matrix[sample], dtype=np.float32))
+
+        quantizer_file = f"quantizer-{self.quantization}.npz"
+        quantizer.save(self.directory / quantizer_file)
+        codes = np.memmap(self.codes_path, dtype=np.uint8, mode="w+", shape=(max(1024, n_rows), quantizer.code_size))
+        for start in range(0, n_rows, ENCODE_CHUNK_ROWS):
+            end = min(n_rows, start + ENCODE_CHUNK_ROWS)
+            codes[start:end] = quantizer.encode(np.asarray(self._matrix[start:end], dtype=np.float32))
+        codes.flush()
+        del codes
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('quantizer_file', ?)", (quantizer_file,))
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES ('codes_file', ?)", (self.codes_path.name,))
+        logger.info(
+            f"Trained {self.quantization} quantizer on {len(sample)} vectors and encoded {n_rows} rows "
+            f"({quantizer.code_size} bytes per vector, {time.monotonic() - started:.1f}s)"
+        )
+
+    def query(self, embeddings, n_results):
+        queries = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            self._refresh()
+            layout = self._layout
+            n_rows = self._n_rows
+            live_count = int(self._live.sum()) if n_rows else 0
+            k = min(n_results, live_count)
+            if k == 0:
+                return _empty_query_result(len(queries))
+
+            if self.quantizer is None:
+                # Squared L2 = |x|^2 + |q|^2 - 2 x.q
+                q_norms = np.einsum("ij,ij->i", queries, queries)
+
+                def score(start, end):
+                    block = self._matrix[start:end]
+                    if block.dtype != np.float32:
+                        block = block.astype(np.float32)
+                    return self._sq_norms[start:end] + q_norms[:, None] - 2.0 * (queries @ block.T)
+
+                top, top_distances = self._search(len(queries), k, n_rows, score)
+            else:
+                # Approximate distances to the codes pick a shortlist, re-ranked exactly
+                prepared = self.quantizer.prepare(queries)
+                norms = self._code_sq_norms
+
+                def score(start, end):
+                    return self.quantizer.distances(
+                        prepared, self._codes[start:end], None if norms is None else norms[start:end]
+                    )
+
+                shortlist, _ = self._search(len(queries), min(live_count, k * max(1, QUANTIZATION_RERANK)), n_rows, score)
+                top, top_distances = self._rerank(queries, shortlist, k)
+
+        order = np.argsort(top_distances, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_distances = np.maximum(np.take_along_axis(top_distances, order, axis=1), 0.0)
+
+        rows = self._fetch_rows(sorted(set(top.ravel().tolist())))
+        with self._lock:
+            if self._read_layout() != layout:
+                # A compaction renumbered the rows after they were scored - search again
+                return self.query(embeddings, n_results)
+        result = _empty_query_result(len(queries))
+        for q, (row_ids, row_distances) in enumerate(zip(top, top_distances)):
+            for r, distance in zip(row_ids.tolist(), row_distances.tolist()):
+                doc_id, document, metadata = rows[r]
+                result["ids"][q].append(doc_id)
+                result["documents"][q].append(document)
+                result["metadatas"][q].append(metadata)
+                result["distances"][q].append(distance)
+        return result
+
+    def _search(self, n_queries: int, k: int, n_rows: int, score) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Each query's k best live rows, scored block by block (lock held)
+
+        Only the k best so far are kept per query, and blocks shrink as queries
+        grow, bounding the distance matrix.
+
+        Args:
+            n_queries: Number of queries
+            k: Rows to keep per query (at most the number of live rows)
+            n_rows: Rows to scan
+            score: score(start, end) -> (n_queries, end - start) distances
+
+        Returns:
+            (rows, distances), both (n_queries, k) and unordered
+        """
+        block_rows = max(1024, min(self.SEARCH_BLOCK_ROWS, self.SEARCH_MAX_CELLS // n_queries))
+        top_distances = np.empty((n_queries, 0), dtype=np.float32)
+        top = np.empty((n_queries, 0), dtype=np.int64)
+        for start in range(0, n_rows, block_rows):
+            end = min(start + block_rows, n_rows)
+            distances = score(start, end)
+            distances[:, ~self._live[start:end]] = np.inf
+            rows = np.broadcast_to(np.arange(start, end), distances.shape)
+            if end - start > k:
+                best = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                distances = np.take_along_axis(distances, best, axis=1)
+                rows = best + start
+            top_distances = np.concatenate([top_distances, distances], axis=1)
+            top = np.concatenate([top, rows], axis=1)
+            if top.shape[1] > k:
+                best = np.argpartition(top_distances, k - 1, axis=1)[:, :k]
+                top_distances = np.take_along_axis(top_distances, best, axis=1)
+                top = np.take_along_axis(top, best, axis=1)
+        return top, top_distances
+
+    def _rerank(self, queries: np.ndarray, shortlist: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact squared L2 distances of each query's shortlisted rows, keeping the k best (lock held)"""
+        rows = np.unique(shortlist)
+        vectors = np.asarray(self._matrix[rows], dtype=np.float32)  # Reads only the shortlisted rows
+        candidates = vectors[np.searchsorted(rows, shortlist)]  # (n_queries, shortlist, dim)
+        difference = candidates - queries[:, None, :]
+        distances = np.einsum("qsd,qsd->qs", difference, difference)
+        if shortlist.shape[1] > k:
+            best = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            return np.take_along_axis(shortlist, best, axis=1), np.take_along_axis(distances, best, axis=1)
+        return shortlist, distances
+
+    def _fetch_rows(self, rows: List[int]) -> Dict[int, tuple]:
+        """Documents and metadata for matrix rows"""
+        fetched = {}
+        with self._lock:
+            for start in range(0, len(rows), 500):  # Stay under SQLite's parameter limit
+                chunk = rows[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for r, doc_id, document, metadata in self._db.execute(
+                    f"SELECT row, id, document, metadata FROM docs WHERE row IN ({placeholders})", chunk
+                ):
+                    fetched[r] = (doc_id, document, json.loads(metadata or "{}"))
+        return fetched
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include_embeddings=False):
+        sql, params = self._where_sql(where)
+        if ids is not None:
+            if not ids:
+                return {"ids": [], "documents": [], "metadatas": [], **({"embeddings": []} if include_embeddings else {})}
+            sql += f" AND id IN ({','.join('?' * len(ids))})"
+            params.extend(ids)
+        sql += " ORDER BY row"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([limit if limit is not None else -1, offset or 0])
+
+        with self._lock:
+            self._refresh()
+            rows = self._db.execute(f"SELECT row, id, document, metadata FROM docs WHERE {sql}", params).fetchall()
+            result = {
+                "ids": [doc_id for _, doc_id, _, _ in rows],
+                "documents": [document for _, _, document, _ in rows],
+                "metadatas": [json.loads(metadata or "{}") for _, _, _, metadata in rows]
+            }
+            if include_embeddings:
+                result["embeddings"] = [np.asarray(self._matrix[r], dtype=np.float32) for r, _, _, _ in rows]
+        return result
+
+    def count(self, where=None):
+        sql, params = self._where_sql(where)
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM docs WHERE {sql}", params).fetchone()[0]
+
+    def find_content_hashes(self, hashes):
+        found = {}
+        hashes = list(hashes)
+        with self._lock:
+            for start in range(0, len(hashes), 500):  # Stay under SQLite's parameter limit
+                chunk = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                # Same expression as the docs_content_hash index, so this is an index lookup
+                for digest, doc_id in self._db.execute(
+                    "SELECT json_extract(metadata, '$.content_hash'), id FROM docs "
+                    f"WHERE json_extract(metadata, '$.content_hash') IN ({placeholders}) AND deleted = 0 ORDER BY row",
+                    chunk
+                ):
+                    found.setdefault(digest, doc_id)
+        return found
+
+    def page(self, where=None, limit=100, cursor=None):
+        # Keyset pagination on the row number - no OFFSET scan on deep pages
+        sql, params = self._where_sql(where)
+        sql += " AND row > ? ORDER BY row LIMIT ?"
+        params.extend([int(cursor) if cursor else -1, limit])
+        with self._lock:
+            rows = self._db.execute(f"SELECT row, id, document, metadata FROM docs WHERE {sql}", params).fetchall()
+        result = {
+            "ids": [doc_id for _, doc_id, _, _ in rows],
+            "documents": [document for _, _, document, _ in rows],
+            "metadatas": [json.loads(metadata or "{}") for _, _, _, metadata in rows]
+        }
+        next_cursor = str(rows[-1][0]) if len(rows) == limit else None
+        return result, next_cursor
+
+    def delete(self, ids):
+        if not ids:
+            return
+        with self._lock:
+            placeholders = ",".join("?" * len(ids))
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh()  # Other processes' rows are loaded before this commit is recorded as seen
+                rows = [r for (r,) in self._db.execute(f"SELECT row FROM docs WHERE id IN ({placeholders})", ids)]
+                # Tombstones - the rows are skipped by search until the index is compacted
+                self._db.execute(f"UPDATE docs SET deleted = 1 WHERE id IN ({placeholders})", ids)
+                self._bump_rows_version()
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            removed = [r for r in rows if r < len(self._live) and self._live[r]]
+            self._live[removed] = False
+            self._changed(np.asarray(self._matrix[removed], dtype=np.float32) if removed else np.zeros((0, self.dim or 0)))
+
+    def update_metadatas(self, ids, metadatas):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE docs SET metadata = ? WHERE id = ?",
+                [(json.dumps(meta or {}), doc_id) for doc_id, meta in zip(ids, metadatas)]
+            )
+
+    def patch_metadatas(self, ids, patches):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE docs SET metadata = json_patch(COALESCE(metadata, '{}'), ?) WHERE id = ?",
+                [(json.dumps(patch), doc_id) for doc_id, patch in zip(ids, patches)]
+            )
+
+    def record_usage(self, usage):
+        # Updated in place by SQLite, so concurrent writers cannot lose each other's hits
+        with self._lock:
+            self._db.executemany(
+                "UPDATE docs SET metadata = json_set(metadata, "
+                "'$.retrieval_hits', COALESCE(json_extract(metadata, '$.retrieval_hits'), 0) + ?, "
+                "'$.last_used', MAX(COALESCE(json_extract(metadata, '$.last_used'), 0), ?)) WHERE id = ?",
+                [(hits, last_used, doc_id) for doc_id, (hits, last_used) in usage.items()]
+            )
+
+    def compact(self):
+        """
+        Rewrite the index without its deleted rows
+
+        Live vectors are copied to a new embedding file, which becomes current in
+        the same SQLite transaction that renumbers the rows, so other processes see
+        either the old or the new layout and remap on their next refresh.
+        Cursors returned by page() before a compaction are invalidated.
+
+        Returns:
+            Row counts before and after
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")  # Blocks writers in all processes
+            new_path = new_codes_path = None
+            try:
+                self._refresh()
+                rows_before = self._n_rows
+                live = np.flatnonzero(self._live[:rows_before])
+                if len(live) == rows_before:
+                    self._db.execute("ROLLBACK")
+                    return {"rows_before": rows_before, "rows_after": rows_before}
+
+                layout = self._read_layout() + 1
+                new_path = self.directory / f"embeddings-{layout}.bin"
+                if self.dim is not None and len(live):
+                    target = np.memmap(new_path, dtype=self.dtype, mode="w+", shape=(len(live), self.dim))
+                    for start in range(0, len(live), self.SEARCH_BLOCK_ROWS):
+                        chunk = live[start:start + self.SEARCH_BLOCK_ROWS]
+                        target[start:start + len(chunk)] = self._matrix[chunk]
+                    target.flush()
+                    del target
+                else:
+                    new_path.write_bytes(b"")
+                if self.quantizer is not None:
+                    new_codes_path = self.directory / f"codes-{layout}.bin"
+                    codes = np.memmap(new_codes_path, dtype=np.uint8, mode="w+",
+                                      shape=(max(1, len(live)), self.quantizer.code_size))
+                    for start in range(0, len(live), self.SEARCH_BLOCK_ROWS):
+                        chunk = live[start:start + self.SEARCH_BLOCK_ROWS]
+                        codes[start:start + len(chunk)] = self._codes[chunk]
+                    codes.flush()
+                    del codes
+                    self._db.execute("INSERT OR REPLACE INTO meta VALUES ('codes_file', ?)", (new_codes_path.name,))
+
+                self._db.execute("DELETE FROM docs WHERE deleted = 1")
+                # Ascending order never moves a row onto one that is still occupied
+                self._db.executemany(
+                    "UPDATE docs SET row = ? WHERE row = ?",
+                    [(new, int(old)) for new, old in enumerate(live) if new != old]
+                )
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('matrix_file', ?)", (new_path.name,))
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('compactions', ?)", (str(layout),))
+                self._bump_rows_version()
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                for path in (new_path, new_codes_path):
+                    if path is not None and path.exists():
+                        path.unlink()
+                raise
+
+            old_paths = [self.matrix_path, self.codes_path]
+            # Only rows that were already deleted are gone, so search results are unchanged
+            self._refresh(force=True, changed=np.zeros((0, self.dim or 0)))
+            # Processes still mapping the old files keep them readable until they remap
+            for path in old_paths:
+                if path not in (self.matrix_path, self.codes_path):
+                    path.unlink(missing_ok=True)
+            self._db.execute("VACUUM")  # Return the deleted documents' pages to the filesystem
+        logger.info(f"Compacted NumPy index from {rows_before} to {len(live)} rows")
+        return {"rows_before": rows_before, "rows_after": len(live)}
+
+    def storage_bytes(self):
+        return _directory_bytes(self.directory)
+
+    @property
+    def epoch(self) -> int:
+        with self._lock:
+            self._refresh()  # Another process's commit is a change too
+            return self._epoch
+
+    @property
+    def search_bytes_per_vector(self) -> int:
+        """Bytes per row that search scans and keeps in memory (codes once quantized, else the vector)"""
+        if self.quantizer is not None:
+            return self.quantizer.code_size + (4 if self._code_sq_norms is not None else 0)
+        return (self.dim or 0) * self.dtype.itemsize + 4  # Plus the cached squared norm
+
+    @property
+    def location(self) -> Path:
+        return self.directory
+
+DEFAULT_LOCATIONS = {"numpy": NUMPY_INDEX_DIR, "chromadb": KNOWLEDGE_DB_DIR}
+
+def current_location(name: str = VECTOR_BACKEND) -> Path:
+    """Directory of a backend's active store (moved by snapshot imports, see app/snapshot.py)"""
+    try:
+        with open(KNOWLEDGE_STORE_POINTER, "r", encoding="utf-8") as f:
+            locations = json.load(f)
+    except FileNotFoundError:
+        locations = {}
+    if name in locations:
+        return KNOWLEDGE_STORE_POINTER.parent / locations[name]
+    return DEFAULT_LOCATIONS[name]
+
+def set_current_location(name: str, location: Path):
+    """
+    Make location the active store for a backend
+
+    The pointer file is replaced atomically, so a process opening the store sees
+    either the old or the new location.
+    """
+    try:
+        with open(KNOWLEDGE_STORE_POINTER, "r", encoding="utf-8") as f:
+            locations = json.load(f)
+    except FileNotFoundError:
+        locations = {}
+    location = Path(location)
+    try:
+        locations[name] = str(location.relative_to(KNOWLEDGE_STORE_POINTER.parent))
+    except ValueError:
+        locations[name] = str(location.resolve())  # Outside the data directory
+    temp_path = KNOWLEDGE_STORE_POINTER.with_suffix(".tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(locations, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, KNOWLEDGE_STORE_POINTER)
+
+def create_backend(name: str = VECTOR_BACKEND, location: Optional[Path] = None) -> VectorBackend:
+    """
+    Build the vector backend selected in app/config.py
+
+    Args:
+        name: "chromadb" or "numpy"
+        location: Store directory (defaults to the backend's active store)
+    """
+    if name not in DEFAULT_LOCATIONS:
+        raise ValueError(f"Unknown vector backend: {name} (expected 'chromadb' or 'numpy')")
+    location = Path(location) if location is not None else current_location(name)
+    if name == "numpy":
+        return NumpyBackend(location)
+    return ChromaBackend(location)
@@ -0,0 +1,282 @@
+"""
+Single-writer access to the vector store for the pre-fork server
+One writer process owns all knowledge writes; worker processes read from their
+own local view of the store and forward writes to it over a unix socket
+"""
+import logging
+import os
+import signal
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+from app.config import KNOWLEDGE_REFRESH_INTERVAL
+from app.vector_store import ChangeJournal, VectorBackend, create_backend, current_location, set_current_location
+
+logger = logging.getLogger(__name__)
+
+# Backend methods that modify the store and must go through the writer
+WRITE_METHODS = ("add", "delete", "update_metadatas", "patch_metadatas", "record_usage", "compact")
+# Writes that do not bump the generation: usage counters and merged hit counts are read
+# from the store's metadata tables directly and do not change search results, so
+# workers need not reload
+UNVERSIONED_METHODS = ("record_usage", "patch_metadatas")
+
+# (address, authkey, generation) once the pre-fork server has started a writer
+_writer = None
+
+def use_writer(address: Path, authkey: bytes, generation):
+    """
+    Route knowledge writes in this process (and processes forked from it) to a writer
+
+    Args:
+        address: Unix socket path the writer listens on
+        authkey: Shared secret for the connection handshake
+        generation: Shared multiprocessing.Value the writer bumps after every write (except metadata patches)
+    """
+    global _writer
+    _writer = (str(address), authkey, generation)
+
+def open_backend() -> VectorBackend:
+    """The configured vector backend, wrapped to forward writes when a writer is in use"""
+    backend = create_backend()
+    if _writer is None:
+        return backend
+    return RemoteWriterBackend(backend, *_writer)
+
+def switch_backend(current: VectorBackend, loaded: VectorBackend) -> VectorBackend:
+    """
+    Make a newly loaded store (e.g. an imported snapshot) the active one
+
+    With a writer, the writer switches first and every worker reopens its local
+    view on its next refresh; in-flight reads finish on the old store.
+
+    Args:
+        current: Backend in use (from open_backend)
+        loaded: Backend opened on the new store's directory
+
+    Returns:
+        The backend to use from now on
+    """
+    if isinstance(current, RemoteWriterBackend):
+        current.switch_store(str(loaded.location))
+        return current
+    set_current_location(loaded.name, loaded.location)
+    return loaded
+
+def serve_writer(address: Path, authkey: bytes, generation):
+    """
+    Writer process main loop: apply write requests from workers one at a time
+
+    Each connection is served on its own thread; writes are serialized with a lock.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor decides when to stop
+
+    backend = create_backend()
+    write_lock = threading.Lock()
+    # Embeddings changed at each generation, for workers' response cache invalidation
+    journal = ChangeJournal()
+    journal.record(generation.value, None)  # Changes before this writer started are unknown
+
+    address = Path(address)
+    if address.exists():
+        address.unlink()  # Left over from an earlier run
+    listener = Listener(str(address), family="AF_UNIX", authkey=authkey)
+    logger.info(f"Knowledge writer listening on {address} (pid {os.getpid()})")
+
+    def switch_store(location: str):
+        nonlocal backend
+        backend = create_backend(backend.name, Path(location))
+        set_current_location(backend.name, backend.location)
+        logger.info(f"Knowledge writer switched to {location}")
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if method == "changed_embeddings":
+                    conn.send(("ok", journal.since(*args)))
+                    continue
+                if method not in WRITE_METHODS and method != "switch_store":
+                    conn.send(("error", f"Unsupported writer method: {method}"))
+                    continue
+                try:
+                    with write_lock:
+                        if method == "switch_store":
+                            result = switch_store(*args)
+                            changed = None
+                        else:
+                            epoch = backend.epoch
+                            result = getattr(backend, method)(*args, **kwargs)
+                            changed = backend.changed_embeddings(epoch)
+                        if method not in UNVERSIONED_METHODS:
+                            with generation.get_lock():
+                                generation.value += 1
+                                journal.record(generation.value, changed)
+                    conn.send(("ok", result))
+                except Exception as e:
+                    logger.error(f"Knowledge writer {method} failed: {e}")
+                    conn.send(("error", str(e)))
+
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            logger.warning(f"Rejected knowledge writer connection: {e}")
+            continue
+        threading.Thread(target=handle, args=(conn,), name="knowledge-writer-conn", daemon=True).start()
+
+class RemoteWriterBackend(VectorBackend):
+    """
+    Serves reads from a local backend and forwards writes to the writer process
+
+    After any write (by this or another worker) the shared generation changes and
+    the local backend is refreshed, at most every KNOWLEDGE_REFRESH_INTERVAL
+    seconds for writes made elsewhere.
+    """
+
+    def __init__(self, local: VectorBackend, address: str, authkey: bytes, generation):
+        self.local = local
+        self.name = local.name
+        self.address = address
+        self.authkey = authkey
+        self.generation = generation
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._seen_generation = generation.value
+        self._epoch = self._seen_generation  # Generation the local view was last refreshed at
+        self._refreshed_at = 0.0
+        # Reads run concurrently; a refresh waits for them and blocks new ones
+        self._readers = 0
+        self._refreshing = False
+        self._state = threading.Condition()
+
+    def _call(self, method: str, *args, **kwargs):
+        """Send one write to the writer and wait for its result"""
+        result = self._request(method, *args, **kwargs)
+        self._sync(force=True)
+        return result
+
+    def _request(self, method: str, *args, **kwargs):
+        """Send one request to the writer and return its result"""
+        with self._conn_lock:
+            try:
+                if self._conn is None:
+                    self._conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+                self._conn.send((method, args, kwargs))
+            except OSError:
+                # Stale connection (writer restarted) - the request was not sent, so retry once
+                self._conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+                self._conn.send((method, args, kwargs))
+            try:
+                status, result = self._conn.recv()
+            except (EOFError, OSError):
+                self._conn = None
+                raise RuntimeError(f"Lost connection to the knowledge writer during {method}")
+
+        if status != "ok":
+            raise RuntimeError(f"Knowledge writer {method} failed: {result}")
+        return result
+
+    def _sync(self, force: bool = False):
+        """Refresh the local view if any process has written since the last refresh"""
+        generation = self.generation.value
+        if generation == self._seen_generation:
+            return
+        now = time.monotonic()
+        if not force and now - self._refreshed_at < KNOWLEDGE_REFRESH_INTERVAL:
+            return
+
+        with self._state:
+            if self._refreshing or generation == self._seen_generation:
+                return
+            self._refreshing = True
+            self._state.wait_for(lambda: self._readers == 0)
+        try:
+            self._seen_generation = generation
+            self._refreshed_at = now
+            location = current_location(self.name)
+            if location.resolve() != Path(self.local.location).resolve():
+                # The writer switched stores (snapshot import)
+                self.local = create_backend(self.name, location)
+            else:
+                self.local.refresh()
+            self._epoch = generation
+        except Exception as e:
+            logger.error(f"Error refreshing vector backend: {e}")
+        finally:
+            with self._state:
+                self._refreshing = False
+                self._state.notify_all()
+
+    def _read(self, method: str, *args, **kwargs):
+        """Run a read on the local backend, never concurrently with a refresh"""
+        self._sync()
+        with self._state:
+            self._state.wait_for(lambda: not self._refreshing)
+            self._readers += 1
+        try:
+            return getattr(self.local, method)(*args, **kwargs)
+        finally:
+            with self._state:
+                self._readers -= 1
+                if not self._readers:
+                    self._state.notify_all()
+
+    def add(self, ids, embeddings, documents, metadatas):
+        return self._call("add", ids, embeddings, documents, metadatas)
+
+    def delete(self, ids):
+        return self._call("delete", ids)
+
+    def update_metadatas(self, ids, metadatas):
+        return self._call("update_metadatas", ids, metadatas)
+
+    def patch_metadatas(self, ids, patches):
+        return self._call("patch_metadatas", ids, patches)
+
+    def record_usage(self, usage):
+        return self._call("record_usage", usage)
+
+    def compact(self):
+        return self._call("compact")
+
+    def switch_store(self, location: str):
+        return self._call("switch_store", location)
+
+    def query(self, embeddings, n_results):
+        return self._read("query", embeddings, n_results)
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include_embeddings=False):
+        return self._read("get", ids=ids, where=where, limit=limit, offset=offset, include_embeddings=include_embeddings)
+
+    def count(self, where=None):
+        return self._read("count", where=where)
+
+    def find_content_hashes(self, hashes):
+        return self._read("find_content_hashes", hashes)
+
+    def page(self, where=None, limit=100, cursor=None):
+        return self._read("page", where=where, limit=limit, cursor=cursor)
+
+    def storage_bytes(self):
+        return self._read("storage_bytes")
+
+    def changed_embeddings(self, since):
+        # The writer knows every process's changes; the local view only its refreshes
+        try:
+            return self._request("changed_embeddings", since)
+        except Exception as e:
+            logger.error(f"Error reading knowledge changes from the writer: {e}")
+            return None
+
+    @property
+    def location(self):
+        return self.local.location
+
+    def refresh(self):
+        self._sync(force=True)
@@ -0,0 +1,4 @@
+"""
+Performance benchmarks
+Run each module with python -m benchmarks.<name>
+"""
@@ -0,0 +1,122 @@
+"""
+Shared helpers for the benchmark suite
+Timing, latency summaries and the JSON result format read by benchmarks.compare
+"""
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import numpy as np
+
+# Result format version, bumped when keys change meaning
+RESULTS_VERSION = 1
+
+def prepare_stub_environment() -> Path:
+    """
+    Point the app at a throwaway data directory and the NumPy vector backend
+
+    Must run before app.config is imported. Explicit DATA_DIR/VECTOR_BACKEND
+    settings are kept.
+
+    Returns:
+        The data directory in use
+    """
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench-data-"))
+    os.environ.setdefault("VECTOR_BACKEND", "numpy")
+    return Path(os.environ["DATA_DIR"])
+
+def summarize(seconds: List[float]) -> Dict:
+    """
+    Latency summary of a list of durations
+
+    Returns:
+        {"n", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"}
+    """
+    if not seconds:
+        return {"n": 0}
+    values = np.asarray(seconds, dtype=np.float64) * 1000.0
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "n": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(values.max()), 3)
+    }
+
+def time_calls(fn: Callable[[int], object], runs: int, warmup: int = 1) -> Dict:
+    """
+    Call fn(i) warmup + runs times and summarize the timed runs
+
+    fn receives the run index so callers can vary inputs (e.g. to miss caches).
+    """
+    for i in range(warmup):
+        fn(-1 - i)
+    timings = []
+    for i in range(runs):
+        started = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
+
+def git_revision() -> Optional[str]:
+    """Short commit hash of the working tree, if it is a git checkout"""
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, cwd=Path(__file__).parent, timeout=5
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return completed.stdout.strip() or None
+
+def environment(**extra) -> Dict:
+    """Metadata stored next to the results so baselines from different machines are recognizable"""
+    return {
+        "version": RESULTS_VERSION,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor() or platform.machine(),
+        **extra
+    }
+
+def write_results(path: Optional[str], suite: str, results: Dict[str, Dict], **meta):
+    """
+    Print results and optionally save them as JSON
+
+    Args:
+        path: Output file (None prints only)
+        suite: Benchmark suite name ("micro", "load")
+        results: Benchmark name -> summary dictionary
+        meta: Extra run metadata (stub mode, sizes, ...)
+    """
+    document = {"suite": suite, "meta": environment(**meta), "results": results}
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name:<40} failed: {result['error']}")
+        elif "p50_ms" in result:
+            line = f"{name:<40} p50 {result['p50_ms']:>10.3f} ms  p95 {result['p95_ms']:>10.3f} ms  p99 {result['p99_ms']:>10.3f} ms"
+            if "throughput_rps" in result:
+                line += f"  {result['throughput_rps']:>8.2f} req/s"
+            print(line)
+    if path:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        print(f"Results written to {path}")
+
+def load_results(path: str) -> Dict:
+    """Read a results file written by write_results"""
+    with open(path, "r") as f:
+        document = json.load(f)
+    if document.get("meta", {}).get("version") != RESULTS_VERSION:
+        raise ValueError(f"{path}: unsupported results version {document.get('meta', {}).get('version')}")
+    return document
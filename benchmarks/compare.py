@@ -0,0 +1,81 @@
+"""
+Compare benchmark results against a stored baseline
+
+Usage:
+    python -m benchmarks.compare benchmarks/baseline/micro.json benchmarks/results/micro.json
+    python -m benchmarks.compare baseline.json current.json --threshold 0.2 --metrics p50_ms p99_ms
+
+Prints the relative change of each metric and exits with status 1 when any
+metric got worse by more than --threshold (latencies up, throughput down).
+"""
+import argparse
+import sys
+from typing import Dict, List
+from benchmarks.common import load_results
+
+DEFAULT_METRICS = ["p50_ms", "p95_ms", "p99_ms", "throughput_rps"]
+HIGHER_IS_BETTER = {"throughput_rps"}
+
+def compare(baseline: Dict[str, Dict], current: Dict[str, Dict], metrics: List[str], threshold: float) -> List[Dict]:
+    """
+    Relative change of each metric present in both result sets
+
+    Returns:
+        Rows of {"benchmark", "metric", "baseline", "current", "change", "regression"}
+    """
+    rows = []
+    for name in sorted(set(baseline) & set(current)):
+        for metric in metrics:
+            before, after = baseline[name].get(metric), current[name].get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before if before else 0.0
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            rows.append({
+                "benchmark": name,
+                "metric": metric,
+                "baseline": before,
+                "current": after,
+                "change": change,
+                "regression": worse > threshold
+            })
+    return rows
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare benchmark results with a baseline")
+    parser.add_argument("baseline", help="Baseline results JSON")
+    parser.add_argument("current", help="New results JSON")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed relative slowdown (0.10 = 10%%)")
+    parser.add_argument("--metrics", nargs="+", default=DEFAULT_METRICS, help="Metrics to compare")
+    args = parser.parse_args(argv)
+
+    baseline = load_results(args.baseline)
+    current = load_results(args.current)
+    if baseline["suite"] != current["suite"]:
+        print(f"Warning: comparing a {current['suite']} run against a {baseline['suite']} baseline")
+    for key in ("git", "processor", "stub"):
+        if baseline["meta"].get(key) != current["meta"].get(key):
+            print(f"Note: {key} differs (baseline {baseline['meta'].get(key)}, current {current['meta'].get(key)})")
+
+    rows = compare(baseline["results"], current["results"], args.metrics, args.threshold)
+    print(f"{'benchmark':<40} {'metric':<15} {'baseline':>12} {'current':>12} {'change':>8}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['benchmark']:<40} {row['metric']:<15} {row['baseline']:>12.3f} "
+            f"{row['current']:>12.3f} {row['change']:>+7.1%}{flag}"
+        )
+
+    for name in sorted(set(baseline["results"]) - set(current["results"])):
+        print(f"Missing from current run: {name}")
+    for name in sorted(set(current["results"]) - set(baseline["results"])):
+        print(f"New benchmark (no baseline): {name}")
+
+    regressions = sum(1 for row in rows if row["regression"])
+    if regressions:
+        print(f"{regressions} metric(s) regressed by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Embedding backend benchmark
+Compares query latency, throughput under concurrency, CPU per query and
+agreement with fp32 of the EMBEDDING_BACKEND settings, with and without
+cross-request batching
+
+Usage:
+    python -m benchmarks.embedding_backends
+    python -m benchmarks.embedding_backends --backends torch-fp32 torch-int8 --threads 16 --queries 50
+
+Each configuration is measured in a fresh subprocess with the query cache
+disabled, so every call reaches the encoder.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
+from benchmarks.common import summarize
+
+DEFAULT_BACKENDS = ["torch-fp32", "torch-int8", "onnx"]
+QUERIES = [
+    "How does the king move in chess?",
+    "What is the capital of France?",
+    "Explain how photosynthesis works in plants",
+    "What time does the library open on weekends?"
+]
+
+def measure(backend: str, batching: bool, threads: int, queries: int) -> Dict:
+    """
+    Load the encoder and time sequential and concurrent queries (runs in the worker process)
+
+    Returns:
+        Result dictionary for the configuration
+    """
+    os.environ["EMBEDDING_BACKEND"] = backend
+    os.environ["EMBEDDING_CACHE_SIZE"] = "0"
+    if not batching:
+        os.environ["EMBEDDING_BATCH_MAX_SIZE"] = "1"
+    from app.embeddings import EmbeddingModel
+
+    started = time.perf_counter()
+    model = EmbeddingModel()
+    load_seconds = time.perf_counter() - started
+
+    for query in QUERIES:
+        model.encode(query)  # Warm-up
+
+    # One query at a time: the latency a lone chat request sees
+    sequential = []
+    for i in range(queries):
+        query_started = time.perf_counter()
+        model.encode(f"{QUERIES[i % len(QUERIES)]} {i}")
+        sequential.append(time.perf_counter() - query_started)
+
+    # Concurrent callers, as under load
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def caller(index: int):
+        for i in range(queries):
+            query_started = time.perf_counter()
+            model.encode(f"{QUERIES[(index + i) % len(QUERIES)]} {index}-{i}")
+            with lock:
+                latencies.append(time.perf_counter() - query_started)
+
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    workers = [threading.Thread(target=caller, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+
+    concurrent = summarize(latencies)
+    return {
+        "backend": model.backend,
+        "batching": batching,
+        "load_seconds": round(load_seconds, 2),
+        "min_cosine": model.verified_similarity if model.verified_similarity is not None else 1.0,
+        "sequential_p50_ms": summarize(sequential)["p50_ms"],
+        "concurrent_p50_ms": concurrent["p50_ms"],
+        "concurrent_p99_ms": concurrent["p99_ms"],
+        "queries_per_sec": round(len(latencies) / wall, 1) if wall > 0 else 0.0,
+        "cpu_ms_per_query": round(cpu / len(latencies) * 1000.0, 3) if latencies else 0.0
+    }
+
+def run_config(backend: str, batching: bool, threads: int, queries: int) -> Dict:
+    """Measure one configuration in a subprocess"""
+    command = [
+        sys.executable, "-m", "benchmarks.embedding_backends", "--worker",
+        "--backends", backend, "--threads", str(threads), "--queries", str(queries)
+    ]
+    if not batching:
+        command.append("--no-batching")
+    completed = subprocess.run(command, capture_output=True, text=True)
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        error = completed.stderr.strip().splitlines()
+        return {"backend": backend, "batching": batching, "error": error[-1] if error else f"exit code {completed.returncode}"}
+    return json.loads(lines[-1])
+
+def print_table(results: List[Dict]):
+    print(f"{'backend':<12} {'batch':>5} {'load s':>7} {'cos':>7} {'seq p50':>8} {'conc p50':>9} {'conc p99':>9} {'q/s':>8} {'CPU ms/q':>9}")
+    for result in results:
+        batching = "on" if result["batching"] else "off"
+        if "error" in result:
+            print(f"{result['backend']:<12} {batching:>5} failed: {result['error']}")
+            continue
+        print(
+            f"{result['backend']:<12} {batching:>5} {result['load_seconds']:>7.2f} {result['min_cosine']:>7.4f} "
+            f"{result['sequential_p50_ms']:>8.2f} {result['concurrent_p50_ms']:>9.2f} {result['concurrent_p99_ms']:>9.2f} "
+            f"{result['queries_per_sec']:>8.1f} {result['cpu_ms_per_query']:>9.3f}"
+        )
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare embedding backends and cross-request batching")
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS, help="Backends to measure")
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent callers")
+    parser.add_argument("--queries", type=int, default=30, help="Queries per caller")
+    parser.add_argument("--no-batching", action="store_true", help="Only measure without batching")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    threads, queries = max(1, args.threads), max(1, args.queries)
+    if args.worker:
+        print(json.dumps(measure(args.backends[0], not args.no_batching, threads, queries)))
+        return 0
+
+    modes = [False] if args.no_batching else [False, True]
+    results = [run_config(backend, batching, threads, queries) for backend in args.backends for batching in modes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
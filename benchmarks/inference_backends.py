@@ -0,0 +1,128 @@
+"""
+Inference backend benchmark
+Compares load time, generation throughput (tokens/sec) and resident memory of
+the chat model (MODEL_NAME) across INFERENCE_BACKEND settings
+
+Usage:
+    python -m benchmarks.inference_backends
+    python -m benchmarks.inference_backends --backends torch-fp32 torch-int8 --tokens 64 --runs 5
+
+Each backend is measured in a fresh subprocess so resident memory is not
+shared between them.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+DEFAULT_BACKENDS = ["torch-fp32", "torch-int8", "onnx"]
+DEFAULT_PROMPT = "The rules of chess are simple once you know how each piece moves."
+
+def rss_mb() -> float:
+    """Current resident set size of this process in MB (Linux)"""
+    try:
+        with open("/proc/self/status", "r") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+def measure(backend: str, prompt: str, tokens: int, runs: int) -> Dict:
+    """
+    Load the model with one backend and time greedy generation (runs in the worker process)
+
+    Returns:
+        Result dictionary for the backend
+    """
+    os.environ["INFERENCE_BACKEND"] = backend
+    import torch
+    from app.model import Phi2Model
+
+    baseline_rss = rss_mb()
+    started = time.perf_counter()
+    model = Phi2Model()
+    load_seconds = time.perf_counter() - started
+
+    tokenizer = model._tokenizer
+    inputs = tokenizer(prompt, return_tensors="pt").to(model._model.device)
+    # Force exactly `tokens` new tokens so every backend does the same work
+    kwargs = dict(
+        max_new_tokens=tokens,
+        min_new_tokens=tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id
+    )
+
+    with torch.no_grad():
+        model._model.generate(**inputs, **kwargs)  # Warm-up
+
+        timings: List[float] = []
+        for _ in range(runs):
+            run_started = time.perf_counter()
+            model._model.generate(**inputs, **kwargs)
+            timings.append(time.perf_counter() - run_started)
+
+    timings.sort()
+    median = timings[len(timings) // 2]
+    return {
+        "backend": model.backend,
+        "load_seconds": round(load_seconds, 2),
+        "tokens": tokens,
+        "median_seconds": round(median, 4),
+        "tokens_per_sec": round(tokens / median, 2) if median > 0 else 0.0,
+        "rss_mb": round(rss_mb(), 1),
+        "model_rss_mb": round(rss_mb() - baseline_rss, 1)
+    }
+
+def run_backend(backend: str, prompt: str, tokens: int, runs: int) -> Dict:
+    """Measure one backend in a subprocess"""
+    command = [
+        sys.executable, "-m", "benchmarks.inference_backends", "--worker",
+        "--backends", backend, "--tokens", str(tokens), "--runs", str(runs), "--prompt", prompt
+    ]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        error = completed.stderr.strip().splitlines()
+        return {"backend": backend, "error": error[-1] if error else f"exit code {completed.returncode}"}
+    return json.loads(lines[-1])
+
+def print_table(results: List[Dict]):
+    print(f"{'backend':<12} {'load s':>8} {'tok/s':>8} {'RSS MB':>8} {'model MB':>9}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['backend']:<12} failed: {result['error']}")
+            continue
+        print(
+            f"{result['backend']:<12} {result['load_seconds']:>8.2f} {result['tokens_per_sec']:>8.2f} "
+            f"{result['rss_mb']:>8.1f} {result['model_rss_mb']:>9.1f}"
+        )
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare chat model inference backends")
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS, help="Backends to measure")
+    parser.add_argument("--tokens", type=int, default=32, help="New tokens per generation")
+    parser.add_argument("--runs", type=int, default=3, help="Timed generations per backend")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT, help="Prompt to generate from")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(measure(args.backends[0], args.prompt, args.tokens, max(1, args.runs))))
+        return 0
+
+    results = [run_backend(backend, args.prompt, args.tokens, max(1, args.runs)) for backend in args.backends]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Load generator for the chat and teach endpoints
+Sends requests at a fixed rate (open loop) and reports p50/p95/p99 latency and
+throughput for each endpoint
+
+Usage:
+    python -m benchmarks.load --stub --rps 20 --duration 30 --output benchmarks/results/load.json
+    python -m benchmarks.load --url http://localhost:8000 --endpoints chat --rps 2
+
+Requests are sent on schedule whether or not earlier ones have finished, and
+latency is measured from each request's scheduled send time, so a server that
+falls behind shows up as growing latency instead of a lower request rate.
+Only 200 responses count towards latency and throughput; other statuses
+(e.g. 429 when the inference queue is full) are reported separately.
+
+With --stub a server with stub models (benchmarks.stub_server) is started on
+--port and stopped afterwards. Against a real server, /teach stores benchmark
+documents under the topic "benchmark".
+
+Requires httpx (pip install -r benchmarks/requirements.txt).
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+from collections import Counter
+from typing import Dict, List
+import httpx
+from benchmarks.common import summarize, write_results
+
+ENDPOINTS = ["chat", "teach"]
+
+QUESTIONS = [
+    "How does the king move in chess?",
+    "What is the capital of France?",
+    "Explain how photosynthesis works",
+    "What time does the library open on weekends?",
+    "How do I reset my password?",
+    "Which planet is closest to the sun?"
+]
+
+def payload(endpoint: str, index: int) -> Dict:
+    """Request body number index for an endpoint (distinct bodies so caches see realistic traffic)"""
+    if endpoint == "chat":
+        return {"message": f"{QUESTIONS[index % len(QUESTIONS)]} ({index})"}
+    return {
+        "knowledge": f"Benchmark fact {index}: item {index} is stored on shelf {index % 97} in aisle {index % 13}.",
+        "topic": "benchmark"
+    }
+
+async def run_phase(client: httpx.AsyncClient, endpoint: str, rps: float, duration: float,
+                    max_in_flight: int) -> Dict:
+    """
+    Drive one endpoint at a fixed request rate
+
+    Returns:
+        Latency summary plus throughput, status and error counts
+    """
+    loop = asyncio.get_running_loop()
+    total = max(1, int(rps * duration))
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    errors: Counter = Counter()
+    slots = asyncio.Semaphore(max_in_flight)
+    started = loop.time()
+
+    async def send(index: int, scheduled: float):
+        async with slots:
+            try:
+                response = await client.post(f"/{endpoint}", json=payload(endpoint, index))
+            except httpx.HTTPError as e:
+                errors[type(e).__name__] += 1
+                return
+        statuses[str(response.status_code)] += 1
+        if response.status_code == 200:
+            latencies.append(loop.time() - scheduled)
+
+    tasks = []
+    for index in range(total):
+        scheduled = started + index / rps
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(index, scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - started
+
+    result = summarize(latencies)
+    result.update({
+        "target_rps": rps,
+        "requests": total,
+        "ok": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed > 0 else 0.0,
+        "statuses": dict(statuses),
+        "errors": dict(errors)
+    })
+    return result
+
+async def run_load(url: str, endpoints: List[str], rps: float, duration: float,
+                   max_in_flight: int, timeout: float) -> Dict[str, Dict]:
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        results = {}
+        for endpoint in endpoints:
+            # Warm up connections and lazily initialized paths
+            for index in range(3):
+                await client.post(f"/{endpoint}", json=payload(endpoint, -1 - index))
+            results[f"load.{endpoint}"] = await run_phase(client, endpoint, rps, duration, max_in_flight)
+        return results
+
+def start_stub_server(port: int, decode_ms: float, timeout: float = 120) -> subprocess.Popen:
+    """Start benchmarks.stub_server and wait until /ready answers 200"""
+    server = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.stub_server", "--port", str(port), "--decode-ms", str(decode_ms)
+    ])
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Stub server exited with code {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/ready", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("Stub server did not become ready")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Fixed-rate load test of /chat and /teach")
+    parser.add_argument("--url", default="http://localhost:8000", help="API base URL (ignored with --stub)")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS, help="Endpoints to drive, one phase each")
+    parser.add_argument("--rps", type=float, default=5.0, help="Requests per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per endpoint")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Concurrent requests cap")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument("--stub", action="store_true", help="Start a local server with stub models")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the stub server")
+    parser.add_argument("--decode-ms", type=float, default=5.0, help="Stub milliseconds per generated token")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    if args.rps <= 0:
+        parser.error("--rps must be positive")
+
+    server = start_stub_server(args.port, args.decode_ms) if args.stub else None
+    url = f"http://127.0.0.1:{args.port}" if args.stub else args.url
+    try:
+        results = asyncio.run(run_load(url, args.endpoints, args.rps, args.duration,
+                                       max(1, args.max_in_flight), args.timeout))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(30)
+
+    write_results(args.output, "load", results, stub=args.stub, url=url, rps=args.rps,
+                  duration=args.duration, decode_ms=args.decode_ms if args.stub else None)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Micro-benchmarks of the chat and teach hot paths
+Times EmbeddingModel.encode (single and batched), KnowledgeStore retrieval over
+synthetic corpora of several sizes, Phi2Model.generate and response post-processing
+
+Usage:
+    python -m benchmarks.micro --stub --output benchmarks/results/micro.json
+    python -m benchmarks.micro --sizes 1000 100000 --runs 50
+    python -m benchmarks.micro --only postprocess encode
+
+With --stub no models are downloaded: embeddings come from feature hashing and
+generation sleeps per token (see benchmarks.stubs), so encode/generate numbers
+only measure the surrounding code. Stub runs use a temporary data directory and
+the NumPy vector backend unless DATA_DIR/VECTOR_BACKEND are set.
+
+Corpora are built in a temporary directory with random unit vectors and
+deleted afterwards.
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+from benchmarks.common import prepare_stub_environment, time_calls, write_results
+
+BENCHMARKS = ["encode", "retrieve", "generate", "postprocess"]
+DEFAULT_SIZES = [1000, 100000, 1000000]
+BUILD_CHUNK_ROWS = 10000  # Synthetic documents per backend.add call
+
+QUERIES = [
+    "How does the king move in chess?",
+    "What is the capital of France?",
+    "Explain how photosynthesis works",
+    "What time does the library open on weekends?"
+]
+
+# Raw model outputs of the shapes clean_response and IncrementalCleaner deal with
+RAW_OUTPUTS = [
+    " The king moves one square in any direction. User: and the queen?",
+    "Assistant: Based on what I know, Paris is the capital of France. It is large.",
+    " Photosynthesis turns light into chemical energy in plants and algae, which is how",
+    "\n\nA: The library opens at 10am on Saturdays and Sundays.\nQuestion: what about"
+]
+
+def bench_encode(runs: int) -> Dict[str, Dict]:
+    from app.embeddings import EmbeddingModel
+
+    model = EmbeddingModel()
+    batch = [f"{QUERIES[i % len(QUERIES)]} (variant {i})" for i in range(32)]
+    return {
+        # Unique texts so the query cache never answers
+        "encode.single": time_calls(lambda i: model.encode(f"{QUERIES[i % len(QUERIES)]} #{i}", use_cache=False), runs),
+        "encode.single_cached": time_calls(lambda i: model.encode(QUERIES[0]), runs),
+        "encode.batch32": time_calls(lambda i: model.encode(batch, use_cache=False), max(1, runs // 4))
+    }
+
+def build_corpus(backend, size: int, dim: int, seed: int = 0):
+    """Fill a backend with size random unit vectors"""
+    rng = np.random.default_rng(seed)
+    for start in range(0, size, BUILD_CHUNK_ROWS):
+        rows = min(BUILD_CHUNK_ROWS, size - start)
+        vectors = rng.standard_normal((rows, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        backend.add(
+            ids=[f"bench-{start + i}" for i in range(rows)],
+            embeddings=vectors,
+            documents=[f"Synthetic benchmark document number {start + i}." for i in range(rows)],
+            metadatas=[{"topic": "benchmark"} for _ in range(rows)]
+        )
+
+def open_temp_backend(name: str, directory: Path):
+    from app.vector_store import ChromaBackend, NumpyBackend
+
+    if name == "numpy":
+        return NumpyBackend(directory=directory)
+    if name == "chromadb":
+        return ChromaBackend(path=directory, collection_name="benchmark")
+    raise ValueError(f"Unknown vector backend: {name}")
+
+def bench_retrieve(runs: int, sizes: List[int], backend_name: str) -> Dict[str, Dict]:
+    from app.knowledge import KnowledgeStore
+
+    store = KnowledgeStore()
+    original_backend = store.backend
+    dim = int(store.embedding_model.encode(QUERIES[0], use_cache=False).shape[-1])
+    results = {}
+    for size in sizes:
+        name = f"retrieve.{backend_name}.{size}"
+        directory = Path(tempfile.mkdtemp(prefix=f"bench-{backend_name}-"))
+        try:
+            backend = open_temp_backend(backend_name, directory)
+            started = time.perf_counter()
+            build_corpus(backend, size, dim)
+            build_seconds = time.perf_counter() - started
+
+            store.backend = backend
+            # A fresh query each run, so the embedding cache never answers
+            result = time_calls(lambda i: store.retrieve_relevant_knowledge(f"{QUERIES[i % len(QUERIES)]} #{i}"), runs)
+            result["build_seconds"] = round(build_seconds, 2)
+            results[name] = result
+        except Exception as e:
+            results[name] = {"error": str(e)}
+        finally:
+            store.backend = original_backend
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def bench_generate(runs: int) -> Dict[str, Dict]:
+    from app.model import Phi2Model
+
+    model = Phi2Model()
+    return {
+        "generate.single": time_calls(lambda i: model.generate(QUERIES[i % len(QUERIES)]), runs),
+        "generate.batch4": time_calls(lambda i: model.generate_batch(QUERIES), max(1, runs // 4))
+    }
+
+def bench_postprocess(runs: int) -> Dict[str, Dict]:
+    from app.postprocess import IncrementalCleaner, clean_response, find_response_end
+
+    def clean(i):
+        for query, raw in zip(QUERIES, RAW_OUTPUTS):
+            clean_response(query, raw)
+
+    def stream(i):
+        # Token-sized pieces, as TextIteratorStreamer delivers them
+        for query, raw in zip(QUERIES, RAW_OUTPUTS):
+            cleaner = IncrementalCleaner(query)
+            for piece in raw.split(" "):
+                cleaner.feed(f"{piece} ")
+                if cleaner.done:
+                    break
+            cleaner.finish()
+
+    def find_end(i):
+        for raw in RAW_OUTPUTS:
+            find_response_end(raw)
+
+    # Each call processes len(RAW_OUTPUTS) responses; enough runs for stable sub-ms numbers
+    runs = runs * 20
+    return {
+        "postprocess.clean_response": time_calls(clean, runs),
+        "postprocess.incremental": time_calls(stream, runs),
+        "postprocess.find_response_end": time_calls(find_end, runs)
+    }
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of encode, retrieval, generation and post-processing")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, help="Benchmarks to run")
+    parser.add_argument("--runs", type=int, default=30, help="Timed calls per benchmark")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="Corpus sizes for retrieval")
+    parser.add_argument("--backend", choices=["numpy", "chromadb"], default=None,
+                        help="Vector backend for retrieval (default: VECTOR_BACKEND)")
+    parser.add_argument("--stub", action="store_true", help="Use stub models (no downloads)")
+    parser.add_argument("--decode-ms", type=float, default=5.0, help="Stub milliseconds per generated token")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    if args.stub:
+        prepare_stub_environment()
+        from benchmarks.stubs import install_stubs
+        install_stubs(decode_ms=args.decode_ms)
+
+    from app.config import VECTOR_BACKEND
+    backend_name = args.backend or VECTOR_BACKEND
+    runs = max(1, args.runs)
+
+    results = {}
+    if "encode" in args.only:
+        results.update(bench_encode(runs))
+    if "retrieve" in args.only:
+        results.update(bench_retrieve(runs, args.sizes, backend_name))
+    if "generate" in args.only:
+        results.update(bench_generate(runs))
+    if "postprocess" in args.only:
+        results.update(bench_postprocess(runs))
+
+    write_results(args.output, "micro", results, stub=args.stub, runs=runs,
+                  vector_backend=backend_name, decode_ms=args.decode_ms if args.stub else None)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+Quantized embedding storage benchmark
+Builds the same corpus into NumPy indexes holding float32 vectors, int8 codes
+and PQ codes, then reports memory per vector, search and retrieval latency, and
+recall against the float32 index: recall@k of the raw search, and how many of
+the items KnowledgeStore.retrieve_relevant_knowledge returns from float32 (top
+MAX_RETRIEVED_DOCS above the similarity threshold) it still returns
+
+Usage:
+    python -m benchmarks.quantization --stub
+    python -m benchmarks.quantization --sizes 100000 1000000 --output benchmarks/results/quantization.json
+    python -m benchmarks.quantization --corpus docs.txt --sizes 50000
+
+Documents come from --corpus (one per line, repeated to reach the size) or are
+synthetic sentences drawn from topic vocabularies. Queries are stored documents
+with a third of their words dropped. Each document is embedded once and the
+vectors are added to every index, so all modes search the same data.
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+from benchmarks.common import prepare_stub_environment, time_calls, write_results
+
+MODES = ["none", "int8", "pq"]
+DEFAULT_SIZES = [10000, 100000]
+RECALL_KS = [1, 3, 10]
+EMBED_BATCH = 256
+BUILD_CHUNK_ROWS = 10000
+TOPICS = 300
+TOPIC_WORDS = 12
+SYLLABLES = ["ka", "lo", "mi", "ren", "tu", "sa", "vel", "dor", "in", "ex", "por", "qui", "bal", "ne", "tor", "ga"]
+
+def synthetic_documents(size: int, seed: int = 0) -> List[str]:
+    """Sentences mixing one topic's words with common filler, so topics form clusters"""
+    rng = np.random.default_rng(seed)
+    vocabulary = ["".join(rng.choice(SYLLABLES, 3)) for _ in range(TOPICS * TOPIC_WORDS + 500)]
+    topics = np.asarray(vocabulary[:TOPICS * TOPIC_WORDS]).reshape(TOPICS, TOPIC_WORDS)
+    filler = vocabulary[TOPICS * TOPIC_WORDS:]
+    documents = []
+    for i in range(size):
+        words = list(rng.choice(topics[rng.integers(TOPICS)], 6)) + list(rng.choice(filler, 6))
+        rng.shuffle(words)
+        documents.append(f"{' '.join(words)} {i}")
+    return documents
+
+def corpus_documents(path: Path, size: int) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if not lines:
+        raise ValueError(f"No documents in {path}")
+    # Numbered repeats keep every document distinct
+    return [lines[i % len(lines)] if i < len(lines) else f"{lines[i % len(lines)]} ({i // len(lines)})"
+            for i in range(size)]
+
+def make_queries(documents: List[str], count: int, seed: int = 1) -> List[str]:
+    """Stored documents with a third of their words dropped"""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for index in rng.choice(len(documents), min(count, len(documents)), replace=False):
+        words = documents[index].split()
+        keep = sorted(rng.choice(len(words), max(1, len(words) - len(words) // 3), replace=False))
+        queries.append(" ".join(words[i] for i in keep))
+    return queries
+
+def embed(model, texts: List[str]) -> np.ndarray:
+    return np.concatenate([
+        np.atleast_2d(model.encode(texts[start:start + EMBED_BATCH], use_cache=False))
+        for start in range(0, len(texts), EMBED_BATCH)
+    ]).astype(np.float32)
+
+def build_index(mode: str, directory: Path, documents: List[str], vectors: np.ndarray):
+    from app.vector_store import NumpyBackend
+
+    backend = NumpyBackend(directory=directory, dtype="float32", quantization=mode)
+    for start in range(0, len(documents), BUILD_CHUNK_ROWS):
+        end = min(len(documents), start + BUILD_CHUNK_ROWS)
+        backend.add(
+            ids=[f"bench-{i}" for i in range(start, end)],
+            embeddings=vectors[start:end],
+            documents=documents[start:end],
+            metadatas=[{"topic": "benchmark"} for _ in range(start, end)]
+        )
+    return backend
+
+def bench_size(store, size: int, documents: List[str], queries: List[str], runs: int) -> Dict[str, Dict]:
+    from app.config import MAX_RETRIEVED_DOCS, QUANTIZATION_TRAIN_ROWS
+
+    started = time.perf_counter()
+    vectors = embed(store.embedding_model, documents)
+    query_vectors = embed(store.embedding_model, queries)
+    embed_seconds = time.perf_counter() - started
+    for query in queries:
+        store.embedding_model.encode(query)  # Cached, so retrieval timings measure the search
+    if size < QUANTIZATION_TRAIN_ROWS:
+        print(f"Size {size} is below QUANTIZATION_TRAIN_ROWS ({QUANTIZATION_TRAIN_ROWS}): quantized indexes search exactly")
+
+    original_backend = store.backend
+    results, baseline, baseline_items = {}, None, None
+    for mode in MODES:
+        directory = Path(tempfile.mkdtemp(prefix=f"bench-quantization-{mode}-"))
+        try:
+            started = time.perf_counter()
+            backend = build_index(mode, directory, documents, vectors)
+            build_seconds = time.perf_counter() - started
+
+            neighbours = backend.query(query_vectors, n_results=max(RECALL_KS))["ids"]
+            search = time_calls(lambda i: backend.query(query_vectors[i % len(query_vectors)], MAX_RETRIEVED_DOCS), runs)
+            batch = time_calls(lambda i: backend.query(query_vectors, MAX_RETRIEVED_DOCS), max(1, runs // 10))
+            search.update({
+                "bytes_per_vector": backend.search_bytes_per_vector,
+                "disk_bytes_per_vector": round(backend.storage_bytes() / size, 1),
+                "batch_queries": len(query_vectors),
+                "batch_p50_ms": batch["p50_ms"],
+                "build_seconds": round(build_seconds, 2)
+            })
+
+            store.backend = backend
+            items = [[item["id"] for item in store.retrieve_relevant_knowledge(query, top_k=MAX_RETRIEVED_DOCS)]
+                     for query in queries]
+            retrieve = time_calls(
+                lambda i: store.retrieve_relevant_knowledge(queries[i % len(queries)], top_k=MAX_RETRIEVED_DOCS), runs
+            )
+            store.backend = original_backend
+
+            if baseline is None:
+                baseline, baseline_items = neighbours, items
+            for k in RECALL_KS:
+                search[f"recall@{k}"] = round(float(np.mean([
+                    len(set(found[:k]) & set(expected[:k])) / len(expected[:k])
+                    for found, expected in zip(neighbours, baseline) if expected
+                ])), 4)
+            relevant = [(found, expected) for found, expected in zip(items, baseline_items) if expected]
+            retrieve["queries_with_results"] = len(relevant)
+            retrieve["retrieval_recall"] = round(float(np.mean([
+                len(set(found) & set(expected)) / len(expected) for found, expected in relevant
+            ])), 4) if relevant else None
+
+            results[f"search.{mode}.{size}"] = search
+            results[f"retrieve.{mode}.{size}"] = retrieve
+        except Exception as e:
+            results[f"search.{mode}.{size}"] = {"error": str(e)}
+        finally:
+            store.backend = original_backend
+            shutil.rmtree(directory, ignore_errors=True)
+    results[f"search.none.{size}"]["embed_seconds"] = round(embed_seconds, 2)
+    return results
+
+def print_summary(results: Dict[str, Dict]):
+    print(f"\n{'index':<22}{'bytes/vec':>10}{'p50 ms':>10}{'recall@1':>10}{'recall@10':>11}{'retrieval':>11}")
+    for name, search in results.items():
+        if not name.startswith("search.") or "error" in search:
+            continue
+        retrieve = results.get(name.replace("search.", "retrieve.", 1), {})
+        retrieval = retrieve.get("retrieval_recall")
+        print(
+            f"{name[len('search.'):]:<22}{search['bytes_per_vector']:>10}{search['p50_ms']:>10.3f}"
+            f"{search['recall@1']:>10.4f}{search['recall@10']:>11.4f}"
+            f"{retrieval if retrieval is not None else '-':>11}"
+        )
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Memory, latency and recall of int8 and PQ embedding storage")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="Corpus sizes")
+    parser.add_argument("--corpus", type=Path, help="Documents to embed, one per line (default: synthetic)")
+    parser.add_argument("--queries", type=int, default=200, help="Queries for recall")
+    parser.add_argument("--runs", type=int, default=100, help="Timed single-query searches per index")
+    parser.add_argument("--stub", action="store_true", help="Use the hashing stub embedding model (no downloads)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    if args.stub:
+        prepare_stub_environment()
+        from benchmarks.stubs import install_stubs
+        install_stubs()
+
+    from app.config import NUMPY_PQ_SUBVECTORS, QUANTIZATION_RERANK
+    from app.knowledge import KnowledgeStore
+
+    store = KnowledgeStore()
+    results = {}
+    for size in args.sizes:
+        documents = corpus_documents(args.corpus, size) if args.corpus else synthetic_documents(size)
+        results.update(bench_size(store, size, documents, make_queries(documents, args.queries), max(1, args.runs)))
+
+    write_results(args.output, "quantization", results, stub=args.stub, sizes=args.sizes,
+                  corpus=str(args.corpus) if args.corpus else "synthetic",
+                  pq_subvectors=NUMPY_PQ_SUBVECTORS, rerank=QUANTIZATION_RERANK)
+    print_summary(results)
+    store.usage.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Speculative decoding benchmark
+Times greedy generation of MODEL_NAME with and without the draft model
+(SPECULATIVE_DRAFT_MODEL) and reports the acceptance rate and speedup
+
+Usage:
+    SPECULATIVE_DRAFT_MODEL=distilgpt2 python -m benchmarks.speculative
+    SPECULATIVE_DRAFT_MODEL=distilgpt2 SPECULATIVE_DRAFT_TOKENS=3 python -m benchmarks.speculative --tokens 64
+"""
+import argparse
+import json
+import sys
+import time
+from typing import List
+
+PROMPTS = [
+    "The rules of chess are simple once you know how each piece moves.",
+    "Python is a programming language that",
+    "The weather today is",
+    "In the history of science, the most important discovery was"
+]
+
+def time_generation(model, prompts: List[str], tokens: int, assisted: bool) -> float:
+    """
+    Greedy generation of exactly `tokens` new tokens per prompt
+
+    Returns:
+        Total seconds (model call counts go into model.speculative)
+    """
+    import torch
+
+    tokenizer = model._tokenizer
+    elapsed = 0.0
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt").to(model._model.device)
+        kwargs = dict(max_new_tokens=tokens, min_new_tokens=tokens, do_sample=False,
+                      pad_token_id=tokenizer.pad_token_id)
+        if assisted:
+            kwargs["assistant_model"] = model._draft_model
+        model.speculative.begin()
+        started = time.perf_counter()
+        with torch.no_grad():
+            outputs = model._model.generate(**inputs, **kwargs)
+        seconds = time.perf_counter() - started
+        model.speculative.record(assisted, outputs.shape[1] - inputs["input_ids"].shape[1], seconds)
+        elapsed += seconds
+    return elapsed
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare generation with and without a speculative draft model")
+    parser.add_argument("--tokens", type=int, default=32, help="New tokens per prompt")
+    parser.add_argument("--runs", type=int, default=2, help="Passes over the prompt set")
+    args = parser.parse_args(argv)
+
+    from app.model import Phi2Model
+    from app.config import SPECULATIVE_DRAFT_MODEL, SPECULATIVE_DRAFT_TOKENS
+
+    model = Phi2Model()
+    if model.speculative is None:
+        print("Speculative decoding is not active: set SPECULATIVE_DRAFT_MODEL to a compatible model "
+              "(see the log for why it was disabled)", file=sys.stderr)
+        return 1
+
+    time_generation(model, PROMPTS[:1], 4, assisted=True)  # Warm-up
+    time_generation(model, PROMPTS[:1], 4, assisted=False)
+    model.speculative.reset()
+
+    baseline_seconds = 0.0
+    assisted_seconds = 0.0
+    for _ in range(max(1, args.runs)):
+        baseline_seconds += time_generation(model, PROMPTS, args.tokens, assisted=False)
+        assisted_seconds += time_generation(model, PROMPTS, args.tokens, assisted=True)
+
+    stats = model.speculative_stats()
+    result = {
+        "draft_model": SPECULATIVE_DRAFT_MODEL,
+        "draft_tokens": SPECULATIVE_DRAFT_TOKENS,
+        "baseline_seconds": round(baseline_seconds, 3),
+        "assisted_seconds": round(assisted_seconds, 3),
+        "speedup": round(baseline_seconds / assisted_seconds, 3) if assisted_seconds else None,
+        "acceptance_rate": round(stats["acceptance_rate"], 3),
+        "tokens_per_verification": round(stats["tokens_per_verification"], 2)
+    }
+    print(json.dumps(result, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
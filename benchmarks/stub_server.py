@@ -0,0 +1,38 @@
+"""
+API server with stub models, for load tests that should not download anything
+
+Usage:
+    python -m benchmarks.stub_server --port 8765 --decode-ms 5
+
+Runs the real FastAPI app (scheduler, caches, ingestion queue, metrics) with the
+models from benchmarks.stubs, a temporary data directory and the NumPy vector
+backend. The response cache is disabled unless RESPONSE_CACHE_SIZE is set, so
+every /chat request reaches the (stub) model.
+"""
+import argparse
+import os
+import sys
+from benchmarks.common import prepare_stub_environment
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Serve the API with stub models")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--decode-ms", type=float, default=5.0, help="Milliseconds per generated token")
+    parser.add_argument("--prefill-ms", type=float, default=0.2, help="Milliseconds per prompt token")
+    args = parser.parse_args(argv)
+
+    prepare_stub_environment()
+    os.environ.setdefault("RESPONSE_CACHE_SIZE", "0")
+
+    from benchmarks.stubs import install_stubs
+    install_stubs(decode_ms=args.decode_ms, prefill_ms=args.prefill_ms)
+
+    import uvicorn
+    from app.main import app
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Stub models for benchmarking without model downloads
+Deterministic stand-ins for EmbeddingModel and Phi2Model that keep the real
+caching, batching, post-processing and metrics code paths and replace only
+the neural network calls (generation sleeps for a configurable per-token time)
+"""
+import threading
+import time
+import zlib
+from typing import Iterator, List, Optional
+import numpy as np
+from app.config import MAX_NEW_TOKENS, TEMPERATURE
+from app.context import use_tokenizer
+from app.embeddings import EmbeddingModel
+from app.metrics import stage, record_generation
+from app.model import Phi2Model
+from app.postprocess import IncrementalCleaner, clean_response, find_response_end, stop_strings_for
+
+STUB_EMBEDDING_DIM = 384  # Same as all-MiniLM-L6-v2
+STUB_VOCAB_SIZE = 50257  # Same as GPT-2
+
+# Continuation the stub model "generates" for every prompt
+STUB_CONTINUATION = " is a topic with a short answer that fits in one sentence. More text follows here."
+
+def _token_id(word: str) -> int:
+    return zlib.crc32(word.encode("utf-8")) % STUB_VOCAB_SIZE
+
+class StubTokenizer:
+    """Whitespace tokenizer with hashed ids, in place of the chat model's tokenizer"""
+
+    def __call__(self, texts, add_special_tokens: bool = False, **kwargs) -> dict:
+        if isinstance(texts, str):
+            return {"input_ids": [_token_id(word) for word in texts.split()]}
+        return {"input_ids": [[_token_id(word) for word in text.split()] for text in texts]}
+
+class HashEncoder:
+    """
+    Bag-of-words feature hashing in place of the sentence-transformers model
+
+    Texts sharing words get similar unit vectors, so retrieval and the
+    response cache behave plausibly.
+    """
+
+    def __init__(self, dim: int = STUB_EMBEDDING_DIM):
+        self.dim = dim
+
+    def encode(self, texts, show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                digest = zlib.crc32(word.encode("utf-8"))
+                vectors[row, digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+class StubEmbeddingModel(EmbeddingModel):
+    """EmbeddingModel whose encoder is a HashEncoder (the query cache stays real)"""
+
+    def load_model(self):
+        self.backend = "stub"
+        self._model = HashEncoder()
+
+class StubPhi2Model(Phi2Model):
+    """
+    Phi2Model that sleeps instead of running the network
+
+    A batch costs prefill_seconds per prompt token plus decode_seconds per generated
+    token (shared by the batch, like a real batched forward pass).
+    """
+
+    prefill_seconds = 0.0002
+    decode_seconds = 0.005
+
+    def load_model(self):
+        self.backend = "stub"
+        self.load_timings = {}
+        self._model = self._tokenizer = "stub"
+
+    def encode_text(self, text: str) -> List[int]:
+        return StubTokenizer()(text)["input_ids"]
+
+    def _respond(self, prompt: str, max_tokens: int, stop: Optional[List[str]]) -> tuple:
+        """Cleaned stub response and the number of tokens it took"""
+        words = STUB_CONTINUATION.split(" ")[:min(max_tokens, 25) + 1]
+        text = " ".join(words)
+        end = find_response_end(text, stop_strings_for(stop))
+        if end is not None:
+            text = text[:end]
+        return text, max(1, len(text.split()))
+
+    def generate(self, prompt: str, max_tokens: int = MAX_NEW_TOKENS,
+                 temperature: float = TEMPERATURE, context="",
+                 stop: Optional[List[str]] = None) -> str:
+        return self.generate_batch([prompt], max_tokens=max_tokens, contexts=[context], stop=stop)[0]
+
+    def generate_batch(self, prompts: List[str], max_tokens: int = MAX_NEW_TOKENS,
+                       contexts: Optional[List[str]] = None,
+                       stop: Optional[List[str]] = None,
+                       prompt_ids: Optional[List[List[int]]] = None) -> List[str]:
+        contexts = contexts or [""] * len(prompts)
+        with stage("tokenize"):
+            if prompt_ids is None:
+                prompt_ids = [self.encode_prompt(p, c) for p, c in zip(prompts, contexts)]
+        outputs = [self._respond(prompt, max_tokens, stop) for prompt in prompts]
+        longest = max((tokens for _, tokens in outputs), default=0)
+
+        started = time.perf_counter()
+        with stage("generate"):
+            time.sleep(self.prefill_seconds * max(len(ids) for ids in prompt_ids) + self.decode_seconds * longest)
+        record_generation(sum(len(ids) for ids in prompt_ids), sum(tokens for _, tokens in outputs),
+                          time.perf_counter() - started)
+
+        with stage("postprocess"):
+            return [clean_response(prompt, text) for prompt, (text, _) in zip(prompts, outputs)]
+
+    def generate_with_history(self, prompt_ids: List[int], prompt: str, max_tokens: int = MAX_NEW_TOKENS,
+                              stop: Optional[List[str]] = None, past_ids: Optional[List[int]] = None,
+                              past_key_values=None) -> dict:
+        prefix = prompt_ids[:-1]
+        reused = len(past_ids) if past_ids and prefix[:len(past_ids)] == list(past_ids) else 0
+        text, tokens = self._respond(prompt, max_tokens, stop)
+
+        started = time.perf_counter()
+        with stage("generate"):
+            time.sleep(self.prefill_seconds * (len(prompt_ids) - reused) + self.decode_seconds * tokens)
+        record_generation(len(prompt_ids) - reused, tokens, time.perf_counter() - started)
+
+        with stage("postprocess"):
+            return {"response": clean_response(prompt, text), "cache_ids": [], "cache": None}
+
+    def extend_cache(self, past_ids: List[int], past_key_values, token_ids: List[int]):
+        return None
+
+    def stream(self, prompt: str, max_tokens: int = MAX_NEW_TOKENS, context="",
+               cancel_event: Optional[threading.Event] = None,
+               stop: Optional[List[str]] = None) -> Iterator[str]:
+        cancel_event = cancel_event or threading.Event()
+        cleaner = IncrementalCleaner(prompt, stop_strings=stop_strings_for(stop))
+        words = STUB_CONTINUATION.split(" ")[:min(max_tokens, 25) + 1]
+        time.sleep(self.prefill_seconds * len(self.encode_prompt(prompt, context)))
+        for i, word in enumerate(words):
+            if cancel_event.is_set():
+                return
+            time.sleep(self.decode_seconds)
+            piece = cleaner.feed(word if i == 0 else f" {word}")
+            if piece:
+                yield piece
+            if cleaner.done:
+                break
+        tail = cleaner.finish()
+        if tail:
+            yield tail
+
+def install_stubs(decode_ms: float = 5.0, prefill_ms: float = 0.2):
+    """
+    Make EmbeddingModel() and Phi2Model() return stub instances and use the stub tokenizer
+
+    Must run before anything instantiates the real models.
+
+    Args:
+        decode_ms: Simulated milliseconds per generated token
+        prefill_ms: Simulated milliseconds per prompt token
+    """
+    use_tokenizer(StubTokenizer())
+    StubPhi2Model.decode_seconds = decode_ms / 1000.0
+    StubPhi2Model.prefill_seconds = prefill_ms / 1000.0
+    if not isinstance(EmbeddingModel._instance, StubEmbeddingModel):
+        EmbeddingModel._instance = object.__new__(StubEmbeddingModel)
+    if not isinstance(Phi2Model._instance, StubPhi2Model):
+        Phi2Model._instance = object.__new__(StubPhi2Model)